@@ -49,6 +49,36 @@ Environment Variables:
 - FIRECRAWL_RETRIES: Retries for Firecrawl (default: 1, set to 0 to disable)
 - BRIGHTDATA_RETRIES: Retries for Bright Data (default: 3, set to 0 to disable)
 - PLAYWRIGHT_RETRIES: Retries for Playwright (default: 2, set to 0 to disable)
+- HEDGE_ENABLED: Start the next method if the current one is slow (default: false)
+- HEDGE_DELAY_SECONDS: Fixed hedge delay (default: observed p90 latency of the current method)
+- HEDGE_MAX_IN_FLIGHT: Max hedged fetches in flight per container (default: 5)
+- DOMAIN_ROUTER_ENABLED: Order methods per domain from past outcomes (default: true)
+- FIRECRAWL_GLOBAL_CONCURRENCY: Firecrawl calls in flight across all containers/jobs (default: 5)
+- BRIGHTDATA_GLOBAL_CONCURRENCY / GEMINI_GLOBAL_CONCURRENCY: Same, 0 = unlimited (default: 0)
+- HEDGE_GLOBAL_MAX_IN_FLIGHT: Hedged fetches in flight across all containers (default: 0 = off)
+- SHARD_SIZE: Jobs larger than this are split across process_batch containers (default: 1000, 0 = off)
+- SCREENSHOT_PROFILE: Screenshot compression profile: fast / balanced / archival (default: balanced)
+- SCREENSHOT_DERIVATIVES_ENABLED: Also upload viewport + thumbnail images (screenshotViewportUrl / screenshotThumbUrl) (default: true)
+- SCREENSHOT_DEDUPE_ENABLED: Reuse the previous screenshot when it looks the same and the price is unchanged (default: true)
+- SCREENSHOT_DEDUPE_MAX_DISTANCE: Max fraction of differing dHash bits to count as unchanged (default: 0.02)
+- SCREENSHOT_POLICY: When to capture screenshots: always / alert / price_changed / error (default: always,
+  overridden per job or per URL by screenshotPolicy)
+- R2_MAX_IN_FLIGHT: R2 requests in flight per container (default: 8)
+- R2_MULTIPART_THRESHOLD: Uploads larger than this (bytes) use multipart (default: 8 MiB)
+- CPU_POOL_WORKERS: Processes for HTML cleaning / image compression per container (default: CPUs, 0 = inline)
+- CPU_POOL_MAX_WORKERS: Cap on the default CPU_POOL_WORKERS (default: 4)
+- CLEAN_HTML_TOKEN_BUDGET: Token budget for the cleaned HTML sent to Gemini (default: 12500)
+- TEMPLATES_ENABLED: Learn per-domain XPath templates from Gemini results and reuse them (default: true)
+- TEMPLATE_VERIFY_RATE: Fraction of template hits re-checked with Gemini (default: 0.05)
+- TEMPLATE_REQUIRED_FIELDS: Comma-separated fields a template hit must have, after filling from structured
+  data, to skip Gemini (default: currentPrice,productTitle,availability)
+- GEMINI_MAX_IN_FLIGHT: Gemini calls in flight per container (default: 20)
+- GEMINI_BATCH_ENABLED: Pack several pages into one Gemini request (default: false)
+- GEMINI_BATCH_MAX_ITEMS / GEMINI_BATCH_TOKEN_BUDGET / GEMINI_BATCH_MAX_WAIT: Batch limits (default: 5 / 60000 / 2.0s)
+- EXTRACTION_CACHE_ENABLED: Reuse Gemini results when the cleaned HTML is unchanged (default: true)
+- EXTRACTION_CACHE_TTL: Seconds a cached extraction stays valid (default: 259200 = 3 days)
+- STRUCTURED_FAST_PATH: Skip Gemini when JSON-LD/VTEX/microdata has the required fields (default: true)
+- STRUCTURED_REQUIRED_FIELDS: Comma-separated fields required for the fast path (default: currentPrice,productTitle)
 
 Usage:
     modal run app/modal_scraper.py
@@ -58,17 +88,22 @@ Usage:
 
 import modal
 import asyncio
+import atexit
 import gzip
+import hashlib
 import json
 import os
 import random
 import re
 import time
 import uuid
-from dataclasses import dataclass, field
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field, fields
 from datetime import datetime, timezone
 from io import BytesIO
-from typing import List, Optional, Tuple, Any
+from typing import List, Optional, Tuple, Any, get_args
 
 # =============================================================================
 # Modal App Configuration
@@ -89,10 +124,9 @@ scraper_image = (
     .pip_install(
         "playwright==1.42.0",
         "playwright-stealth>=1.0.6",
-        "httpx>=0.27.0",
-        "beautifulsoup4>=4.12.0",
+        "httpx[http2]>=0.27.0",
         "lxml>=4.9.0",
-        "google-genai>=1.0.0",
+        "google-genai>=1.20.0",
         "pillow>=10.0.0",
         "boto3>=1.28.0",
         "firecrawl-py>=1.0.0",
@@ -109,6 +143,13 @@ METHOD_FIRECRAWL = "firecrawl"
 METHOD_BRIGHTDATA = "brightdata"
 METHOD_PLAYWRIGHT = "playwright"
 
+# Display names (as recorded in ScrapeResult.attempts)
+METHOD_DISPLAY_NAMES = {
+    METHOD_FIRECRAWL: "Firecrawl",
+    METHOD_BRIGHTDATA: "Bright Data",
+    METHOD_PLAYWRIGHT: "Playwright",
+}
+
 # Primary scraper options
 PRIMARY_FIRECRAWL = "firecrawl"
 PRIMARY_BRIGHTDATA = "brightdata"
@@ -119,6 +160,56 @@ DEFAULT_FIRECRAWL_RETRIES = 1    # Firecrawl: often blocked, 1 attempt
 DEFAULT_BRIGHTDATA_RETRIES = 3   # Bright Data: reliable, worth retrying
 DEFAULT_PLAYWRIGHT_RETRIES = 2   # Playwright: local browser, worth retrying
 
+# Job checkpoints (resumable jobs)
+CHECKPOINT_DICT_PREFIX = "scrape-job-"   # One modal.Dict per job: scrape-job-{jobId}
+CHECKPOINT_INTERVAL = 20                 # Write checkpoints every N ingested results
+CHECKPOINT_INPUT_KEY = "__input__"       # Stored job input, used by the resume endpoint
+CHECKPOINT_CALL_KEY = "__call__"         # FunctionCall id of the job's current run
+
+# Sharded execution (large jobs split across orchestrator containers)
+DEFAULT_SHARD_SIZE = 1000        # URLs per process_batch shard (0 = never shard)
+
+# Hedged fetch configuration (can be overridden via environment variables)
+DEFAULT_HEDGE_DELAY = 20.0       # Seconds before starting the secondary method (until p90 is known)
+DEFAULT_HEDGE_MAX_IN_FLIGHT = 5  # Max hedged (secondary) fetches running at once per container
+HEDGE_MIN_SAMPLES = 20           # Successful fetches needed before using observed p90
+HEDGE_LATENCY_WINDOW = 200       # Rolling window of latencies per method
+
+# Domain router configuration (per-domain method ordering learned from past attempts)
+DOMAIN_STATS_DICT = "scraper-domain-stats"  # modal.Dict shared by all containers
+ROUTER_MIN_SAMPLES = 5           # Attempts needed before a method's stats are trusted
+ROUTER_MIN_SUCCESS_RATE = 0.5    # Below this, a method is moved to the end for the domain
+ROUTER_MAX_SAMPLES = 200         # Halve counters past this so old outcomes fade
+ROUTER_CACHE_TTL = 300.0         # Seconds to cache domain stats in a container
+ROUTER_EXPLORE_RATE = 0.05       # Fraction of URLs that keep the default order (re-tests bad methods)
+ROUTER_METHOD_COST = {           # Relative cost per attempt (price + latency)
+    METHOD_FIRECRAWL: 1.0,
+    METHOD_BRIGHTDATA: 2.0,      # Two requests (HTML + screenshot)
+    METHOD_PLAYWRIGHT: 3.0,      # Slowest, last resort
+}
+
+# Gemini extraction cache (skip Gemini when the cleaned HTML is unchanged)
+GEMINI_MODEL = "gemini-2.5-flash"
+GEMINI_PROMPT_VERSION = "v2"              # Bump when the prompt/fields change (invalidates the cache)
+GEMINI_MAX_OUTPUT_TOKENS = 2048           # Per page; schema-constrained output is ~300 tokens (long descriptions more)
+GEMINI_THINKING_BUDGET = 0                # 2.5-flash thinking tokens count against max_output_tokens; extraction needs none
+EXTRACTION_CACHE_DICT = "scraper-extraction-cache"  # modal.Dict shared by all containers
+DEFAULT_EXTRACTION_CACHE_TTL = 3 * 86400  # Seconds an extraction stays valid
+EXTRACTION_CACHE_LOCAL_SIZE = 2000        # In-container LRU entries in front of the shared store
+DEFAULT_GEMINI_MAX_IN_FLIGHT = 20         # Gemini calls in flight per container (= scrape_url max_inputs)
+GEMINI_MAX_CONNECTIONS = 20               # Pooled connections to the Gemini endpoint per container
+GEMINI_MAX_HTML_CHARS = 50000             # Cleaned HTML sent per page
+
+# Multi-page Gemini extraction (several pages per request, opt-in via GEMINI_BATCH_ENABLED)
+DEFAULT_GEMINI_BATCH_MAX_ITEMS = 5        # Pages per Gemini request
+DEFAULT_GEMINI_BATCH_TOKEN_BUDGET = 60000 # Estimated input tokens per request (~4 chars/token)
+DEFAULT_GEMINI_BATCH_MAX_WAIT = 2.0       # Seconds the first page waits for others before sending
+
+# Domain templates (learned per-domain XPath extraction, skips Gemini)
+DOMAIN_TEMPLATES_DICT = "scraper-domain-templates"  # modal.Dict shared by all containers
+TEMPLATE_CACHE_TTL = 300.0            # Seconds to cache a domain's template in a container
+DEFAULT_TEMPLATE_VERIFY_RATE = 0.05   # Fraction of template hits re-checked with Gemini
+
 # Tinybird configuration
 TINYBIRD_HOST = "https://api.us-east.tinybird.co"
 TINYBIRD_DATASOURCE = "product_scrapes"
@@ -131,6 +222,49 @@ TINYBIRD_BASE_DELAY = 1.0         # Initial retry delay (seconds)
 TINYBIRD_MAX_DELAY = 10.0         # Maximum retry delay (seconds)
 TINYBIRD_REQUEST_TIMEOUT = 30.0   # HTTP request timeout
 
+# Cluster-wide provider limiter (shared across containers and concurrent jobs)
+SCRAPE_URL_TIMEOUT = 300          # scrape_url function timeout (s)
+PROVIDER_LEASES_DICT = "scraper-provider-leases"  # modal.Dict holding slot leases
+PROVIDER_LEASE_TTL = 60.0         # Lease expiry (s) - renewed while held, frees slots of dead containers
+PROVIDER_LEASE_RENEW = PROVIDER_LEASE_TTL / 3  # Renewal interval while a slot is held
+PROVIDER_LOCK_TTL = 10.0          # Lease-set lock expiry (s) - an update takes two RPCs
+PROVIDER_LOCK_RETRY = 0.05        # Wait between attempts to take a busy lease-set lock
+PROVIDER_LOCK_ATTEMPTS = 20       # Attempts before giving up on the lock for one update
+# Max wait for a slot before proceeding without one. Must stay well below
+# SCRAPE_URL_TIMEOUT, or the function is killed (and retried) before the
+# fail-open path can run.
+PROVIDER_ACQUIRE_TIMEOUT = min(60.0, SCRAPE_URL_TIMEOUT / 5)
+PROVIDER_POLL_MIN = 0.2           # Initial poll interval while waiting for a slot
+PROVIDER_POLL_MAX = 2.0           # Maximum poll interval
+
+PROVIDER_FIRECRAWL = "firecrawl"
+PROVIDER_BRIGHTDATA = "brightdata"
+PROVIDER_GEMINI = "gemini"
+PROVIDER_HEDGE = "hedge"
+
+# Async R2 client (native async S3 API over the pooled httpx client)
+DEFAULT_R2_MAX_IN_FLIGHT = 8               # R2 requests in flight per container
+R2_MAX_RETRIES = 3                         # Retries for network errors, 429 and 5xx
+R2_RETRY_BASE_DELAY = 0.5                  # Seconds (doubles per retry, with jitter)
+R2_RETRY_MAX_DELAY = 5.0
+R2_REQUEST_TIMEOUT = 60.0
+DEFAULT_R2_MULTIPART_THRESHOLD = 8 * 1024 * 1024  # Bytes; larger objects use multipart upload
+R2_MULTIPART_PART_SIZE = 5 * 1024 * 1024   # R2 minimum part size (all parts but the last)
+R2_LATENCY_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000)
+R2_KNOWN_KEYS_MAX = 20000                  # Content-addressed keys known to exist (per container LRU)
+R2_IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Shared HTTP client pool (one client per provider, per container)
+HTTP_KEEPALIVE_EXPIRY = 60.0      # Keep idle connections warm for N seconds
+HTTP_POOL_MULTIPLIER = 2          # max_connections = max_inputs × N (HTML + screenshot)
+
+# Playwright browser pool (per scrape_url container, 512 MB)
+PLAYWRIGHT_POOL_BROWSERS = 1          # Long-lived Chromium processes per container
+PLAYWRIGHT_MAX_CONTEXTS = 3           # Concurrent contexts (~100-150 MB each on retail pages)
+PLAYWRIGHT_PAGES_PER_BROWSER = 50     # Recycle browser after N pages
+PLAYWRIGHT_MEMORY_LIMIT_MB = 400      # Recycle browser when container memory exceeds this
+PLAYWRIGHT_MIN_PAGES_BEFORE_RECYCLE = 5  # Avoid relaunch thrash under sustained memory pressure
+
 # =============================================================================
 # Optimal Configuration by Primary Scraper
 # =============================================================================
@@ -170,6 +304,7 @@ class AttemptResult:
     screenshot_bytes: Optional[bytes] = None
     error: Optional[str] = None
     method: str = ""
+    timings: dict = field(default_factory=dict)  # Per-request durations (ms)
 
 
 @dataclass
@@ -192,6 +327,8 @@ class ScrapeResult:
     scrapedAt: int
     errorMessage: Optional[str] = None
     screenshotUrl: Optional[str] = None
+    screenshotThumbUrl: Optional[str] = None     # Small viewport thumbnail (list views)
+    screenshotViewportUrl: Optional[str] = None  # First screen of the page
     productTitle: Optional[str] = None
     brand: Optional[str] = None
     currentPrice: Optional[float] = None
@@ -230,6 +367,8 @@ class ScrapeResult:
     channelName: Optional[str] = None
     familyId: Optional[str] = None
     familyName: Optional[str] = None
+    # Per-URL performance counters (not ingested, aggregated by process_batch)
+    metrics: Optional[dict] = None
 
     def to_dict(self) -> dict:
         result = {
@@ -239,14 +378,15 @@ class ScrapeResult:
             "scrapedAt": self.scrapedAt,
         }
         for field_name in [
-            "errorMessage", "screenshotUrl", "productTitle", "brand",
+            "errorMessage", "screenshotUrl", "screenshotThumbUrl", "screenshotViewportUrl", "productTitle", "brand",
             "currentPrice", "originalPrice", "discountPercentage", "currency",
             "availability", "product_image_url", "seller", "shippingInfo", "shippingCost",
             "deliveryTime", "review_score", "installmentOptions", "kit", "unitMeasurement",
             "outOfStockReason", "marketplaceWebsite", "sku", "ean", "stockQuantity",
             "otherPaymentMethods", "promotionDetails", "method", "attempts", "errors",
             "alertId", "companyName", "hasAlert", "screenshotId",
-            "businessId", "businessName", "channelId", "channelName", "familyId", "familyName"
+            "businessId", "businessName", "channelId", "channelName", "familyId", "familyName",
+            "metrics"
         ]:
             value = getattr(self, field_name)
             if value is not None:
@@ -555,131 +695,346 @@ SELECTOR_PATTERNS = {
 }
 
 
-def clean_html(html_content: str) -> Tuple[str, dict]:
+class SelectorEngine:
+    """
+    Matcher for SELECTOR_PATTERNS, compiled once at import time.
+
+    The patterns are plain alternations of (case-insensitive) substrings. The
+    terms are de-duplicated across categories and compiled two ways:
+    - a trie-shaped regex (shared prefixes are factored out, so re does not
+      try every alternative at each position) for the hot yes/no check on
+      every class/id attribute
+    - an Aho-Corasick automaton that reports every category whose terms occur
+      in the text, used only for captured elements
+    """
+
+    def __init__(self, patterns: dict):
+        self.category_order = {name: i for i, name in enumerate(patterns)}
+        term_categories: dict = {}
+        total_terms = 0
+        for name, pattern in patterns.items():
+            for term in pattern.split('|'):
+                term = term.lower()
+                if term:
+                    total_terms += 1
+                    term_categories.setdefault(term, set()).add(name)
+        self.term_categories = term_categories
+        self.duplicates_removed = total_terms - len(term_categories)
+        self.regex = re.compile(self._trie_pattern(sorted(term_categories)), re.I)
+        self._build_automaton()
+
+    @staticmethod
+    def _trie_pattern(terms: List[str]) -> str:
+        trie: dict = {}
+        for term in terms:
+            node = trie
+            for ch in term:
+                node = node.setdefault(ch, {})
+            node[''] = True
+
+        def build(node: dict) -> str:
+            is_end = '' in node
+            alternatives = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch != '']
+            if not alternatives:
+                return ''
+            if len(alternatives) == 1 and not is_end:
+                return alternatives[0]
+            group = '(?:' + '|'.join(alternatives) + ')'
+            # A term ends here: the rest is optional (substring search needs only the shortest)
+            return group + '?' if is_end else group
+
+        return build(trie)
+
+    def _build_automaton(self):
+        goto: List[dict] = [{}]
+        outputs: List[frozenset] = [frozenset()]
+        for term, categories in self.term_categories.items():
+            state = 0
+            for ch in term:
+                if ch not in goto[state]:
+                    goto.append({})
+                    outputs.append(frozenset())
+                    goto[state][ch] = len(goto) - 1
+                state = goto[state][ch]
+            outputs[state] = outputs[state] | categories
+
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in goto[state].items():
+                queue.append(nxt)
+                f = fail[state]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(ch, 0) if goto[f].get(ch, 0) != nxt else 0
+                outputs[nxt] = outputs[nxt] | outputs[fail[nxt]]
+        self._goto, self._fail, self._outputs = goto, fail, outputs
+
+    def search(self, text: str) -> bool:
+        """True if any selector term occurs in text."""
+        return self.regex.search(text) is not None
+
+    def categories(self, text: str) -> List[str]:
+        """All categories with a term occurring in text, in SELECTOR_PATTERNS order."""
+        goto, fail, outputs = self._goto, self._fail, self._outputs
+        found: set = set()
+        state = 0
+        for ch in text.lower():
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if outputs[state]:
+                found |= outputs[state]
+        return sorted(found, key=self.category_order.__getitem__)
+
+
+SELECTOR_ENGINE = SelectorEngine(SELECTOR_PATTERNS)
+
+
+# Sections of the cleaned HTML, in the order they fill the token budget
+CLEAN_HTML_SECTIONS = ("structured", "price_title", "images", "areas", "scripts")
+CLEAN_HTML_PRIORITY_PATTERNS = ("product_title", "price", "discount")  # -> price_title section
+DEFAULT_CLEAN_HTML_TOKEN_BUDGET = 12500   # ~50,000 chars at ~4 chars/token
+CLEAN_HTML_MIN_PARTIAL_TOKENS = 250       # Truncate an item to fit only if at least this much is left
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough Gemini token estimate (~4 chars/token for HTML)."""
+    return len(text) // 4 + 1
+
+
+def get_clean_html_token_budget() -> int:
+    """Token budget for clean_html output (CLEAN_HTML_TOKEN_BUDGET, default: 12500)."""
+    try:
+        return max(1, int(os.environ.get("CLEAN_HTML_TOKEN_BUDGET", DEFAULT_CLEAN_HTML_TOKEN_BUDGET)))
+    except ValueError:
+        return DEFAULT_CLEAN_HTML_TOKEN_BUDGET
+
+
+def fill_token_budget(sections: List[Tuple[str, List[str]]], token_budget: int) -> Tuple[List[str], dict, int]:
+    """
+    Take items from ranked sections until the token budget is spent.
+
+    Items that do not fit are skipped (a smaller later item may still fit);
+    the first item that does not fit is truncated if enough budget is left.
+
+    Returns:
+        Tuple of (kept items, tokens kept per section, tokens dropped)
+    """
+    kept: List[str] = []
+    section_tokens: dict = {}
+    dropped = 0
+    remaining = token_budget
+
+    for name, items in sections:
+        used = 0
+        for item in items:
+            tokens = estimate_tokens(item)
+            if tokens <= remaining:
+                kept.append(item)
+                used += tokens
+                remaining -= tokens
+            elif remaining >= CLEAN_HTML_MIN_PARTIAL_TOKENS:
+                partial = item[:remaining * 4]
+                kept.append(partial)
+                used += remaining
+                dropped += tokens - remaining
+                remaining = 0
+            else:
+                dropped += tokens
+        section_tokens[name] = used
+
+    return kept, section_tokens, dropped
+
+
+# Keywords/lists used by clean_html (module level so they are built once)
+CLEAN_HTML_SCRIPT_KEYWORDS = (
+    # Product data
+    'product', 'price', 'sku', 'stock', 'inventory',
+    # Portuguese
+    'preco', 'preço', 'produto', 'estoque',
+    # Spanish
+    'precio', 'producto', 'existencias',
+    # Platforms
+    'catalog', 'vtex', 'magento', 'shopify', 'woocommerce',
+    # Schema.org
+    'schema', '@type', 'offer', 'aggregaterating'
+)
+CLEAN_HTML_SCRIPT_TYPES = ('application/ld+json', 'application/json')
+CLEAN_HTML_SCRIPT_IDS = ('__NEXT_DATA__', '__NUXT_DATA__', 'schema-org')
+CLEAN_HTML_REMOVED_TAGS = frozenset(('script', 'style', 'noscript', 'iframe', 'svg', 'link', 'footer', 'nav'))
+CLEAN_HTML_IMAGE_SKIP = ('icon', 'logo', 'sprite', 'pixel', 'tracking', 'analytics', 'badge', 'flag', 'banner', 'ad-', 'advertisement')
+CLEAN_HTML_META_KEYWORDS = (
+    'product', 'price', 'amount', 'currency',
+    'title', 'name', 'description',
+    'image', 'og:', 'twitter:',
+    'brand', 'manufacturer',
+    'availability', 'sku',
+    'review', 'rating'
+)
+# Schema.org microdata props (output is grouped in this order)
+CLEAN_HTML_SCHEMA_PROPS = (
+    'name', 'description', 'image', 'brand', 'sku', 'gtin', 'mpn',
+    'price', 'priceCurrency', 'availability', 'seller',
+    'aggregateRating', 'ratingValue', 'reviewCount', 'offers'
+)
+CLEAN_HTML_DATA_ATTR = re.compile(r'data-(product|price|sku|stock|brand|seller|image)', re.I)
+
+
+def _parse_html_document(html_content: str):
+    """Parse HTML with lxml. Returns None if the document is empty/unparseable."""
+    from lxml import etree, html as lxml_html
+
+    if not html_content or not html_content.strip():
+        return None
+    try:
+        return lxml_html.document_fromstring(html_content)
+    except ValueError:
+        # str with an XML encoding declaration: parse the bytes instead
+        return lxml_html.document_fromstring(html_content.encode('utf-8'))
+    except (etree.ParserError, etree.XMLSyntaxError):
+        return None
+
+
+def clean_html(html_content: str, token_budget: Optional[int] = None) -> Tuple[str, dict]:
     """
     Clean HTML content to reduce tokens while preserving product information.
 
     Uses partial matching (contains) for CSS selectors - this is the recommended
     approach because it catches variations like BEM naming, platform prefixes,
     and site-specific customizations.
-    """
-    from bs4 import BeautifulSoup, Comment
 
-    soup = BeautifulSoup(html_content, 'lxml')
+    The document is parsed once with lxml and walked once: every category
+    (scripts, meta, microdata, images, class/id/data-* areas) is collected in
+    the same traversal. Removed tags (scripts, styles, nav, footer...) are not
+    descended into, and descendants of a captured area are not captured again
+    (the area's markup already contains them).
 
-    # Preserve important scripts (JSON-LD, Next.js data, etc.)
-    important_scripts = []
-    script_keywords = [
-        # Product data
-        'product', 'price', 'sku', 'stock', 'inventory',
-        # Portuguese
-        'preco', 'preço', 'produto', 'estoque',
-        # Spanish
-        'precio', 'producto', 'existencias',
-        # Platforms
-        'catalog', 'vtex', 'magento', 'shopify', 'woocommerce',
-        # Schema.org
-        'schema', '@type', 'offer', 'aggregaterating'
-    ]
+    Output is built from ranked sections (CLEAN_HTML_SECTIONS) that fill the
+    token budget in priority order, so JSON-LD/meta/microdata and the price and
+    title regions survive even when the page has a lot of other matches.
+    """
+    from lxml import etree
 
-    for script in soup.find_all('script'):
-        script_content = str(script.string or '')
-        script_type = script.get('type', '')
-        script_id = script.get('id', '')
-        should_keep = (
-            script_type in ['application/ld+json', 'application/json'] or
-            script_id in ['__NEXT_DATA__', '__NUXT_DATA__', 'schema-org'] or
-            any(kw in script_content.lower() for kw in script_keywords)
-        )
-        if should_keep:
-            important_scripts.append(str(script))
-
-    # Remove non-essential elements
-    for script in soup.find_all('script'):
-        script.decompose()
-    for tag in ['style', 'noscript', 'iframe', 'svg', 'link', 'footer', 'nav']:
-        for el in soup.find_all(tag):
-            el.decompose()
-    for comment in soup.find_all(string=lambda t: isinstance(t, Comment)):
-        comment.extract()
-
-    # Build combined regex for all selector patterns
-    all_patterns = '|'.join(SELECTOR_PATTERNS.values())
-    combined_regex = re.compile(all_patterns, re.I)
-
-    # Find all elements with matching class names
-    product_areas = []
-    for element in soup.find_all(attrs={'class': combined_regex}, limit=50):
-        product_areas.append(str(element))
-
-    # Also find by id attribute
-    for element in soup.find_all(attrs={'id': combined_regex}, limit=20):
-        product_areas.append(str(element))
-
-    # Also find by data-* attributes (common in React/Vue/Angular)
-    data_patterns = re.compile(r'data-(product|price|sku|stock|brand|seller|image)', re.I)
-    for element in soup.find_all(lambda tag: any(data_patterns.match(attr) for attr in tag.attrs.keys() if attr.startswith('data-')), limit=20):
-        product_areas.append(str(element))
-
-    # Get product images directly
-    product_images = []
-    image_skip_patterns = ['icon', 'logo', 'sprite', 'pixel', 'tracking', 'analytics', 'badge', 'flag', 'banner', 'ad-', 'advertisement']
-
-    for img in soup.find_all('img', limit=30):
-        src = img.get('src', '') or img.get('data-src', '') or img.get('data-lazy', '') or ''
-        srcset = img.get('srcset', '') or img.get('data-srcset', '') or ''
-
-        # Keep images that are likely product images
-        if (src or srcset) and len(src + srcset) > 20:
-            if not any(skip in (src + srcset).lower() for skip in image_skip_patterns):
-                product_images.append(str(img))
-
-    # Get meta tags (OpenGraph, Twitter Cards, Schema.org hints)
-    meta_keywords = [
-        'product', 'price', 'amount', 'currency',
-        'title', 'name', 'description',
-        'image', 'og:', 'twitter:',
-        'brand', 'manufacturer',
-        'availability', 'sku',
-        'review', 'rating'
-    ]
+    json_ld_scripts = []
+    important_scripts = []   # Other kept scripts (JSON, Next.js data, keyword matches)
     meta_tags = []
-    for m in soup.find_all('meta'):
-        meta_name = m.get('name', '').lower()
-        meta_property = m.get('property', '').lower()
-        meta_itemprop = m.get('itemprop', '').lower()
-        combined_attrs = meta_name + meta_property + meta_itemprop
-        if any(kw in combined_attrs for kw in meta_keywords):
-            meta_tags.append(str(m))
-
-    # Get elements with itemprop (Schema.org microdata)
-    schema_props = [
-        'name', 'description', 'image', 'brand', 'sku', 'gtin', 'mpn',
-        'price', 'priceCurrency', 'availability', 'seller',
-        'aggregateRating', 'ratingValue', 'reviewCount', 'offers'
-    ]
-    schema_elements = []
-    for prop in schema_props:
-        for el in soup.find_all(attrs={'itemprop': prop}, limit=5):
-            schema_elements.append(str(el))
+    schema_by_prop: dict = {prop: [] for prop in CLEAN_HTML_SCHEMA_PROPS}
+    image_elements = []
+    class_areas, id_areas, data_areas = [], [], []
+    removed = []
+
+    root = _parse_html_document(html_content)
+    stack = [(root, False)] if root is not None else []
+    images_seen = 0
+
+    # Single depth-first traversal in document order
+    while stack:
+        el, in_area = stack.pop()
+        tag = el.tag
+        if not isinstance(tag, str):
+            # Comments / processing instructions
+            removed.append(el)
+            continue
+        tag = tag.lower()
+
+        if tag in CLEAN_HTML_REMOVED_TAGS:
+            if tag == 'script':
+                script_type = el.get('type', '')
+                script_content = el.text or ''
+                if script_type == 'application/ld+json':
+                    json_ld_scripts.append(el)
+                elif (script_type in CLEAN_HTML_SCRIPT_TYPES or
+                      el.get('id', '') in CLEAN_HTML_SCRIPT_IDS or
+                      any(kw in script_content.lower() for kw in CLEAN_HTML_SCRIPT_KEYWORDS)):
+                    important_scripts.append(el)
+            removed.append(el)
+            continue
 
-    # Deduplicate while preserving order
+        if tag == 'meta':
+            combined_attrs = (el.get('name', '') + el.get('property', '') + el.get('itemprop', '')).lower()
+            if any(kw in combined_attrs for kw in CLEAN_HTML_META_KEYWORDS):
+                meta_tags.append(el)
+
+        if tag == 'img' and images_seen < 30:
+            images_seen += 1
+            src = el.get('src', '') or el.get('data-src', '') or el.get('data-lazy', '') or ''
+            srcset = el.get('srcset', '') or el.get('data-srcset', '') or ''
+            if (src or srcset) and len(src + srcset) > 20:
+                if not any(skip in (src + srcset).lower() for skip in CLEAN_HTML_IMAGE_SKIP):
+                    image_elements.append(el)
+
+        itemprop = el.get('itemprop')
+        if itemprop in schema_by_prop and len(schema_by_prop[itemprop]) < 5:
+            schema_by_prop[itemprop].append(el)
+
+        if not in_area:
+            class_attr = el.get('class')
+            id_attr = el.get('id')
+            if class_attr and len(class_areas) < 50 and SELECTOR_ENGINE.search(class_attr):
+                class_areas.append(el)
+                in_area = True
+            elif id_attr and len(id_areas) < 20 and SELECTOR_ENGINE.search(id_attr):
+                id_areas.append(el)
+                in_area = True
+            elif len(data_areas) < 20 and any(
+                attr.startswith('data-') and CLEAN_HTML_DATA_ATTR.match(attr) for attr in el.attrib
+            ):
+                data_areas.append(el)
+                in_area = True
+
+        stack.extend((child, in_area) for child in reversed(el))
+
+    def serialize(el) -> str:
+        return etree.tostring(el, encoding='unicode', method='html', with_tail=False)
+
+    # Serialize scripts before they are dropped from the tree
+    json_ld_scripts = [serialize(el) for el in json_ld_scripts]
+    important_scripts = [serialize(el) for el in important_scripts]
+    for el in removed:
+        if el.getparent() is not None:
+            el.drop_tree()
+
+    meta_tags = [serialize(el) for el in meta_tags]
+    schema_elements = [serialize(el) for prop in CLEAN_HTML_SCHEMA_PROPS for el in schema_by_prop[prop]]
+    product_images = [serialize(el) for el in image_elements]
+
+    # Deduplicate while preserving order; tag each area with its matched categories
     seen = set()
-    unique_areas = []
-    for area in product_areas[:30]:
+    unique_areas = []   # (html, categories)
+    category_counts: dict = {}
+    for el in (class_areas + id_areas + data_areas)[:30]:
+        area = serialize(el)
         area_hash = hash(area)
         if area_hash not in seen:
             seen.add(area_hash)
-            unique_areas.append(area)
-
-    # Combine all extracted content
-    combined = "\n".join(
-        meta_tags +
-        schema_elements +
-        product_images[:10] +
-        unique_areas +
-        important_scripts
-    )
+            categories = SELECTOR_ENGINE.categories(f"{el.get('class', '')} {el.get('id', '')}")
+            unique_areas.append((area, categories))
+            for category in categories:
+                category_counts[category] = category_counts.get(category, 0) + 1
+
+    def category_rank(categories: List[str]) -> int:
+        # data-* only matches have no class/id category: rank them last
+        return min((SELECTOR_ENGINE.category_order[c] for c in categories), default=len(SELECTOR_PATTERNS))
+
+    priority_areas = [area for area, cats in unique_areas if set(cats) & set(CLEAN_HTML_PRIORITY_PATTERNS)]
+    other_areas = [
+        area for area, cats in sorted(unique_areas, key=lambda a: category_rank(a[1]))
+        if not set(cats) & set(CLEAN_HTML_PRIORITY_PATTERNS)
+    ]
+
+    # Fill the token budget in priority order
+    sections = [
+        ("structured", json_ld_scripts + meta_tags + schema_elements),
+        ("price_title", priority_areas),
+        ("images", product_images[:10]),
+        ("areas", other_areas),   # Ranked by category (SELECTOR_PATTERNS order)
+        ("scripts", important_scripts),
+    ]
+    budget = token_budget or get_clean_html_token_budget()
+    kept, section_tokens, dropped_tokens = fill_token_budget(sections, budget)
+    combined = "\n".join(kept)
 
     stats = {
         "original_size": len(html_content),
@@ -689,34 +1044,931 @@ def clean_html(html_content: str) -> Tuple[str, dict]:
         "images_found": len(product_images),
         "meta_tags_found": len(meta_tags),
         "schema_elements_found": len(schema_elements),
+        "area_categories": category_counts,
+        "token_budget": budget,
+        "tokens": sum(section_tokens.values()),
+        "section_tokens": section_tokens,
+        "dropped_tokens": dropped_tokens,
     }
     return combined, stats
 
 
+# =============================================================================
+# Structured Data Extraction (JSON-LD / Microdata / Next.js / VTEX)
+# =============================================================================
+#
+# Most retail pages already carry the product as structured data. When it
+# yields the required fields we skip Gemini entirely (deterministic, ~free).
+# Sources, in priority order (earlier sources win, later ones fill gaps):
+#   1. Schema.org Product/Offer in application/ld+json (incl. @graph)
+#   2. VTEX state: legacy skuJson_0 / VTEX IO __STATE__ commertialOffer
+#   3. Schema.org Product objects embedded in __NEXT_DATA__
+#   4. Microdata itemprop (price, priceCurrency, name, brand, sku, gtin)
+#   5. OpenGraph / product: meta tags
+
+# Fields that must be present to skip Gemini (override via STRUCTURED_REQUIRED_FIELDS)
+STRUCTURED_REQUIRED_FIELDS = ("currentPrice", "productTitle")
+
+# ISO currency code -> symbol (Gemini returns symbols, keep output consistent)
+CURRENCY_SYMBOLS = {
+    "BRL": "R$", "USD": "$", "EUR": "€", "GBP": "£",
+    "ARS": "$", "MXN": "$", "CLP": "$", "COP": "$", "UYU": "$",
+}
+
+AVAILABILITY_IN_STOCK = ("instock", "instoreonly", "limitedavailability", "onlineonly", "preorder", "presale")
+AVAILABILITY_OUT_OF_STOCK = ("outofstock", "soldout", "discontinued")
+
+
+def parse_price(value) -> Optional[float]:
+    """
+    Parse a price from a number or visible text ("14.90", "1.299,90", "R$ 14,90").
+
+    "1.299" is read as pt-BR thousands; machine-readable values go through
+    parse_schema_price instead. Returns None for missing, non-numeric or
+    non-positive values.
+    """
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value) if value > 0 else None
+
+    text = re.sub(r'[^\d,.]', '', str(value))
+    if not text:
+        return None
+    if ',' in text and '.' in text:
+        # Last separator is the decimal one
+        if text.rfind(',') > text.rfind('.'):
+            text = text.replace('.', '').replace(',', '.')
+        else:
+            text = text.replace(',', '')
+    elif ',' in text:
+        head, _, tail = text.rpartition(',')
+        text = f"{head.replace(',', '')}.{tail}" if len(tail) in (1, 2) else text.replace(',', '')
+    elif text.count('.') > 1 or re.fullmatch(r'\d{1,3}\.\d{3}', text):
+        # "1.299.000" / "1.299" use '.' as thousands separator (pt-BR)
+        text = text.replace('.', '')
+    try:
+        price = float(text)
+    except ValueError:
+        return None
+    return price if price > 0 else None
+
+
+def parse_schema_price(value) -> Optional[float]:
+    """
+    Parse a machine-readable price (schema.org, microdata content, og:price:amount, VTEX state).
+
+    These always use '.' as the decimal separator, so "29.900" is 29.9, not
+    29900. Values that are not plain numbers (e.g. "R$ 1.299,90") fall back
+    to parse_price's locale heuristics.
+    """
+    if isinstance(value, str) and re.fullmatch(r'\s*\d+(\.\d+)?\s*', value):
+        price = float(value)
+        return price if price > 0 else None
+    return parse_price(value)
+
+
+def _parse_availability(value) -> Optional[bool]:
+    """Map schema.org availability (URL or text) to a boolean."""
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return value
+    normalized = re.sub(r'[^a-z]', '', str(value).lower())
+    if any(kw in normalized for kw in AVAILABILITY_OUT_OF_STOCK):
+        return False
+    if any(kw in normalized for kw in AVAILABILITY_IN_STOCK):
+        return True
+    return None
+
+
+def _first_text(value) -> Optional[str]:
+    """First usable string from a str / list / {name|url|contentUrl|@id} value."""
+    if isinstance(value, list):
+        value = value[0] if value else None
+    if isinstance(value, dict):
+        value = value.get("name") or value.get("url") or value.get("contentUrl") or value.get("@id")
+    if value is None:
+        return None
+    text = str(value).strip()
+    return text or None
+
+
+def _is_product(obj: dict) -> bool:
+    types = obj.get("@type")
+    types = types if isinstance(types, list) else [types]
+    return any(t in ("Product", "ProductGroup", "IndividualProduct") for t in types)
+
+
+def _iter_json_objects(data, depth: int = 0):
+    """Yield every dict inside a JSON value (bounded depth)."""
+    if depth > 12:
+        return
+    if isinstance(data, dict):
+        yield data
+        for value in data.values():
+            yield from _iter_json_objects(value, depth + 1)
+    elif isinstance(data, list):
+        for value in data:
+            yield from _iter_json_objects(value, depth + 1)
+
+
+def _product_from_schema(product: dict) -> dict:
+    """Map a schema.org Product object to ScrapeResult fields."""
+    offers = product.get("offers")
+    if isinstance(offers, list):
+        offers = next((o for o in offers if isinstance(o, dict) and parse_schema_price(o.get("price") or o.get("lowPrice"))), offers[0] if offers else None)
+    if isinstance(offers, dict) and offers.get("offers") and not offers.get("price") and not offers.get("lowPrice"):
+        nested = offers["offers"]
+        offers = nested[0] if isinstance(nested, list) and nested else nested
+    offers = offers if isinstance(offers, dict) else {}
+
+    price_spec = offers.get("priceSpecification")
+    if isinstance(price_spec, list):
+        price_spec = price_spec[0] if price_spec else None
+    price_spec = price_spec if isinstance(price_spec, dict) else {}
+
+    currency = offers.get("priceCurrency") or price_spec.get("priceCurrency")
+    rating = product.get("aggregateRating")
+
+    data = {
+        "productTitle": _first_text(product.get("name")),
+        "brand": _first_text(product.get("brand")),
+        "currentPrice": parse_schema_price(offers.get("price") or offers.get("lowPrice") or price_spec.get("price")),
+        "currency": CURRENCY_SYMBOLS.get(str(currency).upper(), currency) if currency else None,
+        "availability": _parse_availability(offers.get("availability")),
+        "product_image_url": _first_text(product.get("image")),
+        "seller": _first_text(offers.get("seller")),
+        "sku": _first_text(product.get("sku")),
+        "ean": _first_text(product.get("gtin13") or product.get("gtin") or product.get("gtin14") or product.get("gtin8")),
+        "review_score": str(rating["ratingValue"]) if isinstance(rating, dict) and rating.get("ratingValue") is not None else None,
+    }
+    return {k: v for k, v in data.items() if v is not None}
+
+
+def _extract_vtex(html_content: str) -> dict:
+    """Extract product data from VTEX page state (legacy skuJson or VTEX IO __STATE__)."""
+    match = re.search(r'var\s+skuJson_0\s*=\s*(\{.*?\});', html_content, re.S)
+    if match:
+        try:
+            sku_json = json.loads(match.group(1))
+            skus = sku_json.get("skus") or []
+            sku = next((s for s in skus if s.get("available")), skus[0] if skus else {})
+            best = sku.get("bestPrice")
+            listed = sku.get("listPrice")
+            data = {
+                "productTitle": sku_json.get("name"),
+                "currentPrice": best / 100 if isinstance(best, (int, float)) and best > 0 else None,
+                "originalPrice": listed / 100 if isinstance(listed, (int, float)) and listed > 0 else None,
+                "availability": sku.get("available"),
+                "product_image_url": sku.get("image"),
+                "seller": sku.get("sellerName") or sku.get("seller"),
+                "sku": str(sku["sku"]) if sku.get("sku") is not None else None,
+            }
+            return {k: v for k, v in data.items() if v is not None}
+        except (ValueError, TypeError, AttributeError):
+            pass
+
+    match = re.search(r'<template[^>]*data-varname=["\']__STATE__["\'][^>]*>\s*<script>(.*?)</script>', html_content, re.S)
+    if match:
+        try:
+            state = json.loads(match.group(1))
+        except ValueError:
+            return {}
+        data = {}
+        for key, value in state.items():
+            if not isinstance(value, dict):
+                continue
+            if key.startswith("Product:") and "productName" in value and "productTitle" not in data:
+                data["productTitle"] = value.get("productName")
+                if value.get("brand"):
+                    data["brand"] = value["brand"]
+            if "commertialOffer" in key and "currentPrice" not in data:
+                price = parse_schema_price(value.get("Price"))
+                if price:
+                    data["currentPrice"] = price
+                    list_price = parse_schema_price(value.get("ListPrice"))
+                    if list_price and list_price > price:
+                        data["originalPrice"] = list_price
+                    if value.get("AvailableQuantity") is not None:
+                        data["availability"] = value["AvailableQuantity"] > 0
+        return {k: v for k, v in data.items() if v is not None}
+
+    return {}
+
+
+def extract_structured_data(html_content: str, root=None) -> Tuple[dict, dict]:
+    """
+    Extract product fields from structured data embedded in the page.
+
+    root is the page parsed with _parse_html_document (parsed here if not
+    given). The tree is only read, so it can be shared with apply_template.
+
+    Returns (data, stats) where stats["sources"] lists the sources that
+    contributed fields. Earlier sources win; later ones only fill gaps.
+    """
+    if root is None:
+        root = _parse_html_document(html_content)
+    if root is None:
+        return {}, {"sources": [], "fields": 0}
+
+    def first(xpath: str, **variables):
+        matches = root.xpath(xpath, **variables)
+        return matches[0] if matches else None
+
+    data: dict = {}
+    sources: List[str] = []
+
+    def merge(source: str, found: dict):
+        added = False
+        for key, value in found.items():
+            if value is not None and data.get(key) is None:
+                data[key] = value
+                added = True
+        if added:
+            sources.append(source)
+
+    # 1. JSON-LD
+    for script in root.xpath('//script[@type="application/ld+json"]'):
+        try:
+            payload = json.loads(script.text or '')
+        except (ValueError, TypeError):
+            continue
+        for obj in _iter_json_objects(payload):
+            if _is_product(obj):
+                merge("json_ld", _product_from_schema(obj))
+
+    # 2. VTEX state
+    merge("vtex", _extract_vtex(html_content))
+
+    # 3. __NEXT_DATA__ (embedded schema.org Product objects)
+    next_data = first('//script[@id="__NEXT_DATA__"]')
+    if next_data is not None and next_data.text:
+        try:
+            for obj in _iter_json_objects(json.loads(next_data.text)):
+                if _is_product(obj):
+                    merge("next_data", _product_from_schema(obj))
+        except (ValueError, TypeError):
+            pass
+
+    # 4. Microdata
+    def itemprop(name: str) -> Optional[str]:
+        el = first('//*[@itemprop=$name]', name=name)
+        if el is None:
+            return None
+        value = el.get('content') or el.get('href') or " ".join(t.strip() for t in el.itertext() if t.strip())
+        return value or None
+
+    price_el = first('//*[@itemprop="price"]')
+    if price_el is not None:
+        currency = itemprop('priceCurrency')
+        merge("microdata", {
+            # content="..." is machine-readable; visible text keeps the locale heuristics
+            "currentPrice": (parse_schema_price(price_el.get('content')) if price_el.get('content')
+                             else parse_price(itemprop('price'))),
+            "currency": CURRENCY_SYMBOLS.get(currency.upper(), currency) if currency else None,
+            "productTitle": itemprop('name'),
+            "brand": itemprop('brand'),
+            "sku": itemprop('sku'),
+            "ean": itemprop('gtin13') or itemprop('gtin'),
+            "availability": _parse_availability(itemprop('availability')),
+        })
+
+    # 5. Meta tags
+    def meta(*names: str) -> Optional[str]:
+        for name in names:
+            el = first('//meta[@property=$name]', name=name)
+            if el is None:
+                el = first('//meta[@name=$name]', name=name)
+            if el is not None and el.get('content'):
+                return el.get('content').strip()
+        return None
+
+    currency = meta('product:price:currency', 'og:price:currency')
+    merge("meta", {
+        "currentPrice": parse_schema_price(meta('product:price:amount', 'og:price:amount')),
+        "currency": CURRENCY_SYMBOLS.get(currency.upper(), currency) if currency else None,
+        "productTitle": meta('og:title', 'twitter:title'),
+        "brand": meta('product:brand'),
+        "availability": _parse_availability(meta('product:availability', 'og:availability')),
+        "product_image_url": meta('og:image', 'twitter:image'),
+    })
+
+    # Derived fields
+    current, original = data.get("currentPrice"), data.get("originalPrice")
+    if current and original and original > current and data.get("discountPercentage") is None:
+        data["discountPercentage"] = round((1 - current / original) * 100, 1)
+    if data.get("availability") is False and not data.get("outOfStockReason"):
+        data["outOfStockReason"] = "Out of stock (structured data)"
+
+    return data, {"sources": sources, "fields": len(data)}
+
+
+def get_structured_required_fields() -> Tuple[str, ...]:
+    """Required fields for the structured fast path (STRUCTURED_REQUIRED_FIELDS, comma-separated)."""
+    value = os.environ.get("STRUCTURED_REQUIRED_FIELDS", "").strip()
+    if not value:
+        return STRUCTURED_REQUIRED_FIELDS
+    return tuple(f.strip() for f in value.split(",") if f.strip())
+
+
+def is_structured_fast_path_enabled() -> bool:
+    """Structured data fast path toggle (STRUCTURED_FAST_PATH, default: true)."""
+    return os.environ.get("STRUCTURED_FAST_PATH", "true").lower() in ("true", "1", "yes")
+
+
+# =============================================================================
+# Domain Templates (learned XPath extraction per domain)
+# =============================================================================
+#
+# Product pages of one retailer share a layout. After Gemini extracts a page,
+# each extracted value is located in the DOM and turned into an XPath that
+# finds it again; the per-domain template is stored in a shared modal.Dict
+# and applied deterministically to later pages of that domain. Gemini is
+# only called when the template yields no price or fails a sanity check,
+# plus a small sample of template hits that are re-checked with Gemini
+# (TEMPLATE_VERIFY_RATE) so layout changes are noticed and re-learned.
+
+TEMPLATE_FIELDS = ("productTitle", "currentPrice", "originalPrice", "brand")  # Title first: it anchors the rest
+TEMPLATE_PRICE_FIELDS = ("currentPrice", "originalPrice")
+TEMPLATE_DOMAIN_CONSTANTS = ("currency", "marketplaceWebsite")  # Same on every page of a domain
+TEMPLATE_MAX_ANCESTORS = 3         # Ancestor steps tried to make an XPath unambiguous
+TEMPLATE_MAX_CANDIDATES = 10       # DOM nodes tried per value when learning
+TEMPLATE_MAX_TEXT = {"currentPrice": 40, "originalPrice": 40, "productTitle": 300, "brand": 80}
+TEMPLATE_MAX_PRICE = 1_000_000.0   # Sanity: anything above is a parse error
+TEMPLATE_MAX_DISCOUNT = 0.9        # Sanity: originalPrice at most 10x currentPrice
+TEMPLATE_REQUIRED_FIELDS = ("currentPrice", "productTitle", "availability")  # Else Gemini runs
+TEMPLATE_LEARN_WINDOW = 600.0      # Seconds over which learning attempts per domain are counted
+TEMPLATE_MAX_LEARN_ATTEMPTS = 3    # Learning attempts per domain per window (per container)
+
+
+def _normalize_text(text: str) -> str:
+    return re.sub(r'\s+', ' ', text or '').strip()
+
+
+def _visible_length(text: Optional[str]) -> int:
+    """Number of non-whitespace characters."""
+    return len("".join(text.split())) if text else 0
+
+
+def _xpath_literal(value: str) -> Optional[str]:
+    if "'" not in value:
+        return f"'{value}'"
+    if '"' not in value:
+        return f'"{value}"'
+    return None
+
+
+def _node_step(el) -> str:
+    """XPath step for an element using its id or stable classes (no generated names)."""
+    tag = el.tag if isinstance(el.tag, str) else '*'
+    el_id = el.get('id') or ''
+    if el_id and not re.search(r'\d{3,}', el_id) and _xpath_literal(el_id):
+        return f"{tag}[@id={_xpath_literal(el_id)}]"
+    classes = [
+        c for c in (el.get('class') or '').split()
+        if re.fullmatch(r'[A-Za-z][\w-]*', c) and not re.search(r'\d{3,}', c)
+        and not re.match(r'(css|sc|jsx|emotion)-', c)
+    ][:2]
+    predicates = "".join(f"[contains(concat(' ', normalize-space(@class), ' '), ' {c} ')]" for c in classes)
+    return f"{tag}{predicates}"
+
+
+def _template_value(field_name: str, text: str):
+    """Parse a template match into the field's type (None if unusable)."""
+    text = _normalize_text(text)
+    if not text or len(text) > TEMPLATE_MAX_TEXT[field_name]:
+        return None
+    if field_name in TEMPLATE_PRICE_FIELDS:
+        return parse_price(text)
+    return text
+
+
+def _values_match(field_name: str, found, expected) -> bool:
+    if found is None or expected is None:
+        return False
+    if field_name in TEMPLATE_PRICE_FIELDS:
+        try:
+            return abs(float(found) - float(expected)) < 0.011
+        except (TypeError, ValueError):
+            return False
+    return str(found).casefold() == _normalize_text(str(expected)).casefold()
+
+
+def learn_template(html_content: str, data: dict) -> dict:
+    """
+    Build {field: xpath} for the extracted values that can be found in the page.
+
+    An XPath is kept only if its first match on this page gives back the
+    extracted value, so a template never encodes a guess.
+    """
+    root = _parse_html_document(html_content)
+    if root is None:
+        return {}
+    for el in root.iter('script', 'style', 'noscript', 'svg'):
+        el.text = None
+
+    # Non-whitespace length of every element's text content, children first
+    # (one pass; the normalized text is never shorter than this)
+    text_lengths = {}
+    for el in reversed(list(root.iter())):
+        length = _visible_length(el.text) if isinstance(el.tag, str) else 0
+        for child in el:
+            length += text_lengths[child] + _visible_length(child.tail)
+        text_lengths[el] = length
+
+    def node_depth(el) -> int:
+        return sum(1 for _ in el.iterancestors())
+
+    def shared_depth(a, b) -> int:
+        # Depth of the closest common ancestor (deeper = same product block)
+        ancestors_b = set(b.iterancestors()) | {b}
+        for ancestor in [a, *a.iterancestors()]:
+            if ancestor in ancestors_b:
+                return node_depth(ancestor)
+        return 0
+
+    template = {}
+    anchor = None   # Element of the learned title: values near it are preferred
+    for field_name in TEMPLATE_FIELDS:
+        expected = data.get(field_name)
+        if expected in (None, ""):
+            continue
+
+        # Deepest elements whose own text content is exactly the value. The
+        # length check runs first: text_content() is only built for elements
+        # whose text could be the value, and a price is only parsed when the
+        # text holds its integer digits.
+        is_price = field_name in TEMPLATE_PRICE_FIELDS
+        expected_length = _visible_length(str(expected))
+        try:
+            price_digits = str(int(float(expected))) if is_price else ""
+        except (TypeError, ValueError):
+            continue
+        candidates = []
+        for el in root.iter():
+            if not isinstance(el.tag, str) or el.tag in ('html', 'body', 'head', 'title', 'meta'):
+                continue
+            length = text_lengths[el]
+            if not length or length > TEMPLATE_MAX_TEXT[field_name] or (not is_price and length != expected_length):
+                continue
+            text = el.text_content()
+            if is_price and price_digits not in re.sub(r'\D', '', text):
+                continue
+            if _values_match(field_name, _template_value(field_name, text), expected):
+                if candidates and candidates[-1] in el.iterancestors():
+                    candidates[-1] = el
+                else:
+                    candidates.append(el)
+                if len(candidates) >= TEMPLATE_MAX_CANDIDATES:
+                    break
+
+        options = []   # (score, xpath, element)
+        for index, el in enumerate(candidates):
+            steps = [_node_step(el)]
+            ancestors = list(el.iterancestors())
+            for depth in range(TEMPLATE_MAX_ANCESTORS + 1):
+                xpath = "//" + "//".join(steps)
+                try:
+                    matches = root.xpath(xpath)
+                except Exception:
+                    break
+                # Bare tag paths ("//b") are too fragile across pages: need an id/class anchor
+                anchored = "[" in xpath
+                if anchored and matches and _values_match(field_name, _template_value(field_name, matches[0].text_content()), expected):
+                    # Prefer: unique match, close to the title, earlier in the page
+                    score = (len(matches) == 1, shared_depth(el, anchor) if anchor is not None else 0, -index)
+                    options.append((score, xpath, el))
+                    break
+                if depth >= len(ancestors) or ancestors[depth].tag in ('html', 'body'):
+                    break
+                steps.insert(0, _node_step(ancestors[depth]))
+        if options:
+            _, xpath, el = max(options, key=lambda o: o[0])
+            template[field_name] = xpath
+            if field_name == "productTitle":
+                anchor = el
+    return template
+
+
+def apply_template(html_content: str, template: dict, root=None) -> dict:
+    """Apply {field: xpath} to a page (or its parsed root). Returns the fields that produced a value."""
+    if root is None:
+        root = _parse_html_document(html_content)
+    if root is None:
+        return {}
+    data = {}
+    for field_name, xpath in template.items():
+        if field_name not in TEMPLATE_FIELDS:
+            continue
+        try:
+            matches = root.xpath(xpath)
+        except Exception:
+            continue
+        if matches and hasattr(matches[0], 'text_content'):
+            value = _template_value(field_name, matches[0].text_content())
+            if value is not None:
+                data[field_name] = value
+    return data
+
+
+def extract_page_fields(html_content: str, template: Optional[dict] = None,
+                        structured: bool = True) -> Tuple[dict, dict, Optional[dict]]:
+    """
+    Parse the page once and run structured data extraction and the domain
+    template on the same tree (one CPU pool task, lxml trees don't pickle).
+
+    Returns (structured_data, structured_stats, template_data); template_data
+    is None when no template was given.
+    """
+    root = _parse_html_document(html_content)
+    data, stats = extract_structured_data(html_content, root) if structured else ({}, {"sources": []})
+    template_data = apply_template(html_content, template, root) if template else None
+    return data, stats, template_data
+
+
+def check_template_result(data: dict, structured: dict) -> Optional[str]:
+    """Sanity checks for a template extraction. Returns the failure reason, or None."""
+    price = data.get("currentPrice")
+    if not price:
+        return "no price"
+    if price > TEMPLATE_MAX_PRICE:
+        return f"implausible price {price}"
+    original = data.get("originalPrice")
+    if original is not None and (original < price or price < original * (1 - TEMPLATE_MAX_DISCOUNT)):
+        return f"implausible original price {original} for {price}"
+    structured_price = structured.get("currentPrice")
+    if structured_price and abs(structured_price - price) > max(0.011, structured_price * 0.01):
+        return f"price {price} disagrees with structured data {structured_price}"
+    return None
+
+
+def get_template_config() -> dict:
+    """Domain template settings (TEMPLATES_ENABLED, TEMPLATE_VERIFY_RATE, TEMPLATE_REQUIRED_FIELDS)."""
+    try:
+        verify_rate = float(os.environ.get("TEMPLATE_VERIFY_RATE", DEFAULT_TEMPLATE_VERIFY_RATE))
+    except ValueError:
+        verify_rate = DEFAULT_TEMPLATE_VERIFY_RATE
+    required = os.environ.get("TEMPLATE_REQUIRED_FIELDS", "").strip()
+    return {
+        "enabled": os.environ.get("TEMPLATES_ENABLED", "true").lower() in ("true", "1", "yes"),
+        "verify_rate": min(1.0, max(0.0, verify_rate)),
+        "required_fields": tuple(f.strip() for f in required.split(",") if f.strip()) if required else TEMPLATE_REQUIRED_FIELDS,
+    }
+
+
+class DomainTemplates:
+    """
+    Per-domain extraction templates backed by a shared modal.Dict.
+
+    Reads are cached per container for TEMPLATE_CACHE_TTL seconds (same as the
+    domain router). Any scrape_url container may (re)learn a template, at most
+    TEMPLATE_MAX_LEARN_ATTEMPTS times per domain per TEMPLATE_LEARN_WINDOW, so
+    a domain whose template keeps failing doesn't cost a parse and a Dict
+    write on every page.
+    """
+
+    def __init__(self, store=None):
+        self._store = store
+        self._cache: dict = {}  # domain -> (fetched_at, template entry)
+        self._learn_attempts: dict = {}  # domain -> (window_start, attempts)
+
+    def _get_store(self):
+        if self._store is None:
+            self._store = modal.Dict.from_name(DOMAIN_TEMPLATES_DICT, create_if_missing=True)
+        return self._store
+
+    async def get(self, domain: str) -> Optional[dict]:
+        """Template entry for a domain ({"fields": {...}, ...}) or None."""
+        cached = self._cache.get(domain)
+        if cached and time.time() - cached[0] < TEMPLATE_CACHE_TTL:
+            return cached[1]
+        try:
+            entry = await self._get_store().get.aio(domain)
+        except Exception as e:
+            print(f"[DomainTemplates] Read error for {domain}: {str(e)[:100]}")
+            entry = None
+        self._cache[domain] = (time.time(), entry)
+        return entry
+
+    async def learn(self, domain: str, html_content: str, data: dict, url_id: str) -> Optional[dict]:
+        """Learn a template from a Gemini extraction and store it (needs at least the price)."""
+        now = time.time()
+        window_start, attempts = self._learn_attempts.get(domain, (now, 0))
+        if now - window_start >= TEMPLATE_LEARN_WINDOW:
+            window_start, attempts = now, 0
+        if attempts >= TEMPLATE_MAX_LEARN_ATTEMPTS:
+            return None
+        self._learn_attempts[domain] = (window_start, attempts + 1)
+
+        try:
+            fields_found = await run_cpu_bound(learn_template, html_content, data)
+        except Exception as e:
+            print(f"[{url_id}] Template learning error: {str(e)[:100]}")
+            return None
+        if "currentPrice" not in fields_found:
+            return None
+        constants = {k: data[k] for k in TEMPLATE_DOMAIN_CONSTANTS if data.get(k) not in (None, "")}
+        cached = self._cache.get(domain)
+        if cached and cached[1] and cached[1].get("fields") == fields_found and cached[1].get("constants") == constants:
+            return cached[1]  # Same template as stored: no write
+        entry = {"fields": fields_found, "constants": constants, "learnedAt": int(time.time() * 1000)}
+        self._cache[domain] = (time.time(), entry)
+        try:
+            await self._get_store().put.aio(domain, entry)
+        except Exception as e:
+            print(f"[DomainTemplates] Write error for {domain}: {str(e)[:100]}")
+        print(f"[{url_id}] Template learned for {domain}: {', '.join(fields_found)}")
+        return entry
+
+    async def forget(self, domain: str):
+        """Drop a domain's template (it disagreed with Gemini)."""
+        self._cache[domain] = (time.time(), None)
+        try:
+            await self._get_store().pop.aio(domain, None)
+        except Exception as e:
+            print(f"[DomainTemplates] Delete error for {domain}: {str(e)[:100]}")
+
+
+# Global domain templates - created once per container
+_domain_templates: Optional[DomainTemplates] = None
+
+
+def get_domain_templates() -> DomainTemplates:
+    """Get or create the container's domain templates."""
+    global _domain_templates
+    if _domain_templates is None:
+        _domain_templates = DomainTemplates()
+    return _domain_templates
+
+
 # =============================================================================
 # Image Compression
 # =============================================================================
 
-def compress_image(image_bytes: bytes, quality: int = 85) -> Tuple[bytes, dict]:
-    """Compress PNG image to optimized WebP."""
+# Compression profiles for full-page screenshots (SCREENSHOT_PROFILE selects one).
+# method: WebP encoder effort (0 fastest - 6 slowest). max_height crops the page
+# (the top holds the product; nobody reads the footer), max_width downscales.
+# If the output exceeds size_budget, quality steps down by quality_step until
+# min_quality.
+SCREENSHOT_PROFILES = {
+    "fast": {
+        "method": 2, "quality": 80, "min_quality": 50, "quality_step": 10,
+        "max_width": 1280, "max_height": 6000, "size_budget": 300_000,
+    },
+    "balanced": {
+        "method": 4, "quality": 82, "min_quality": 60, "quality_step": 10,
+        "max_width": 1920, "max_height": 10000, "size_budget": 600_000,
+    },
+    "archival": {
+        "method": 6, "quality": 85, "min_quality": 85, "quality_step": 0,
+        "max_width": None, "max_height": None, "size_budget": None,
+    },
+}
+DEFAULT_SCREENSHOT_PROFILE = "balanced"
+WEBP_MAX_DIMENSION = 16383  # WebP format limit (taller pages are always cropped)
+
+# Derivatives encoded from the same decoded image as the full screenshot:
+# "viewport" is the first screen of the page (16:9 of the page width) and
+# "thumb" is that crop scaled down for list views.
+SCREENSHOT_DERIVATIVES = {
+    "viewport": {"width": 1280, "quality": 80},
+    "thumb": {"width": 320, "quality": 70},
+}
+SCREENSHOT_VIEWPORT_ASPECT = 9 / 16  # Viewport height / page width
+SCREENSHOT_URL_FIELDS = {"full": "screenshotUrl", "viewport": "screenshotViewportUrl", "thumb": "screenshotThumbUrl"}
+
+
+def get_screenshot_profile() -> str:
+    """Compression profile (SCREENSHOT_PROFILE: fast / balanced / archival, default: balanced)."""
+    profile = os.environ.get("SCREENSHOT_PROFILE", DEFAULT_SCREENSHOT_PROFILE).lower().strip()
+    return profile if profile in SCREENSHOT_PROFILES else DEFAULT_SCREENSHOT_PROFILE
+
+
+def is_screenshot_derivatives_enabled() -> bool:
+    """Encode viewport + thumbnail derivatives (SCREENSHOT_DERIVATIVES_ENABLED, default: true)."""
+    return os.environ.get("SCREENSHOT_DERIVATIVES_ENABLED", "true").lower() in ("true", "1", "yes")
+
+
+def compress_image(image_bytes: bytes, profile: str = DEFAULT_SCREENSHOT_PROFILE,
+                   derivatives: bool = False,
+                   dedupe: Optional[Tuple[Optional[str], float]] = None) -> Tuple[Optional[bytes], dict, dict]:
+    """
+    Compress a PNG screenshot to WebP using a compression profile.
+
+    Tall pages are cropped to the profile's max_height, wide ones downscaled
+    to max_width, and quality is lowered until the output fits size_budget.
+    With derivatives=True the viewport and thumb images (SCREENSHOT_DERIVATIVES)
+    are encoded from the same decoded image.
+
+    With dedupe=(previous dhash, max distance) the dHash of the decoded image
+    is returned in stats["dhash"], and if it is within max distance of the
+    previous one nothing is encoded: compressed is None and
+    stats["dhash_distance"] holds the distance.
+
+    Returns (compressed, {variant: bytes}, stats).
+    """
     from PIL import Image
 
+    started = time.time()
+    settings = SCREENSHOT_PROFILES.get(profile) or SCREENSHOT_PROFILES[DEFAULT_SCREENSHOT_PROFILE]
     original_size = len(image_bytes)
     img = Image.open(BytesIO(image_bytes))
+    original_dims = img.size
+
+    dhash = None
+    if dedupe is not None:
+        dhash = image_dhash(img, profile)
+        previous_dhash, max_distance = dedupe
+        distance = dhash_distance(previous_dhash, dhash) if previous_dhash else None
+        if distance is not None and distance <= max_distance:
+            return None, {}, {"dhash": dhash, "dhash_distance": distance}
+
     # WebP supports RGBA, no need to convert unless we want to reduce size further
     if img.mode == 'P':
         img = img.convert('RGBA')
 
-    output = BytesIO()
-    img.save(output, format='WEBP', quality=quality, method=6)  # method=6 = best compression
-    compressed = output.getvalue()
+    max_width = settings["max_width"]
+    if max_width and img.width > max_width:
+        img = img.resize((max_width, max(1, round(img.height * max_width / img.width))), Image.LANCZOS)
+
+    max_height = min(settings["max_height"] or WEBP_MAX_DIMENSION, WEBP_MAX_DIMENSION)
+    cropped = img.height > max_height
+    if cropped:
+        img = img.crop((0, 0, img.width, max_height))
+
+    def encode(image, q: int, method: int) -> BytesIO:
+        output = BytesIO()
+        image.save(output, format='WEBP', quality=q, method=method)
+        return output
+
+    quality = settings["quality"]
+    budget = settings["size_budget"]
+    compressed = encode(img, quality, settings["method"]).getvalue()
+    encodes = 1
+
+    # Over budget: choose the quality with trial encodes of a 1/4-scale copy
+    # at method=0 (~30x cheaper), scaled by the size ratio observed at the
+    # starting quality, then do a single final encode at that quality
+    if budget and len(compressed) > budget and settings["quality_step"]:
+        sample = img.resize((max(1, img.width // 4), max(1, img.height // 4)))
+        ratio = len(compressed) / max(1, encode(sample, quality, 0).tell())
+        while quality - settings["quality_step"] >= settings["min_quality"]:
+            quality -= settings["quality_step"]
+            if encode(sample, quality, 0).tell() * ratio <= budget:
+                break
+        compressed = encode(img, quality, settings["method"]).getvalue()
+        encodes += 1
+
+    derived = {}
+    if derivatives:
+        viewport = img.crop((0, 0, img.width, min(img.height, max(1, round(img.width * SCREENSHOT_VIEWPORT_ASPECT)))))
+        for variant, spec in SCREENSHOT_DERIVATIVES.items():
+            image = viewport
+            if image.width > spec["width"]:
+                image = image.resize((spec["width"], max(1, round(image.height * spec["width"] / image.width))), Image.LANCZOS)
+            derived[variant] = encode(image, spec["quality"], settings["method"]).getvalue()
+            encodes += 1
 
     stats = {
         'original_size': original_size,
         'compressed_size': len(compressed),
         'reduction_percent': round((1 - len(compressed) / original_size) * 100, 1) if original_size else 0,
+        'profile': profile if profile in SCREENSHOT_PROFILES else DEFAULT_SCREENSHOT_PROFILE,
+        'quality': quality,
+        'method': settings["method"],
+        'encodes': encodes,
+        'original_dims': f"{original_dims[0]}x{original_dims[1]}",
+        'output_dims': f"{img.width}x{img.height}",
+        'cropped': cropped,
+        'derivative_sizes': {variant: len(data) for variant, data in derived.items()},
+        'encode_ms': int((time.time() - started) * 1000),
+        'dhash': dhash,
     }
-    return compressed, stats
+    return compressed, derived, stats
+
+
+# =============================================================================
+# Screenshot Dedupe (perceptual hash per urlId)
+# =============================================================================
+#
+# Daily crons re-screenshot pages that usually look the same. A difference
+# hash (dHash) of the stored region is kept per urlId; when the new capture
+# is within SCREENSHOT_DEDUPE_MAX_DISTANCE of it and the extracted price and
+# availability are unchanged, the previous screenshotUrl is reused and the
+# encode + upload are skipped. The price guard matters: a dHash is blind to a
+# few changed digits, and the screenshot is the evidence for the price.
+
+SCREENSHOT_HASHES_DICT = "scraper-screenshot-hashes"  # modal.Dict: urlId -> last stored screenshot
+DHASH_WIDTH = 16                     # Gradient columns per row
+DHASH_ROW_PIXELS = 64                # One hash row per N source pixels of height
+DHASH_MIN_ROWS, DHASH_MAX_ROWS = 16, 256
+DEFAULT_SCREENSHOT_DEDUPE_MAX_DISTANCE = 0.02  # Max fraction of differing bits
+
+
+def image_dhash(img, profile: str = DEFAULT_SCREENSHOT_PROFILE) -> str:
+    """
+    Difference hash of a decoded screenshot, over the region compress_image keeps.
+
+    Called by compress_image on the image it already decoded. Rows scale
+    with the page height (one per DHASH_ROW_PIXELS), so long pages get
+    proportionally more bits. Returns "<rows>:<hex bits>".
+    """
+    from PIL import Image
+
+    settings = SCREENSHOT_PROFILES.get(profile) or SCREENSHOT_PROFILES[DEFAULT_SCREENSHOT_PROFILE]
+    max_height = min(settings["max_height"] or WEBP_MAX_DIMENSION, WEBP_MAX_DIMENSION)
+    if img.height > max_height:
+        img = img.crop((0, 0, img.width, max_height))
+
+    rows = min(DHASH_MAX_ROWS, max(DHASH_MIN_ROWS, img.height // DHASH_ROW_PIXELS))
+    pixels = list(img.convert('L').resize((DHASH_WIDTH + 1, rows), Image.BILINEAR).getdata())
+    bits = 0
+    for row in range(rows):
+        offset = row * (DHASH_WIDTH + 1)
+        for col in range(DHASH_WIDTH):
+            bits = (bits << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return f"{rows}:{bits:0{rows * DHASH_WIDTH // 4}x}"
+
+
+def dhash_distance(a: str, b: str) -> Optional[float]:
+    """Fraction of differing bits, or None if the hashes are not comparable."""
+    try:
+        rows_a, bits_a = a.split(":")
+        rows_b, bits_b = b.split(":")
+        if rows_a != rows_b:
+            return None
+        return bin(int(bits_a, 16) ^ int(bits_b, 16)).count("1") / (int(rows_a) * DHASH_WIDTH)
+    except (AttributeError, ValueError):
+        return None
+
+
+def get_screenshot_dedupe_max_distance() -> Optional[float]:
+    """Max dHash distance for reuse (SCREENSHOT_DEDUPE_MAX_DISTANCE), None if SCREENSHOT_DEDUPE_ENABLED=false."""
+    if os.environ.get("SCREENSHOT_DEDUPE_ENABLED", "true").lower() not in ("true", "1", "yes"):
+        return None
+    try:
+        return float(os.environ.get("SCREENSHOT_DEDUPE_MAX_DISTANCE", DEFAULT_SCREENSHOT_DEDUPE_MAX_DISTANCE))
+    except ValueError:
+        return DEFAULT_SCREENSHOT_DEDUPE_MAX_DISTANCE
+
+
+class ScreenshotIndex:
+    """Last stored screenshot per urlId (hash, URL, price, availability) in a shared modal.Dict."""
+
+    def __init__(self, store=None):
+        self._store = store
+
+    def _get_store(self):
+        if self._store is None:
+            self._store = modal.Dict.from_name(SCREENSHOT_HASHES_DICT, create_if_missing=True)
+        return self._store
+
+    async def get(self, url_id: str) -> Optional[dict]:
+        try:
+            return await self._get_store().get.aio(url_id)
+        except Exception as e:
+            print(f"[ScreenshotIndex] Read error for {url_id}: {str(e)[:100]}")
+            return None
+
+    async def put(self, url_id: str, dhash: Optional[str], screenshots: dict, product_data: dict):
+        """Store the uploaded screenshot URLs ({result field: url}) with the product state."""
+        entry = {
+            "dhash": dhash,
+            **screenshots,
+            "currentPrice": product_data.get("currentPrice"),
+            "availability": product_data.get("availability"),
+            "updatedAt": int(time.time() * 1000),
+        }
+        try:
+            await self._get_store().put.aio(url_id, entry)
+        except Exception as e:
+            print(f"[ScreenshotIndex] Write error for {url_id}: {str(e)[:100]}")
+
+    @staticmethod
+    def screenshot_urls(entry: dict) -> dict:
+        """Stored screenshot URLs as {result field: url} (older entries only have screenshotUrl)."""
+        return {f: entry[f] for f in SCREENSHOT_URL_FIELDS.values() if entry.get(f)}
+
+    @staticmethod
+    def same_product_state(entry: dict, product_data: Optional[dict]) -> bool:
+        """Price and availability unchanged since the stored screenshot."""
+        if not product_data or not product_data.get("currentPrice"):
+            return False
+        return (entry.get("currentPrice") == product_data.get("currentPrice")
+                and entry.get("availability") == product_data.get("availability"))
+
+
+# Global screenshot index - created once per container
+_screenshot_index: Optional[ScreenshotIndex] = None
+
+
+def get_screenshot_index() -> ScreenshotIndex:
+    """Get or create the container's screenshot index."""
+    global _screenshot_index
+    if _screenshot_index is None:
+        _screenshot_index = ScreenshotIndex()
+    return _screenshot_index
 
 
 # =============================================================================
@@ -754,57 +2006,836 @@ def get_r2_client():
     return _r2_client, None
 
 
-async def upload_to_r2_async(image_bytes: bytes, url_id: str) -> Tuple[Optional[str], Optional[str]]:
-    """Upload image to R2 (run in thread pool for async compatibility)."""
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(None, upload_to_r2_sync, image_bytes, url_id)
+class R2Error(Exception):
+    """R2 request failed (after retries)."""
 
 
-def upload_to_r2_sync(image_bytes: bytes, url_id: str) -> Tuple[Optional[str], Optional[str]]:
-    """Synchronous R2 upload."""
-    bucket_name = os.environ.get("R2_BUCKET_NAME", "screenshots")
-    public_url = os.environ.get("R2_PUBLIC_URL")
+class AsyncR2Client:
+    """
+    Native async S3-compatible client for R2.
+
+    Requests are signed with botocore's SigV4 signer and sent through the
+    pooled httpx client (HTTP_CLIENT_R2), so uploads never occupy executor
+    threads. A semaphore caps requests in flight per container, transient
+    failures (network, 429, 5xx) are retried with backoff, and objects above
+    R2_MULTIPART_THRESHOLD are sent as parallel multipart uploads.
+    put_if_absent skips content-addressed keys that already exist (conditional
+    PUT with If-None-Match: *, plus a per-container LRU of keys seen so
+    repeats cost no request).
+
+    Every request records latency into a histogram (R2_LATENCY_BUCKETS_MS),
+    both container-wide (get_stats) and in the per-URL metrics
+    (r2_{op}_le_{bucket}), so process_batch can print a job histogram.
+    """
 
-    if not public_url:
-        return None, "R2_PUBLIC_URL not configured"
+    def __init__(self, account_id: str, access_key: str, secret_key: str, bucket: str):
+        from botocore.credentials import Credentials
+
+        self.endpoint = f"https://{account_id}.r2.cloudflarestorage.com"
+        self.bucket = bucket
+        self._credentials = Credentials(access_key, secret_key)
+        self._slots = asyncio.Semaphore(get_r2_max_in_flight())
+        self._stats: dict = {}
+        self._known_keys: OrderedDict = OrderedDict()
+
+    def _url(self, key: str, query: str = "") -> str:
+        from urllib.parse import quote
+        url = f"{self.endpoint}/{self.bucket}/{quote(key, safe='/')}"
+        return f"{url}?{query}" if query else url
+
+    def _sign(self, method: str, url: str, body: bytes, headers: dict) -> dict:
+        from botocore.auth import S3SigV4Auth
+        from botocore.awsrequest import AWSRequest
+
+        request = AWSRequest(method=method, url=url, data=body, headers=headers)
+        S3SigV4Auth(self._credentials, "s3", "auto").add_auth(request)
+        return dict(request.headers.items())
+
+    def _record(self, op: str, elapsed_ms: int, size: int, ok: bool):
+        stats = self._stats.setdefault(op, {
+            "count": 0, "errors": 0, "bytes": 0, "total_ms": 0,
+            "histogram": {bucket: 0 for bucket in (*R2_LATENCY_BUCKETS_MS, "inf")},
+        })
+        stats["count"] += 1
+        stats["total_ms"] += elapsed_ms
+        bucket = next((b for b in R2_LATENCY_BUCKETS_MS if elapsed_ms <= b), "inf")
+        stats["histogram"][bucket] += 1
+        _count_metric(f"r2_{op}_le_{bucket}")
+        _count_metric(f"r2_{op}_ms", elapsed_ms)
+        if ok:
+            stats["bytes"] += size
+            _count_metric("r2_bytes", size)
+        else:
+            stats["errors"] += 1
+            _count_metric("r2_errors")
 
-    client, error = get_r2_client()
-    if error:
-        return None, error
+    async def _request(self, op: str, method: str, key: str, query: str = "",
+                       body: bytes = b"", headers: Optional[dict] = None, expected: Tuple[int, ...] = ()):
+        """Signed request with in-flight cap and retries. Returns the httpx response (2xx or expected status)."""
+        import httpx
+
+        url = self._url(key, query)
+        client = get_http_client(HTTP_CLIENT_R2)
+        last_error = None
+        for attempt in range(R2_MAX_RETRIES + 1):
+            if attempt:
+                _count_metric("r2_retries")
+                await asyncio.sleep(min(R2_RETRY_MAX_DELAY, R2_RETRY_BASE_DELAY * (2 ** (attempt - 1))) * random.uniform(0.5, 1.5))
+            started = time.time()
+            try:
+                async with self._slots:
+                    signed = self._sign(method, url, body, dict(headers or {}))
+                    response = await client.request(
+                        method, url, content=body or None, headers=signed,
+                        timeout=httpx.Timeout(R2_REQUEST_TIMEOUT),
+                    )
+            except httpx.TransportError as e:
+                self._record(op, int((time.time() - started) * 1000), 0, False)
+                last_error = f"{type(e).__name__}: {str(e)[:100]}"
+                continue
+
+            ok = response.status_code < 300 or response.status_code in expected
+            self._record(op, int((time.time() - started) * 1000), len(body), ok)
+            if ok:
+                return response
+            last_error = f"HTTP {response.status_code}: {response.text[:200]}"
+            if response.status_code != 429 and response.status_code < 500:
+                break
+        raise R2Error(f"R2 {op} failed: {last_error}")
+
+    async def put_object(self, key: str, data: bytes, content_type: str, cache_control: Optional[str] = None,
+                         if_absent: bool = False) -> bool:
+        """
+        Upload an object (multipart above R2_MULTIPART_THRESHOLD).
+
+        With if_absent=True an existing key is left untouched: a single PUT
+        carries If-None-Match: * (412 = already stored), a multipart upload
+        checks with HEAD first. Returns True if the object was written.
+        """
+        headers = {"Content-Type": content_type}
+        if cache_control:
+            headers["Cache-Control"] = cache_control
+        if len(data) > get_r2_multipart_threshold():
+            if if_absent and await self.head_object(key):
+                return False
+            await self._put_multipart(key, data, headers)
+            return True
+        if if_absent:
+            headers["If-None-Match"] = "*"
+        response = await self._request("put", "PUT", key, body=data, headers=headers,
+                                       expected=(412,) if if_absent else ())
+        return response.status_code != 412
+
+    async def head_object(self, key: str) -> bool:
+        """Whether the object exists."""
+        response = await self._request("head", "HEAD", key, expected=(404,))
+        return response.status_code < 300
+
+    async def put_if_absent(self, key: str, data: bytes, content_type: str) -> bool:
+        """
+        Upload a content-addressed object unless it is already stored.
+
+        Returns True if uploaded, False if the key already existed.
+        """
+        exists = key in self._known_keys or not await self.put_object(
+            key, data, content_type, cache_control=R2_IMMUTABLE_CACHE_CONTROL, if_absent=True
+        )
+        self._known_keys[key] = True
+        self._known_keys.move_to_end(key)
+        while len(self._known_keys) > R2_KNOWN_KEYS_MAX:
+            self._known_keys.popitem(last=False)
+        if exists:
+            _count_metric("r2_put_skipped")
+            _count_metric("r2_bytes_skipped", len(data))
+        return not exists
+
+    async def _put_multipart(self, key: str, data: bytes, headers: dict):
+        from urllib.parse import quote
+        from xml.sax.saxutils import escape
+
+        response = await self._request("multipart", "POST", key, "uploads", headers=headers)
+        match = re.search(r"<UploadId>([^<]+)</UploadId>", response.text)
+        if not match:
+            raise R2Error("R2 multipart: no UploadId in response")
+        upload_id = match.group(1)
+        quoted_id = quote(upload_id, safe="")
+
+        async def upload_part(number: int, chunk: bytes) -> Tuple[int, str]:
+            part = await self._request("part", "PUT", key, f"partNumber={number}&uploadId={quoted_id}", body=chunk)
+            return number, part.headers.get("etag", "")
+
+        chunks = [data[i:i + R2_MULTIPART_PART_SIZE] for i in range(0, len(data), R2_MULTIPART_PART_SIZE)]
+        try:
+            parts = await asyncio.gather(*(upload_part(i + 1, c) for i, c in enumerate(chunks)))
+            body = "<CompleteMultipartUpload>" + "".join(
+                f"<Part><PartNumber>{n}</PartNumber><ETag>{escape(etag)}</ETag></Part>" for n, etag in sorted(parts)
+            ) + "</CompleteMultipartUpload>"
+            await self._request("multipart", "POST", key, f"uploadId={quoted_id}",
+                                body=body.encode(), headers={"Content-Type": "application/xml"})
+        except BaseException:
+            try:
+                await self._request("multipart", "DELETE", key, f"uploadId={quoted_id}")
+            except Exception as e:
+                print(f"[R2] Multipart abort failed for {key}: {str(e)[:100]}")
+            raise
+
+    def get_stats(self) -> dict:
+        """Per-operation counts, bytes, errors, mean latency and latency histogram."""
+        stats = {}
+        for op, s in self._stats.items():
+            stats[op] = {**s, "histogram": dict(s["histogram"]),
+                         "avg_ms": round(s["total_ms"] / s["count"], 1) if s["count"] else 0}
+        return stats
+
+
+# Global async R2 client - created once per container
+_async_r2_client: Optional[AsyncR2Client] = None
+
+
+def get_r2_max_in_flight() -> int:
+    """R2 requests in flight per container (R2_MAX_IN_FLIGHT, default: 8)."""
+    try:
+        return max(1, int(os.environ.get("R2_MAX_IN_FLIGHT", DEFAULT_R2_MAX_IN_FLIGHT)))
+    except ValueError:
+        return DEFAULT_R2_MAX_IN_FLIGHT
+
+
+def get_r2_multipart_threshold() -> int:
+    """Object size (bytes) above which uploads use multipart (R2_MULTIPART_THRESHOLD)."""
+    try:
+        return max(R2_MULTIPART_PART_SIZE, int(os.environ.get("R2_MULTIPART_THRESHOLD", DEFAULT_R2_MULTIPART_THRESHOLD)))
+    except ValueError:
+        return DEFAULT_R2_MULTIPART_THRESHOLD
+
+
+def get_async_r2_client():
+    """
+    Get or create the container's async R2 client.
+
+    Returns:
+        Tuple of (client, error_message)
+    """
+    global _async_r2_client
+
+    if _async_r2_client is not None:
+        return _async_r2_client, None
+
+    account_id = os.environ.get("R2_ACCOUNT_ID")
+    access_key = os.environ.get("R2_ACCESS_KEY_ID")
+    secret_key = os.environ.get("R2_SECRET_ACCESS_KEY")
+
+    if not all([account_id, access_key, secret_key]):
+        return None, "R2 configuration incomplete"
+
+    _async_r2_client = AsyncR2Client(
+        account_id, access_key, secret_key,
+        bucket=os.environ.get("R2_BUCKET_NAME", "screenshots"),
+    )
+    return _async_r2_client, None
+
+
+def get_r2_stats() -> dict:
+    """Container-wide R2 stats (empty if the client was never used)."""
+    return _async_r2_client.get_stats() if _async_r2_client else {}
+
+
+def screenshot_object_key(image_bytes: bytes, variant: str = "full") -> str:
+    """Content-addressed key: screenshots/[<variant>/]<sha256[:2]>/<sha256>.webp."""
+    digest = hashlib.sha256(image_bytes).hexdigest()
+    prefix = "screenshots" if variant == "full" else f"screenshots/{variant}"
+    return f"{prefix}/{digest[:2]}/{digest}.webp"
+
+
+async def upload_to_r2_async(image_bytes: bytes, url_id: str, variant: str = "full") -> Tuple[Optional[str], Optional[str]]:
+    """Upload image to R2 with the native async client (no-op if the same bytes are already stored)."""
+    public_url = os.environ.get("R2_PUBLIC_URL")
+
+    if not public_url:
+        return None, "R2_PUBLIC_URL not configured"
+
+    client, error = get_async_r2_client()
+    if error:
+        return None, error
 
     try:
-        now = datetime.utcnow()
-        filename = f"screenshots/{now.strftime('%Y/%m/%d')}/{url_id}_{uuid.uuid4().hex[:8]}.webp"
-        client.put_object(Bucket=bucket_name, Key=filename, Body=image_bytes, ContentType='image/webp')
+        filename = screenshot_object_key(image_bytes, variant)
+        if not await client.put_if_absent(filename, image_bytes, 'image/webp'):
+            print(f"[{url_id}] R2: {filename} already stored, upload skipped")
         return f"{public_url.rstrip('/')}/{filename}", None
     except Exception as e:
         return None, f"R2 upload error: {str(e)[:200]}"
 
 
-async def delete_from_r2_async(screenshot_url: str) -> bool:
-    """Delete image from R2 asynchronously."""
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(None, delete_from_r2_sync, screenshot_url)
+async def upload_screenshot_async(compressed: bytes, derivatives: dict, url_id: str) -> Tuple[dict, Optional[str]]:
+    """
+    Upload a screenshot and its derivatives in parallel.
+
+    Returns ({variant: url}, error). A failed derivative is only logged and
+    left out; if the full image failed, nothing is returned ({}, error) so a
+    derivative-only set is never used or indexed. Uploaded derivatives are
+    not deleted then: keys are content-addressed and may be shared.
+    """
+    variants = {"full": compressed, **derivatives}
+    uploads = await asyncio.gather(*(upload_to_r2_async(data, url_id, variant) for variant, data in variants.items()))
+    full_url, full_error = uploads[0]
+    if not full_url:
+        return {}, full_error or "R2 upload failed"
+    urls = {}
+    for variant, (url, err) in zip(variants, uploads):
+        if url:
+            urls[variant] = url
+        else:
+            print(f"[{url_id}] R2 {variant} upload error: {err}")
+    return urls, None
 
 
-def delete_from_r2_sync(screenshot_url: str) -> bool:
-    """Synchronous R2 delete."""
+def upload_to_r2_sync(image_bytes: bytes, url_id: str) -> Tuple[Optional[str], Optional[str]]:
+    """Synchronous R2 upload (content-addressed, skipped if the key exists)."""
     bucket_name = os.environ.get("R2_BUCKET_NAME", "screenshots")
-    public_url = os.environ.get("R2_PUBLIC_URL", "")
+    public_url = os.environ.get("R2_PUBLIC_URL")
 
-    if not screenshot_url or not public_url:
-        return False
+    if not public_url:
+        return None, "R2_PUBLIC_URL not configured"
 
     client, error = get_r2_client()
     if error:
-        return False
+        return None, error
 
     try:
-        key = screenshot_url.replace(public_url.rstrip('/') + '/', '')
-        client.delete_object(Bucket=bucket_name, Key=key)
-        return True
-    except Exception:
-        return False
+        filename = screenshot_object_key(image_bytes)
+        try:
+            client.head_object(Bucket=bucket_name, Key=filename)
+        except Exception:
+            client.put_object(Bucket=bucket_name, Key=filename, Body=image_bytes, ContentType='image/webp',
+                              CacheControl=R2_IMMUTABLE_CACHE_CONTROL)
+        return f"{public_url.rstrip('/')}/{filename}", None
+    except Exception as e:
+        return None, f"R2 upload error: {str(e)[:200]}"
+
+
+# =============================================================================
+# HTTP Client Registry (Pooled)
+# =============================================================================
+#
+# Each scrape_url container handles thousands of URLs. Opening a new
+# httpx.AsyncClient per URL means a fresh TCP + TLS handshake every time.
+# Instead we keep one long-lived client per provider (HTTP/2 + keep-alive)
+# so every tier reuses warm connections to api.firecrawl.dev / api.brightdata.com.
+#
+# Pool counters are collected via the httpcore "trace" extension:
+#   - requests:    requests sent through the pool
+#   - connections: new TCP connections opened
+#   - handshakes:  TLS handshakes performed
+# handshakes_saved = requests - handshakes
+
+HTTP_CLIENT_FIRECRAWL = "firecrawl"
+HTTP_CLIENT_BRIGHTDATA = "brightdata"
+HTTP_CLIENT_R2 = "r2"
+HTTP_CLIENT_DEFAULT = "default"
+
+# Global clients - created once per container
+_http_clients: dict = {}
+_http_pool_stats = {"requests": 0, "connections": 0, "handshakes": 0}
+
+# Event loop the pooled clients / browsers were created on (closed there on exit)
+_resource_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def _remember_resource_loop():
+    """Record the running loop that owns the container's pooled resources."""
+    global _resource_loop
+    try:
+        _resource_loop = asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+
+# Per-scrape counters (set by scrape_url, inherited by child tasks)
+_scrape_metrics: ContextVar[Optional[dict]] = ContextVar("scrape_metrics", default=None)
+
+
+def _count_metric(key: str, amount: int = 1):
+    """Increment a counter in the current scrape's metrics (if any)."""
+    metrics = _scrape_metrics.get()
+    if metrics is not None:
+        metrics[key] = metrics.get(key, 0) + amount
+
+
+def _share_metrics(metrics: dict, targets: List[Optional[dict]]):
+    """Split counters from shared work evenly over several scrapes' metrics (totals are preserved)."""
+    targets = [t for t in targets if t is not None]
+    for key, value in metrics.items():
+        base, extra = divmod(value, len(targets) or 1)
+        for i, target in enumerate(targets):
+            share = base + (1 if i < extra else 0)
+            if share:
+                target[key] = target.get(key, 0) + share
+
+
+async def _http_trace(event_name: str, info: dict):
+    """httpcore trace hook - counts new connections and TLS handshakes."""
+    if event_name == "connection.connect_tcp.complete":
+        _http_pool_stats["connections"] += 1
+        _count_metric("http_connections")
+    elif event_name == "connection.start_tls.complete":
+        _http_pool_stats["handshakes"] += 1
+        _count_metric("http_handshakes")
+
+
+async def _http_on_request(request):
+    """Request event hook - attaches trace hook and counts pool usage."""
+    request.extensions["trace"] = _http_trace
+    _http_pool_stats["requests"] += 1
+    _count_metric("http_requests")
+
+
+def get_http_client(name: str = HTTP_CLIENT_DEFAULT):
+    """
+    Get or create a pooled httpx.AsyncClient for a provider.
+
+    Pool limits are sized from get_config() so a container running
+    max_inputs concurrent scrapes never queues on the pool. HTTP/2 is
+    enabled when the 'h2' package is installed.
+    """
+    client = _http_clients.get(name)
+    if client is not None and not client.is_closed:
+        return client
+
+    import httpx
+
+    try:
+        import h2  # noqa: F401
+        http2 = True
+    except ImportError:
+        http2 = False
+
+    config = get_config()
+    limits = httpx.Limits(
+        max_connections=config["max_inputs"] * HTTP_POOL_MULTIPLIER,
+        max_keepalive_connections=config["max_inputs"],
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+    client = httpx.AsyncClient(
+        http2=http2,
+        limits=limits,
+        timeout=httpx.Timeout(90.0),
+        event_hooks={"request": [_http_on_request]},
+    )
+    _http_clients[name] = client
+    _remember_resource_loop()
+    print(f"[HttpPool] Created '{name}' client (http2={http2}, "
+          f"max_connections={limits.max_connections}, keepalive={limits.max_keepalive_connections})")
+    return client
+
+
+def get_http_pool_stats() -> dict:
+    """Get container-wide pool utilisation counters."""
+    stats = dict(_http_pool_stats)
+    stats["handshakes_saved"] = max(0, stats["requests"] - stats["handshakes"])
+    stats["clients"] = len(_http_clients)
+    return stats
+
+
+async def close_http_clients():
+    """Close all pooled clients (container shutdown hook)."""
+    for name, client in list(_http_clients.items()):
+        try:
+            await client.aclose()
+        except Exception as e:
+            print(f"[HttpPool] Error closing '{name}': {str(e)[:100]}")
+    _http_clients.clear()
+    print(f"[HttpPool] Closed. Stats: {get_http_pool_stats()}")
+
+
+# =============================================================================
+# Container Shutdown
+# =============================================================================
+#
+# scrape_url and process_batch are plain functions, so there is no
+# @modal.exit() hook to hang cleanup on. An atexit handler closes the pooled
+# HTTP clients and the browser pool when the container process exits instead,
+# on the loop that created them (httpx / Playwright objects are bound to it).
+
+SHUTDOWN_TIMEOUT = 10.0  # seconds
+
+
+async def close_container_resources():
+    """Close pooled HTTP clients and browsers."""
+    if _browser_pool is not None:
+        try:
+            await _browser_pool.close()
+        except Exception as e:
+            print(f"[Shutdown] Error closing browser pool: {str(e)[:100]}")
+    if _http_clients:
+        await close_http_clients()
+
+
+def _close_container_resources_at_exit():
+    """atexit hook: run close_container_resources on the owning event loop."""
+    if not _http_clients and _browser_pool is None:
+        return
+    loop = _resource_loop
+    try:
+        if loop is not None and loop.is_running():
+            # Loop still running in another thread: hand the coroutine over
+            asyncio.run_coroutine_threadsafe(close_container_resources(), loop).result(SHUTDOWN_TIMEOUT)
+        elif loop is not None and not loop.is_closed():
+            loop.run_until_complete(asyncio.wait_for(close_container_resources(), SHUTDOWN_TIMEOUT))
+        else:
+            # Owning loop is gone: best effort on a fresh one
+            asyncio.run(asyncio.wait_for(close_container_resources(), SHUTDOWN_TIMEOUT))
+    except Exception as e:
+        print(f"[Shutdown] Cleanup failed: {str(e)[:100]}")
+
+
+atexit.register(_close_container_resources_at_exit)
+
+
+# =============================================================================
+# CPU Worker Pool (clean_html / compress_image off the event loop)
+# =============================================================================
+#
+# clean_html, extract_structured_data and compress_image are CPU-bound. Run
+# inline, one 3 MB page or full-page screenshot blocks the event loop and
+# stalls the other 19 concurrent scrapes in the container (fetch timeouts,
+# stale keep-alive connections). They run in a per-container process pool
+# sized to the container's CPU quota instead.
+#
+# Per-URL metrics: cpu_pool_tasks, cpu_pool_wait_ms (time queued before a
+# worker picked the task up), cpu_pool_run_ms, cpu_pool_queued (tasks that
+# had to wait because every worker was busy).
+
+DEFAULT_CPU_POOL_MAX_WORKERS = 4  # cpu.max is often "max" (host cores) and each worker costs memory
+
+_cpu_pool = None
+_cpu_pool_stats = {"tasks": 0, "in_flight": 0, "max_queue_depth": 0, "wait_ms": 0, "run_ms": 0, "errors": 0}
+
+
+def get_container_cpus() -> float:
+    """CPU quota from cgroup (v2 cpu.max or v1 cfs quota), falling back to os.cpu_count()."""
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()[:2]
+            if quota != "max":
+                return int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+            quota = int(f.read().strip())
+        with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+            period = int(f.read().strip())
+        if quota > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+    return float(os.cpu_count() or 1)
+
+
+def get_cpu_pool_workers() -> int:
+    """
+    Worker processes (CPU_POOL_WORKERS; 0 = run inline).
+
+    Default: container CPUs rounded up, capped at CPU_POOL_MAX_WORKERS
+    (default: 4). Without a cgroup quota the CPU count is the host's.
+    """
+    value = os.environ.get("CPU_POOL_WORKERS", "").strip()
+    if value:
+        try:
+            return max(0, int(value))
+        except ValueError:
+            pass
+    try:
+        cap = max(1, int(os.environ.get("CPU_POOL_MAX_WORKERS", DEFAULT_CPU_POOL_MAX_WORKERS)))
+    except ValueError:
+        cap = DEFAULT_CPU_POOL_MAX_WORKERS
+    return min(cap, max(1, int(get_container_cpus() + 0.999)))
+
+
+def get_cpu_pool():
+    """Get or create the container's process pool (None when CPU_POOL_WORKERS=0)."""
+    global _cpu_pool
+    if _cpu_pool is None:
+        from concurrent.futures import ProcessPoolExecutor
+
+        workers = get_cpu_pool_workers()
+        if workers == 0:
+            return None
+        _cpu_pool = ProcessPoolExecutor(max_workers=workers)
+        print(f"[CpuPool] Started {workers} worker process(es) ({get_container_cpus():.2f} CPUs)")
+    return _cpu_pool
+
+
+def _run_timed(func, args: tuple):
+    """Runs in the worker: returns (start timestamp, result, run seconds)."""
+    started = time.time()
+    result = func(*args)
+    return started, result, time.time() - started
+
+
+async def run_cpu_bound(func, *args):
+    """
+    Run a CPU-bound function in the container's process pool.
+
+    Falls back to running inline if the pool is disabled or broken (e.g. a
+    worker was OOM-killed), so a pool failure never fails the scrape.
+    """
+    from concurrent.futures.process import BrokenProcessPool
+
+    global _cpu_pool
+    pool = get_cpu_pool()
+    if pool is None:
+        return func(*args)
+
+    workers = pool._max_workers
+    _cpu_pool_stats["in_flight"] += 1
+    queue_depth = max(0, _cpu_pool_stats["in_flight"] - workers)
+    _cpu_pool_stats["max_queue_depth"] = max(_cpu_pool_stats["max_queue_depth"], queue_depth)
+    if queue_depth:
+        _count_metric("cpu_pool_queued")
+
+    submitted = time.time()
+    try:
+        started, result, run_s = await asyncio.get_running_loop().run_in_executor(pool, _run_timed, func, args)
+    except BrokenProcessPool:
+        print(f"[CpuPool] Pool broken, recreating (running {func.__name__} inline)")
+        _cpu_pool_stats["errors"] += 1
+        if _cpu_pool is pool:
+            _cpu_pool = None
+            pool.shutdown(wait=False)
+        return func(*args)
+    finally:
+        _cpu_pool_stats["in_flight"] -= 1
+
+    wait_ms = int(max(0.0, started - submitted) * 1000)
+    run_ms = int(run_s * 1000)
+    _cpu_pool_stats["tasks"] += 1
+    _cpu_pool_stats["wait_ms"] += wait_ms
+    _cpu_pool_stats["run_ms"] += run_ms
+    _count_metric("cpu_pool_tasks")
+    _count_metric("cpu_pool_wait_ms", wait_ms)
+    _count_metric("cpu_pool_run_ms", run_ms)
+    return result
+
+
+def get_cpu_pool_stats() -> dict:
+    """Get container-wide CPU pool counters."""
+    return dict(_cpu_pool_stats)
+
+
+# =============================================================================
+# Cluster Limiter (Provider concurrency across containers)
+# =============================================================================
+#
+# asyncio.Semaphore in process_batch only bounds one orchestrator. Two jobs
+# running at once would each allow 5 Firecrawl calls and together exceed the
+# Hobby plan. This limiter keeps one lease set per provider in a modal.Dict:
+#
+#   "firecrawl"      -> {"<lease uuid>": 1739999999.0, ...}   (lease -> expiresAt)
+#   "firecrawl:lock" -> {"owner": "<uuid>", "expiresAt": ...}
+#
+# Waiters poll the lease set with a single get while it is full. The set is
+# only changed under its lock (atomic put(skip_if_exists=True)), so acquire,
+# renew and release are read-modify-write steps that cannot interleave, and
+# release only removes the caller's own lease id. Holders renew their lease
+# every PROVIDER_LEASE_RENEW seconds; a lease that is not renewed within
+# PROVIDER_LEASE_TTL (dead container) is pruned by the next update.
+# A lock left behind by a dead container expires after PROVIDER_LOCK_TTL and
+# is taken over by whoever first claims "<provider>:lock:<stale owner>".
+# If the store is unreachable or no slot frees up in time, the call proceeds
+# without a slot (fail open) rather than stalling the batch.
+
+def get_provider_limits() -> dict:
+    """
+    Get cluster-wide concurrency limits per provider from environment variables.
+
+    Environment variables (0 = unlimited, no coordination):
+    - FIRECRAWL_GLOBAL_CONCURRENCY: default 5 (Hobby plan)
+    - BRIGHTDATA_GLOBAL_CONCURRENCY: default 0
+    - GEMINI_GLOBAL_CONCURRENCY: default 0
+    - HEDGE_GLOBAL_MAX_IN_FLIGHT: default 0 (per-container HEDGE_MAX_IN_FLIGHT only)
+    """
+    def get_limit(env_var: str, default: int) -> int:
+        value = os.environ.get(env_var, "").strip()
+        if not value:
+            return default
+        try:
+            return max(0, int(value))
+        except ValueError:
+            return default
+
+    return {
+        PROVIDER_FIRECRAWL: get_limit("FIRECRAWL_GLOBAL_CONCURRENCY", FIRECRAWL_MAX_CONCURRENCY),
+        PROVIDER_BRIGHTDATA: get_limit("BRIGHTDATA_GLOBAL_CONCURRENCY", 0),
+        PROVIDER_GEMINI: get_limit("GEMINI_GLOBAL_CONCURRENCY", 0),
+        PROVIDER_HEDGE: get_limit("HEDGE_GLOBAL_MAX_IN_FLIGHT", 0),
+    }
+
+
+class ClusterLimiter:
+    """
+    Distributed semaphore with renewed, expiring leases, keyed by provider.
+
+    Usage:
+        async with get_cluster_limiter().slot(PROVIDER_FIRECRAWL, url_id):
+            response = await client.post(...)
+    """
+
+    def __init__(self, store=None, lease_ttl: float = PROVIDER_LEASE_TTL):
+        self._store = store
+        self.lease_ttl = lease_ttl
+
+    def _get_store(self):
+        if self._store is None:
+            self._store = modal.Dict.from_name(PROVIDER_LEASES_DICT, create_if_missing=True)
+        return self._store
+
+    async def _lock(self, provider: str) -> Optional[str]:
+        """Take the provider's lease-set lock. Returns the owner token, or None if it stays busy."""
+        store = self._get_store()
+        lock_key = f"{provider}:lock"
+        token = uuid.uuid4().hex
+        for _ in range(PROVIDER_LOCK_ATTEMPTS):
+            lock = {"owner": token, "expiresAt": time.time() + PROVIDER_LOCK_TTL}
+            if await store.put.aio(lock_key, lock, skip_if_exists=True):
+                return token
+            current = await store.get.aio(lock_key)
+            if current and current.get("expiresAt", 0) < time.time():
+                # Holder died mid-update: one taker wins the claim on that owner
+                if await store.put.aio(f"{lock_key}:{current.get('owner')}", token, skip_if_exists=True):
+                    await store.put.aio(lock_key, lock)
+                    print(f"[ClusterLimiter] Took over expired {provider} lock")
+                    return token
+            await asyncio.sleep(PROVIDER_LOCK_RETRY * random.uniform(0.5, 1.5))
+        return None
+
+    async def _unlock(self, provider: str, token: str):
+        """Release the lease-set lock if we still own it."""
+        store = self._get_store()
+        lock_key = f"{provider}:lock"
+        current = await store.get.aio(lock_key)
+        if current and current.get("owner") == token:
+            await store.pop.aio(lock_key)
+
+    async def _update_leases(self, provider: str, change) -> Tuple[bool, Any]:
+        """
+        Apply change(leases) to the provider's live leases under the lock.
+
+        Expired leases are dropped first. Returns (applied, change's return value);
+        applied is False when the lock could not be taken.
+        """
+        token = await self._lock(provider)
+        if token is None:
+            return False, None
+        store = self._get_store()
+        try:
+            now = time.time()
+            leases = {k: v for k, v in (await store.get.aio(provider) or {}).items() if v >= now}
+            result = change(leases)
+            await store.put.aio(provider, leases)
+            return True, result
+        finally:
+            await self._unlock(provider, token)
+
+    async def try_acquire(self, provider: str, limit: int) -> Optional[str]:
+        """Take a lease if the provider has a free slot. Returns the lease id, or None."""
+        leases = await self._get_store().get.aio(provider) or {}
+        now = time.time()
+        if sum(1 for expires_at in leases.values() if expires_at >= now) >= limit:
+            return None  # Full: one RPC per poll
+
+        lease_id = uuid.uuid4().hex
+
+        def add(current: dict) -> bool:
+            if len(current) >= limit:
+                return False
+            current[lease_id] = time.time() + self.lease_ttl
+            return True
+
+        applied, added = await self._update_leases(provider, add)
+        return lease_id if applied and added else None
+
+    async def acquire(self, provider: str, limit: int, timeout: float = PROVIDER_ACQUIRE_TIMEOUT) -> Optional[str]:
+        """Wait for a slot (polling with backoff + jitter). None on timeout."""
+        deadline = time.time() + timeout
+        delay = PROVIDER_POLL_MIN
+        while True:
+            lease_id = await self.try_acquire(provider, limit)
+            if lease_id or time.time() >= deadline:
+                return lease_id
+            await asyncio.sleep(delay + random.uniform(0, delay * 0.3))
+            delay = min(delay * 2, PROVIDER_POLL_MAX)
+
+    async def renew(self, provider: str, lease_id: str) -> bool:
+        """Push our lease's expiry forward. False if it was lost (expired and pruned)."""
+        def extend(current: dict) -> bool:
+            if lease_id not in current:
+                return False
+            current[lease_id] = time.time() + self.lease_ttl
+            return True
+
+        applied, held = await self._update_leases(provider, extend)
+        return held if applied else True  # Lock busy: retry on the next interval
+
+    async def release(self, provider: str, lease_id: str):
+        """Remove our own lease (other holders' leases are never touched)."""
+        applied, _ = await self._update_leases(provider, lambda current: current.pop(lease_id, None))
+        if not applied:
+            print(f"[ClusterLimiter] {provider} lock busy on release, lease expires in <= {self.lease_ttl:.0f}s")
+
+    async def keep_alive(self, provider: str, lease_id: str, url_id: str = ""):
+        """Renew a held lease until cancelled."""
+        while True:
+            await asyncio.sleep(PROVIDER_LEASE_RENEW)
+            try:
+                if not await self.renew(provider, lease_id):
+                    print(f"[{url_id}] ClusterLimiter: {provider} lease lost, slot no longer held")
+                    _count_metric("limiter_leases_lost")
+                    return
+            except Exception as e:
+                print(f"[{url_id}] ClusterLimiter: {provider} renew error: {str(e)[:100]}")
+
+    @asynccontextmanager
+    async def slot(self, provider: str, url_id: str = ""):
+        """Hold one of the provider's cluster-wide slots for the duration of the block."""
+        limit = get_provider_limits().get(provider, 0)
+        if limit <= 0:
+            yield
+            return
+
+        wait_start = time.time()
+        lease_id = None
+        try:
+            lease_id = await self.acquire(provider, limit)
+            if lease_id is None:
+                print(f"[{url_id}] ClusterLimiter: no {provider} slot after {PROVIDER_ACQUIRE_TIMEOUT:.0f}s, proceeding")
+                _count_metric("limiter_timeouts")
+        except Exception as e:
+            print(f"[{url_id}] ClusterLimiter: {provider} store error, proceeding: {str(e)[:100]}")
+            _count_metric("limiter_errors")
+        _count_metric(f"{provider}_slot_wait_ms", int((time.time() - wait_start) * 1000))
+
+        keep_alive = asyncio.create_task(self.keep_alive(provider, lease_id, url_id)) if lease_id else None
+        try:
+            yield
+        finally:
+            if keep_alive is not None:
+                keep_alive.cancel()
+                try:
+                    await self.release(provider, lease_id)
+                except Exception as e:
+                    print(f"[{url_id}] ClusterLimiter: {provider} release error: {str(e)[:100]}")
+
+
+# Global cluster limiter - created once per container
+_cluster_limiter: Optional[ClusterLimiter] = None
+
+
+def get_cluster_limiter() -> ClusterLimiter:
+    """Get or create the container's cluster limiter."""
+    global _cluster_limiter
+    if _cluster_limiter is None:
+        _cluster_limiter = ClusterLimiter()
+    return _cluster_limiter
 
 
 # =============================================================================
@@ -855,6 +2886,8 @@ class TinybirdBatcher:
         self._total_batches = 0
         self._failed_batches = 0
         self._total_retries = 0
+        # urlIds whose batch was never acknowledged (must not be checkpointed)
+        self.failed_url_ids: set = set()
 
     async def __aenter__(self):
         """Initialize HTTP client on context enter."""
@@ -963,6 +2996,8 @@ class TinybirdBatcher:
             "scrapedAt": scraped_at_iso,
             "errorMessage": scrape_result.get("errorMessage"),
             "screenshotUrl": scrape_result.get("screenshotUrl"),
+            "screenshotThumbUrl": scrape_result.get("screenshotThumbUrl"),
+            "screenshotViewportUrl": scrape_result.get("screenshotViewportUrl"),
             "productTitle": scrape_result.get("productTitle"),
             "productName": scrape_result.get("productName") or scrape_result.get("productTitle"),
             "brand": scrape_result.get("brand"),
@@ -1046,17 +3081,23 @@ class TinybirdBatcher:
         token = os.environ.get("TINYBIRD_TOKEN")
         if not token:
             print("[TinybirdBatcher] ERROR: TINYBIRD_TOKEN not configured - discarding batch")
+            self.failed_url_ids.update(r.get("urlId") for r in self._buffer)
             self._buffer.clear()
             return
 
         batch = self._buffer.copy()
         self._buffer.clear()
 
-        success = await self._send_batch_with_retry(batch, token)
+        try:
+            success = await self._send_batch_with_retry(batch, token)
+        except Exception as e:
+            print(f"[TinybirdBatcher] Unexpected send error: {str(e)[:200]}")
+            success = False
 
         self._total_batches += 1
         if not success:
             self._failed_batches += 1
+            self.failed_url_ids.update(r.get("urlId") for r in batch)
 
     async def _send_batch_with_retry(self, batch: List[dict], token: str) -> bool:
         """Send batch with exponential backoff retry."""
@@ -1188,6 +3229,8 @@ class ConvexBatcher:
         self._total_records = 0
         self._total_batches = 0
         self._failed_batches = 0
+        # urlIds whose batch was never acknowledged (must not be checkpointed)
+        self.failed_url_ids: set = set()
 
     async def __aenter__(self):
         import httpx
@@ -1224,6 +3267,7 @@ class ConvexBatcher:
         self._total_batches += 1
         if not success:
             self._failed_batches += 1
+            self.failed_url_ids.update(r.get("urlId") for r in batch)
 
     async def _send_batch(self, batch: List[dict]) -> bool:
         import httpx
@@ -1285,7 +3329,9 @@ class ConvexBatcher:
 class DualBatcher:
     """
     Writes to both Convex (primary) and Tinybird (analytics) simultaneously.
-    Tinybird failures are logged but do NOT block the Convex write.
+    Tinybird failures are logged but do NOT block the Convex write. Their
+    urlIds are still reported in failed_url_ids (when Tinybird is configured),
+    so they are not checkpointed and a resume re-ingests them.
 
     Usage:
         async with DualBatcher(convex_url, batch_id, trigger) as batcher:
@@ -1300,6 +3346,7 @@ class DualBatcher:
     ):
         self._convex = ConvexBatcher(convex_ingest_url, batch_id, trigger_type)
         self._tinybird = TinybirdBatcher()
+        self._tinybird_add_failed: set = set()
 
     async def __aenter__(self):
         await self._convex.__aenter__()
@@ -1324,6 +3371,7 @@ class DualBatcher:
             await self._tinybird.add(scrape_result)
         except Exception as e:
             url_id = scrape_result.get("urlId", "unknown")
+            self._tinybird_add_failed.add(url_id)
             print(f"[DualBatcher] Tinybird add failed for {url_id} (non-blocking): {e}")
 
     async def flush(self):
@@ -1334,25 +3382,45 @@ class DualBatcher:
             print(f"[DualBatcher] Tinybird flush error (non-blocking): {e}")
         await self._convex.flush()
 
+    @property
+    def failed_url_ids(self) -> set:
+        """urlIds Convex never acknowledged, plus Tinybird's when TINYBIRD_TOKEN is set."""
+        if not os.environ.get("TINYBIRD_TOKEN"):
+            return self._convex.failed_url_ids  # Convex-only deployment
+        return self._convex.failed_url_ids | self._tinybird.failed_url_ids | self._tinybird_add_failed
+
 
 # =============================================================================
 # Method 1: Firecrawl API (Async)
 # =============================================================================
 
-async def attempt_firecrawl_async(url: str, url_id: str) -> AttemptResult:
-    """Async Firecrawl scraping."""
+async def _download_firecrawl_screenshot(client, screenshot_url: Optional[str], url_id: str) -> Optional[bytes]:
+    """Download the screenshot Firecrawl rendered (it returns a URL, not bytes)."""
+    if not screenshot_url or not screenshot_url.startswith("http"):
+        return None
+    print(f"[{url_id}] Firecrawl: Downloading screenshot...")
+    try:
+        img_response = await client.get(screenshot_url, timeout=30.0)
+        if img_response.status_code == 200 and len(img_response.content) > 1000:
+            print(f"[{url_id}] Firecrawl: Screenshot {len(img_response.content):,} bytes")
+            return img_response.content
+    except Exception as e:
+        print(f"[{url_id}] Firecrawl: Screenshot download error: {str(e)[:50]}")
+    return None
+
+
+async def fetch_firecrawl_screenshot(url: str, url_id: str) -> Optional[bytes]:
+    """Screenshot-only Firecrawl request (on-demand capture after an HTML-only scrape)."""
     import httpx
 
     api_key = os.environ.get("FIRECRAWL_API_KEY")
     if not api_key:
-        return AttemptResult(success=False, error="FIRECRAWL_API_KEY not configured", method=METHOD_FIRECRAWL)
+        return None
 
+    client = get_http_client(HTTP_CLIENT_FIRECRAWL)
+    wait_seconds = int(os.environ.get("FIRECRAWL_WAIT_SECONDS", "2"))
     try:
-        print(f"[{url_id}] Firecrawl: Starting async scrape...")
-
-        async with httpx.AsyncClient(timeout=httpx.Timeout(90.0)) as client:
-            # Call Firecrawl API v2
-            wait_seconds = int(os.environ.get("FIRECRAWL_WAIT_SECONDS", "2"))
+        async with get_cluster_limiter().slot(PROVIDER_FIRECRAWL, url_id):
             response = await client.post(
                 "https://api.firecrawl.dev/v2/scrape",
                 headers={
@@ -1361,61 +3429,91 @@ async def attempt_firecrawl_async(url: str, url_id: str) -> AttemptResult:
                 },
                 json={
                     "url": url,
-                    "formats": ["html", "screenshot"],
+                    "formats": ["screenshot"],
                     "waitFor": wait_seconds * 1000,
                     "timeout": 60000,
-                }
+                },
+                timeout=httpx.Timeout(90.0)
             )
+        if response.status_code != 200:
+            print(f"[{url_id}] Firecrawl: Screenshot request failed - status={response.status_code}")
+            return None
+        data = response.json()
+        return await _download_firecrawl_screenshot(client, (data.get("data") or {}).get("screenshot"), url_id)
+    except Exception as e:
+        print(f"[{url_id}] Firecrawl: Screenshot error: {str(e)[:50]}")
+        return None
 
-            if response.status_code != 200:
-                return AttemptResult(
-                    success=False,
-                    error=f"Firecrawl API error: {response.status_code}",
-                    method=METHOD_FIRECRAWL
-                )
-
-            data = response.json()
-
-            if not data.get("success"):
-                return AttemptResult(
-                    success=False,
-                    error=f"Firecrawl failed: {data.get('error', 'Unknown')}",
-                    method=METHOD_FIRECRAWL
-                )
-
-            result_data = data.get("data", {})
-            html_content = result_data.get("html") or result_data.get("rawHtml")
 
-            if not html_content or len(html_content) < MIN_HTML_SIZE:
-                return AttemptResult(
-                    success=False,
-                    error=f"Firecrawl HTML too small ({len(html_content) if html_content else 0} bytes)",
-                    method=METHOD_FIRECRAWL
-                )
+async def attempt_firecrawl_async(url: str, url_id: str, screenshot: bool = True) -> AttemptResult:
+    """Async Firecrawl scraping (screenshot=False requests HTML only)."""
+    import httpx
 
-            print(f"[{url_id}] Firecrawl: HTML {len(html_content):,} bytes")
+    api_key = os.environ.get("FIRECRAWL_API_KEY")
+    if not api_key:
+        return AttemptResult(success=False, error="FIRECRAWL_API_KEY not configured", method=METHOD_FIRECRAWL)
 
-            # Get screenshot
-            screenshot_bytes = None
-            screenshot_url = result_data.get("screenshot")
+    try:
+        print(f"[{url_id}] Firecrawl: Starting async scrape...")
 
-            if screenshot_url and screenshot_url.startswith("http"):
-                print(f"[{url_id}] Firecrawl: Downloading screenshot...")
-                try:
-                    img_response = await client.get(screenshot_url, timeout=30.0)
-                    if img_response.status_code == 200 and len(img_response.content) > 1000:
-                        screenshot_bytes = img_response.content
-                        print(f"[{url_id}] Firecrawl: Screenshot {len(screenshot_bytes):,} bytes")
-                except Exception as e:
-                    print(f"[{url_id}] Firecrawl: Screenshot download error: {str(e)[:50]}")
+        client = get_http_client(HTTP_CLIENT_FIRECRAWL)
 
-            return AttemptResult(
-                success=True,
-                html=html_content,
-                screenshot_bytes=screenshot_bytes,
+        # Call Firecrawl API v2
+        wait_seconds = int(os.environ.get("FIRECRAWL_WAIT_SECONDS", "2"))
+        async with get_cluster_limiter().slot(PROVIDER_FIRECRAWL, url_id):
+            response = await client.post(
+                "https://api.firecrawl.dev/v2/scrape",
+                headers={
+                    "Authorization": f"Bearer {api_key}",
+                    "Content-Type": "application/json"
+                },
+                json={
+                    "url": url,
+                    "formats": ["html", "screenshot"] if screenshot else ["html"],
+                    "waitFor": wait_seconds * 1000,
+                    "timeout": 60000,
+                },
+                timeout=httpx.Timeout(90.0)
+            )
+
+        if response.status_code != 200:
+            return AttemptResult(
+                success=False,
+                error=f"Firecrawl API error: {response.status_code}",
                 method=METHOD_FIRECRAWL
             )
 
+        data = response.json()
+
+        if not data.get("success"):
+            return AttemptResult(
+                success=False,
+                error=f"Firecrawl failed: {data.get('error', 'Unknown')}",
+                method=METHOD_FIRECRAWL
+            )
+
+        result_data = data.get("data", {})
+        html_content = result_data.get("html") or result_data.get("rawHtml")
+
+        if not html_content or len(html_content) < MIN_HTML_SIZE:
+            return AttemptResult(
+                success=False,
+                error=f"Firecrawl HTML too small ({len(html_content) if html_content else 0} bytes)",
+                method=METHOD_FIRECRAWL
+            )
+
+        print(f"[{url_id}] Firecrawl: HTML {len(html_content):,} bytes")
+
+        # Get screenshot
+        screenshot_bytes = await _download_firecrawl_screenshot(client, result_data.get("screenshot"), url_id)
+
+        return AttemptResult(
+            success=True,
+            html=html_content,
+            screenshot_bytes=screenshot_bytes,
+            method=METHOD_FIRECRAWL
+        )
+
     except httpx.TimeoutException:
         return AttemptResult(success=False, error="Firecrawl timeout", method=METHOD_FIRECRAWL)
     except Exception as e:
@@ -1426,8 +3524,42 @@ async def attempt_firecrawl_async(url: str, url_id: str) -> AttemptResult:
 # Method 2: Bright Data Web Unlocker (Async)
 # =============================================================================
 
-async def attempt_brightdata_async(url: str, url_id: str) -> AttemptResult:
-    """Async Bright Data scraping."""
+BRIGHTDATA_API_URL = "https://api.brightdata.com/request"
+
+
+async def fetch_brightdata_screenshot(url: str, url_id: str, timings: Optional[dict] = None) -> Optional[bytes]:
+    """Bright Data screenshot request (data_format=screenshot). Records screenshot_ms in timings."""
+    import httpx
+
+    api_key = os.environ.get("BRIGHT_DATA_API")
+    if not api_key:
+        return None
+    zone = os.environ.get("BRIGHT_DATA_ZONE", "web_unlocker1")
+
+    client = get_http_client(HTTP_CLIENT_BRIGHTDATA)
+    screen_start = time.time()
+    try:
+        async with get_cluster_limiter().slot(PROVIDER_BRIGHTDATA, url_id):
+            screen_response = await client.post(
+                BRIGHTDATA_API_URL,
+                headers={"Content-Type": "application/json", "Authorization": f"Bearer {api_key}"},
+                json={"zone": zone, "url": url, "format": "raw", "data_format": "screenshot"},
+                timeout=httpx.Timeout(150.0)
+            )
+        if screen_response.status_code == 200 and len(screen_response.content) > 1000:
+            print(f"[{url_id}] Bright Data: Screenshot {len(screen_response.content):,} bytes")
+            return screen_response.content
+        print(f"[{url_id}] Bright Data: Screenshot failed - status={screen_response.status_code}, size={len(screen_response.content)} bytes")
+    except Exception as e:
+        print(f"[{url_id}] Bright Data: Screenshot error: {str(e)[:50]}")
+    finally:
+        if timings is not None:
+            timings["screenshot_ms"] = int((time.time() - screen_start) * 1000)
+    return None
+
+
+async def attempt_brightdata_async(url: str, url_id: str, screenshot: bool = True) -> AttemptResult:
+    """Async Bright Data scraping (screenshot=False skips the screenshot request)."""
     import httpx
 
     api_key = os.environ.get("BRIGHT_DATA_API")
@@ -1436,76 +3568,273 @@ async def attempt_brightdata_async(url: str, url_id: str) -> AttemptResult:
     if not api_key:
         return AttemptResult(success=False, error="BRIGHT_DATA_API not configured", method=METHOD_BRIGHTDATA)
 
-    api_url = "https://api.brightdata.com/request"
     headers = {"Content-Type": "application/json", "Authorization": f"Bearer {api_key}"}
 
+    client = get_http_client(HTTP_CLIENT_BRIGHTDATA)
+    timings = {}
+    attempt_start = time.time()
+
+    # Fire HTML and screenshot requests at the same time
+    screenshot_task = None
+    if screenshot:
+        print(f"[{url_id}] Bright Data: Fetching HTML + screenshot in parallel...")
+        screenshot_task = asyncio.create_task(fetch_brightdata_screenshot(url, url_id, timings))
+    else:
+        print(f"[{url_id}] Bright Data: Fetching HTML (screenshot skipped by policy)...")
+
     try:
-        async with httpx.AsyncClient(timeout=httpx.Timeout(180.0)) as client:
-            # Fetch HTML
-            print(f"[{url_id}] Bright Data: Fetching HTML...")
+        html_start = time.time()
+        async with get_cluster_limiter().slot(PROVIDER_BRIGHTDATA, url_id):
             response = await client.post(
-                api_url,
+                BRIGHTDATA_API_URL,
                 headers=headers,
-                json={"zone": zone, "url": url, "format": "raw"}
+                json={"zone": zone, "url": url, "format": "raw"},
+                timeout=httpx.Timeout(180.0)
             )
+        timings["html_ms"] = int((time.time() - html_start) * 1000)
 
-            if response.status_code != 200:
-                return AttemptResult(
-                    success=False,
-                    error=f"Bright Data HTML error: {response.status_code}",
-                    method=METHOD_BRIGHTDATA
-                )
-
-            html_content = response.text
-            if len(html_content) < MIN_HTML_SIZE:
-                return AttemptResult(
-                    success=False,
-                    error=f"Bright Data HTML too small ({len(html_content)} bytes)",
-                    method=METHOD_BRIGHTDATA
-                )
+        if response.status_code != 200:
+            return AttemptResult(
+                success=False,
+                error=f"Bright Data HTML error: {response.status_code}",
+                method=METHOD_BRIGHTDATA,
+                timings=timings
+            )
 
-            print(f"[{url_id}] Bright Data: HTML {len(html_content):,} bytes")
+        html_content = response.text
+        if len(html_content) < MIN_HTML_SIZE:
+            return AttemptResult(
+                success=False,
+                error=f"Bright Data HTML too small ({len(html_content)} bytes)",
+                method=METHOD_BRIGHTDATA,
+                timings=timings
+            )
 
-            # Fetch screenshot
-            screenshot_bytes = None
-            print(f"[{url_id}] Bright Data: Taking screenshot...")
+        print(f"[{url_id}] Bright Data: HTML {len(html_content):,} bytes")
 
-            try:
-                screen_response = await client.post(
-                    api_url,
-                    headers=headers,
-                    json={"zone": zone, "url": url, "format": "raw", "data_format": "screenshot"},
-                    timeout=httpx.Timeout(150.0)
-                )
-                if screen_response.status_code == 200 and len(screen_response.content) > 1000:
-                    screenshot_bytes = screen_response.content
-                    print(f"[{url_id}] Bright Data: Screenshot {len(screenshot_bytes):,} bytes")
-                else:
-                    print(f"[{url_id}] Bright Data: Screenshot failed - status={screen_response.status_code}, size={len(screen_response.content)} bytes")
-            except Exception as e:
-                print(f"[{url_id}] Bright Data: Screenshot error: {str(e)[:50]}")
+        screenshot_bytes = await screenshot_task if screenshot_task else None
+        timings["wall_ms"] = int((time.time() - attempt_start) * 1000)
+        timings["saved_ms"] = max(0, timings["html_ms"] + timings.get("screenshot_ms", 0) - timings["wall_ms"])
+        print(f"[{url_id}] Bright Data: HTML {timings['html_ms']}ms, screenshot {timings.get('screenshot_ms', 0)}ms, "
+              f"wall {timings['wall_ms']}ms (saved {timings['saved_ms']}ms)")
 
-            return AttemptResult(
-                success=True,
-                html=html_content,
-                screenshot_bytes=screenshot_bytes,
-                method=METHOD_BRIGHTDATA
-            )
+        return AttemptResult(
+            success=True,
+            html=html_content,
+            screenshot_bytes=screenshot_bytes,
+            method=METHOD_BRIGHTDATA,
+            timings=timings
+        )
 
     except httpx.TimeoutException:
-        return AttemptResult(success=False, error="Bright Data timeout", method=METHOD_BRIGHTDATA)
+        return AttemptResult(success=False, error="Bright Data timeout", method=METHOD_BRIGHTDATA, timings=timings)
     except Exception as e:
-        return AttemptResult(success=False, error=f"Bright Data error: {str(e)[:200]}", method=METHOD_BRIGHTDATA)
+        return AttemptResult(success=False, error=f"Bright Data error: {str(e)[:200]}", method=METHOD_BRIGHTDATA, timings=timings)
+    finally:
+        # HTML failed or too small: the screenshot is useless, cancel it
+        if screenshot_task and not screenshot_task.done():
+            screenshot_task.cancel()
+            print(f"[{url_id}] Bright Data: Screenshot cancelled")
+
+
+# =============================================================================
+# Playwright Browser Pool (Persistent, per container)
+# =============================================================================
+
+def get_container_memory_mb() -> Optional[float]:
+    """Read current container memory usage from cgroup (v2 or v1). None if unavailable."""
+    for path in ("/sys/fs/cgroup/memory.current", "/sys/fs/cgroup/memory/memory.usage_in_bytes"):
+        try:
+            with open(path) as f:
+                return int(f.read().strip()) / (1024 * 1024)
+        except (OSError, ValueError):
+            continue
+    return None
+
+
+@dataclass
+class PooledBrowser:
+    """A long-lived Chromium process handed out by BrowserPool."""
+    browser: Any
+    pages_served: int = 0
+    active_contexts: int = 0
+    retiring: bool = False
+
+
+class BrowserPool:
+    """
+    Container-scoped pool of long-lived Chromium processes.
+
+    Features:
+    - Playwright driver and browsers started once, reused across URLs
+    - Fresh isolated BrowserContext per URL, with stealth applied
+    - Concurrent contexts bounded by semaphore (container memory budget)
+    - Browser recycled after N pages or when container memory is too high
+    - Crashed/disconnected browsers are dropped and relaunched on demand
+
+    Usage:
+        pool = get_browser_pool()
+        async with pool.context(ctx_args) as context:
+            page = await context.new_page()
+    """
+
+    def __init__(
+        self,
+        max_browsers: int = PLAYWRIGHT_POOL_BROWSERS,
+        max_contexts: int = PLAYWRIGHT_MAX_CONTEXTS,
+        pages_per_browser: int = PLAYWRIGHT_PAGES_PER_BROWSER,
+        memory_limit_mb: float = PLAYWRIGHT_MEMORY_LIMIT_MB,
+    ):
+        self.max_browsers = max_browsers
+        self.pages_per_browser = pages_per_browser
+        self.memory_limit_mb = memory_limit_mb
+
+        self._playwright = None
+        self._browsers: List[PooledBrowser] = []
+        self._semaphore = asyncio.Semaphore(max_contexts)
+        self._lock = asyncio.Lock()
+
+        # Metrics
+        self._launches = 0
+        self._recycles = 0
+        self._contexts_served = 0
+
+    async def _launch(self) -> PooledBrowser:
+        """Launch a new Chromium process (must be called with lock held)."""
+        if self._playwright is None:
+            from playwright.async_api import async_playwright
+            self._playwright = await async_playwright().start()
+            _remember_resource_loop()
+
+        launch_start = time.time()
+        browser = await self._playwright.chromium.launch(
+            headless=True,
+            args=['--no-sandbox', '--disable-setuid-sandbox', '--disable-dev-shm-usage', '--disable-gpu']
+        )
+        entry = PooledBrowser(browser=browser)
+        browser.on("disconnected", lambda _: self._drop(entry))
+        self._browsers.append(entry)
+        self._launches += 1
+        _count_metric("playwright_launches")
+        print(f"[BrowserPool] Launched browser #{self._launches} in {time.time() - launch_start:.2f}s")
+        return entry
+
+    def _drop(self, entry: PooledBrowser):
+        """Forget a browser (disconnected or closed)."""
+        if entry in self._browsers:
+            self._browsers.remove(entry)
+
+    async def _close_browser(self, entry: PooledBrowser):
+        """Close a retired browser (already removed from the pool)."""
+        self._recycles += 1
+        print(f"[BrowserPool] Recycling browser after {entry.pages_served} pages")
+        try:
+            await entry.browser.close()
+        except Exception as e:
+            print(f"[BrowserPool] Error closing browser: {str(e)[:100]}")
+
+    async def _acquire_browser(self) -> PooledBrowser:
+        """Pick the least busy healthy browser, launching one if needed."""
+        async with self._lock:
+            memory_mb = get_container_memory_mb()
+            if memory_mb is not None and memory_mb > self.memory_limit_mb:
+                for entry in self._browsers:
+                    if not entry.retiring and entry.pages_served >= PLAYWRIGHT_MIN_PAGES_BEFORE_RECYCLE:
+                        print(f"[BrowserPool] Memory {memory_mb:.0f}MB > {self.memory_limit_mb}MB: recycling browser")
+                        entry.retiring = True
+
+            # Idle retired browsers get no _release_browser call: close them now,
+            # before launching a replacement, so memory is freed first
+            for entry in [b for b in self._browsers if b.retiring and b.active_contexts <= 0]:
+                self._drop(entry)
+                await self._close_browser(entry)
+
+            healthy = [b for b in self._browsers if not b.retiring and b.browser.is_connected()]
+            if not healthy or (len(healthy) < self.max_browsers and all(b.active_contexts for b in healthy)):
+                entry = await self._launch()
+            else:
+                entry = min(healthy, key=lambda b: b.active_contexts)
+
+            entry.active_contexts += 1
+            entry.pages_served += 1
+            if entry.pages_served >= self.pages_per_browser:
+                entry.retiring = True
+            return entry
+
+    async def _release_browser(self, entry: PooledBrowser):
+        """Release a browser; close it if retiring and idle."""
+        async with self._lock:
+            entry.active_contexts -= 1
+            if not (entry.retiring and entry.active_contexts <= 0):
+                return
+            self._drop(entry)
+        await self._close_browser(entry)
+
+    @asynccontextmanager
+    async def context(self, ctx_args: dict):
+        """Yield a fresh stealth BrowserContext from a pooled browser."""
+        from playwright_stealth import Stealth
+
+        async with self._semaphore:
+            entry = await self._acquire_browser()
+            context = None
+            try:
+                context = await entry.browser.new_context(**ctx_args)
+                await Stealth().apply_stealth_async(context)
+                self._contexts_served += 1
+                _count_metric("playwright_contexts")
+                yield context
+            finally:
+                if context is not None:
+                    try:
+                        await context.close()
+                    except Exception:
+                        pass
+                await self._release_browser(entry)
+
+    def get_stats(self) -> dict:
+        """Get pool metrics."""
+        return {
+            "browsers": len(self._browsers),
+            "launches": self._launches,
+            "recycles": self._recycles,
+            "contexts_served": self._contexts_served,
+        }
+
+    async def close(self):
+        """Close all browsers and the Playwright driver (container shutdown hook)."""
+        async with self._lock:
+            browsers = list(self._browsers)
+            self._browsers.clear()
+        for entry in browsers:
+            try:
+                await entry.browser.close()
+            except Exception:
+                pass
+        if self._playwright is not None:
+            await self._playwright.stop()
+            self._playwright = None
+        print(f"[BrowserPool] Closed. Stats: {self.get_stats()}")
+
+
+# Global browser pool - created once per container
+_browser_pool: Optional[BrowserPool] = None
+
+
+def get_browser_pool() -> BrowserPool:
+    """Get or create the container's browser pool."""
+    global _browser_pool
+    if _browser_pool is None:
+        _browser_pool = BrowserPool()
+    return _browser_pool
 
 
 # =============================================================================
 # Method 3: Playwright + Stealth (Async)
 # =============================================================================
 
-async def attempt_playwright_async(url: str, url_id: str) -> AttemptResult:
-    """Async Playwright scraping with stealth mode."""
-    from playwright.async_api import async_playwright
-    from playwright_stealth import Stealth
+async def attempt_playwright_async(url: str, url_id: str, screenshot: bool = True) -> AttemptResult:
+    """Async Playwright scraping with stealth mode (pooled browser, screenshot=False skips the capture)."""
     from urllib.parse import urlparse, unquote
 
     popup_blocker = """
@@ -1528,26 +3857,17 @@ async def attempt_playwright_async(url: str, url_id: str) -> AttemptResult:
             "password": unquote(p.password) if p.password else None,
         }
 
-    try:
-        async with async_playwright() as p:
-            print(f"[{url_id}] Playwright: Launching browser...")
-            browser = await p.chromium.launch(
-                headless=True,
-                args=['--no-sandbox', '--disable-setuid-sandbox', '--disable-dev-shm-usage', '--disable-gpu']
-            )
-
-            ctx_args = {
-                'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 Chrome/131.0.0.0 Safari/537.36',
-                'viewport': {'width': 1920, 'height': 1080},
-                'locale': 'pt-BR',
-                'timezone_id': 'America/Sao_Paulo',
-            }
-            if proxy_config:
-                ctx_args['proxy'] = proxy_config
-
-            context = await browser.new_context(**ctx_args)
-            await Stealth().apply_stealth_async(context)
+    ctx_args = {
+        'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 Chrome/131.0.0.0 Safari/537.36',
+        'viewport': {'width': 1920, 'height': 1080},
+        'locale': 'pt-BR',
+        'timezone_id': 'America/Sao_Paulo',
+    }
+    if proxy_config:
+        ctx_args['proxy'] = proxy_config
 
+    try:
+        async with get_browser_pool().context(ctx_args) as context:
             page = await context.new_page()
             page.on("dialog", lambda d: asyncio.create_task(d.dismiss()))
 
@@ -1567,8 +3887,6 @@ async def attempt_playwright_async(url: str, url_id: str) -> AttemptResult:
             print(f"[{url_id}] Playwright: HTML {len(html_content):,} bytes")
 
             if len(html_content) < MIN_HTML_SIZE:
-                await context.close()
-                await browser.close()
                 return AttemptResult(
                     success=False,
                     error=f"Playwright HTML too small ({len(html_content)} bytes)",
@@ -1577,6 +3895,8 @@ async def attempt_playwright_async(url: str, url_id: str) -> AttemptResult:
 
             # Screenshot
             screenshot_bytes = None
+            if not screenshot:
+                return AttemptResult(success=True, html=html_content, method=METHOD_PLAYWRIGHT)
             try:
                 await page.evaluate(popup_blocker)
                 await asyncio.sleep(0.5)
@@ -1585,9 +3905,6 @@ async def attempt_playwright_async(url: str, url_id: str) -> AttemptResult:
             except Exception as e:
                 print(f"[{url_id}] Playwright screenshot error: {str(e)[:50]}")
 
-            await context.close()
-            await browser.close()
-
             return AttemptResult(
                 success=True,
                 html=html_content,
@@ -1600,161 +3917,541 @@ async def attempt_playwright_async(url: str, url_id: str) -> AttemptResult:
 
 
 # =============================================================================
-# Gemini Extraction (Async)
+# Screenshot Policy (lazy / on-demand capture)
 # =============================================================================
+#
+# Screenshots are the most expensive bytes in the pipeline (a second Bright
+# Data request, a Firecrawl download, a full-page Playwright capture). The
+# policy decides whether the fetch captures one:
+#   always        - capture with every fetch (previous behavior)
+#   alert         - capture only for items with hasAlert / alertsEnabled
+#   price_changed - fetch HTML only; capture on demand when the extracted
+#                   price differs from the last stored screenshot
+#   error         - fetch HTML only; capture on demand when extraction fails
+# Resolved per item: screenshotPolicy, then the job's policy, then
+# SCREENSHOT_POLICY.
+
+SCREENSHOT_POLICY_ALWAYS = "always"
+SCREENSHOT_POLICY_ALERT = "alert"
+SCREENSHOT_POLICY_PRICE_CHANGED = "price_changed"
+SCREENSHOT_POLICY_ERROR = "error"
+SCREENSHOT_POLICIES = (
+    SCREENSHOT_POLICY_ALWAYS, SCREENSHOT_POLICY_ALERT,
+    SCREENSHOT_POLICY_PRICE_CHANGED, SCREENSHOT_POLICY_ERROR,
+)
+DEFAULT_SCREENSHOT_POLICY = SCREENSHOT_POLICY_ALWAYS
+
+
+def parse_screenshot_policy(value: Any) -> Optional[str]:
+    """Normalize a policy value ("price-changed" -> "price_changed"), None if unknown."""
+    if not isinstance(value, str):
+        return None
+    policy = value.lower().strip().replace("-", "_")
+    return policy if policy in SCREENSHOT_POLICIES else None
+
+
+def get_screenshot_policy(item: Optional[dict] = None) -> str:
+    """Screenshot policy for an item: screenshotPolicy, then the job's (_screenshotPolicy), then SCREENSHOT_POLICY."""
+    item = item or {}
+    return (
+        parse_screenshot_policy(item.get("screenshotPolicy"))
+        or parse_screenshot_policy(item.get("_screenshotPolicy"))
+        or parse_screenshot_policy(os.environ.get("SCREENSHOT_POLICY"))
+        or DEFAULT_SCREENSHOT_POLICY
+    )
+
+
+def wants_inline_screenshot(policy: str, initial_data: Optional[dict] = None) -> bool:
+    """Whether the fetch itself should capture a screenshot under this policy."""
+    if policy == SCREENSHOT_POLICY_ALWAYS:
+        return True
+    if policy == SCREENSHOT_POLICY_ALERT:
+        initial_data = initial_data or {}
+        return bool(initial_data.get("hasAlert") or initial_data.get("alertsEnabled"))
+    return False
+
 
-def repair_truncated_json(text: str) -> str:
+async def capture_screenshot_async(method_key: str, url: str, url_id: str) -> Optional[bytes]:
     """
-    Attempt to repair truncated or malformed JSON.
+    On-demand screenshot after an HTML-only fetch, with the method that fetched it.
 
-    Common issues:
-    - Truncated at end (missing closing braces)
-    - Trailing commas
-    - Incomplete string values
+    Bright Data and Firecrawl make a screenshot-only request; Playwright
+    loads the page again.
     """
-    text = text.strip()
+    print(f"[{url_id}] Capturing screenshot on demand ({method_key})...")
+    try:
+        if method_key == METHOD_BRIGHTDATA:
+            return await fetch_brightdata_screenshot(url, url_id)
+        if method_key == METHOD_FIRECRAWL:
+            return await fetch_firecrawl_screenshot(url, url_id)
+        if method_key == METHOD_PLAYWRIGHT:
+            return (await attempt_playwright_async(url, url_id)).screenshot_bytes
+    except Exception as e:
+        print(f"[{url_id}] On-demand screenshot error: {str(e)[:100]}")
+    return None
+
 
-    # Remove markdown code blocks
-    if text.startswith('```'):
-        lines = text.split('\n')
-        # Remove first line (```json or ```)
-        lines = lines[1:]
-        # Remove last line if it's ```
-        if lines and lines[-1].strip() == '```':
-            lines = lines[:-1]
-        text = '\n'.join(lines)
+# =============================================================================
+# Gemini Extraction (Async)
+# =============================================================================
 
-    # Remove any trailing ``` that might be in the middle
-    if '```' in text:
-        text = text.split('```')[0]
+# Product fields extracted from the page (ScrapeResult attribute -> prompt description).
+# The Gemini response schema is derived from these plus the ScrapeResult types.
+PRODUCT_FIELD_DESCRIPTIONS = {
+    "productTitle": "Product name/title",
+    "brand": "Brand name",
+    "currentPrice": "Current/discounted price (the price the customer pays now)",
+    "originalPrice": "Original/regular price before discount",
+    "discountPercentage": "Discount percentage",
+    "currency": "Currency symbol (e.g. \"R$\", \"$\", \"€\")",
+    "availability": "True if the product is in stock",
+    "product_image_url": "Main product image URL",
+    "seller": "Seller name",
+    "shippingInfo": "Shipping information text",
+    "shippingCost": "Shipping cost",
+    "deliveryTime": "Estimated delivery time",
+    "review_score": "Review rating",
+    "installmentOptions": "Payment installment info (e.g. \"10x de R$ 15,90\")",
+    "kit": "True if this is a kit/bundle",
+    "unitMeasurement": "Product unit/size (e.g. \"100ml\", \"500g\")",
+    "outOfStockReason": "Reason if the product is not available",
+    "marketplaceWebsite": "Website/marketplace name (e.g. \"Amazon\", \"Mercado Livre\")",
+    "sku": "Product SKU code",
+    "ean": "Product EAN/barcode",
+    "stockQuantity": "Quantity in stock",
+    "otherPaymentMethods": "Other payment methods (e.g. \"PIX, Boleto\")",
+    "promotionDetails": "Promotion details",
+}
+PRODUCT_FIELDS = tuple(PRODUCT_FIELD_DESCRIPTIONS)
 
-    text = text.strip()
+_SCHEMA_TYPES = {str: "STRING", float: "NUMBER", int: "INTEGER", bool: "BOOLEAN"}
 
-    # Count braces to check if truncated
-    open_braces = text.count('{')
-    close_braces = text.count('}')
-    open_brackets = text.count('[')
-    close_brackets = text.count(']')
 
-    # If truncated, try to fix
-    if open_braces > close_braces or open_brackets > close_brackets:
-        # Remove incomplete last line (often truncated mid-value)
-        lines = text.rstrip().split('\n')
+def build_extraction_schema() -> dict:
+    """
+    Gemini response schema for PRODUCT_FIELDS, typed from ScrapeResult.
 
-        # Check if last line is incomplete (no comma or closing brace)
-        while lines:
-            last_line = lines[-1].strip()
-            # If line ends properly, stop
-            if last_line.endswith((',', '{', '[', '}', ']', 'true', 'false', 'null')) or \
-               (last_line.endswith('"') and ':' not in last_line):
-                break
-            # If line has unclosed string, remove it
-            if last_line.count('"') % 2 != 0:
-                lines.pop()
-                continue
-            # If line doesn't end with proper JSON, remove it
-            if not any(last_line.endswith(c) for c in (',', '{', '[', '}', ']', '"', '0', '1', '2', '3', '4', '5', '6', '7', '8', '9', 'true', 'false', 'null')):
-                lines.pop()
-                continue
-            break
+    Every field is nullable, so Gemini returns null instead of guessing, and
+    numbers/booleans come back typed (no string prices to coerce downstream).
+    """
+    annotations = {f.name: f.type for f in fields(ScrapeResult)}
+    properties = {}
+    for name, description in PRODUCT_FIELD_DESCRIPTIONS.items():
+        base = next((t for t in get_args(annotations[name]) if t is not type(None)), str)
+        properties[name] = {
+            "type": _SCHEMA_TYPES.get(base, "STRING"),
+            "description": description,
+            "nullable": True,
+        }
+    return {"type": "OBJECT", "properties": properties, "propertyOrdering": list(PRODUCT_FIELDS)}
 
-        text = '\n'.join(lines)
 
-        # Remove trailing comma before adding closing braces
-        text = text.rstrip()
-        if text.endswith(','):
-            text = text[:-1]
+# Global Gemini client - created once per container
+_gemini_client = None
+_gemini_slots: Optional[asyncio.Semaphore] = None
+_gemini_warmup_task: Optional[asyncio.Task] = None
 
-        # Add missing closing braces/brackets
-        open_braces = text.count('{')
-        close_braces = text.count('}')
-        open_brackets = text.count('[')
-        close_brackets = text.count(']')
 
-        text += ']' * (open_brackets - close_brackets)
-        text += '}' * (open_braces - close_braces)
+def get_gemini_client():
+    """
+    Get or create the container's Gemini client (reused across all URLs).
 
-    # Remove trailing commas before closing braces (common JSON error)
-    text = re.sub(r',(\s*[}\]])', r'\1', text)
+    The async transport keeps a pooled HTTP/2 connection to the endpoint, so
+    only the first extraction in a container pays for TLS setup.
 
-    return text
+    Returns:
+        Tuple of (client, error_message)
+    """
+    global _gemini_client
 
+    if _gemini_client is not None:
+        return _gemini_client, None
 
-async def extract_product_data_async(html_content: str, url: str, url_id: str) -> Tuple[Optional[dict], Optional[str]]:
-    """Extract product data using async Gemini."""
+    import httpx
     from google import genai
     from google.genai import types
 
+    api_key = os.environ.get("GEMINI_API_KEY")
+    if not api_key:
+        return None, "GEMINI_API_KEY not set"
+
     try:
-        cleaned_html, stats = clean_html(html_content)
-        print(f"[{url_id}] HTML cleaned: {stats['reduction_pct']}% reduction")
+        http_options = types.HttpOptions(
+            api_version='v1beta',
+            async_client_args={
+                "http2": True,
+                "limits": httpx.Limits(
+                    max_connections=GEMINI_MAX_CONNECTIONS,
+                    max_keepalive_connections=GEMINI_MAX_CONNECTIONS,
+                    keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+                ),
+            },
+        )
+    except Exception:
+        # Older google-genai without async_client_args: default transport
+        http_options = types.HttpOptions(api_version='v1beta')
 
-        api_key = os.environ.get("GEMINI_API_KEY")
-        if not api_key:
-            return None, "GEMINI_API_KEY not set"
+    _gemini_client = genai.Client(api_key=api_key, http_options=http_options)
+    print("[Gemini] Client created")
+    return _gemini_client, None
 
-        client = genai.Client(
-            api_key=api_key,
-            http_options=types.HttpOptions(api_version='v1beta')
-        )
 
-        prompt = f"""Analyze this HTML content from a product page and extract product information.
+def get_gemini_slots() -> asyncio.Semaphore:
+    """Per-container Gemini concurrency limit (GEMINI_MAX_IN_FLIGHT, default: 20)."""
+    global _gemini_slots
+    if _gemini_slots is None:
+        try:
+            limit = int(os.environ.get("GEMINI_MAX_IN_FLIGHT", DEFAULT_GEMINI_MAX_IN_FLIGHT))
+        except ValueError:
+            limit = DEFAULT_GEMINI_MAX_IN_FLIGHT
+        _gemini_slots = asyncio.Semaphore(max(1, limit))
+    return _gemini_slots
 
-URL: {url}
 
-HTML Content:
-{cleaned_html[:50000]}
-
-Extract and return a JSON object with these fields:
-- productTitle: Product name/title
-- brand: Brand name if found
-- currentPrice: Current/discounted price as a number (the price the customer pays now)
-- originalPrice: Original/regular price as a number (before discount, if any)
-- discountPercentage: Discount percentage if any, as a number
-- currency: Currency symbol (e.g., "R$", "$", "€")
-- availability: Boolean indicating if product is in stock
-- seller: Seller name if found
-- shippingInfo: Shipping information text
-- shippingCost: Shipping cost as a number
-- deliveryTime: Estimated delivery time
-- installmentOptions: Payment installment info (e.g., "10x de R$ 15,90")
-- product_image_url: Main product image URL
-- review_score: Review rating if found
-- kit: Boolean if this is a kit/bundle
-- unitMeasurement: Product unit/size (e.g., "100ml", "500g")
-- outOfStockReason: Reason if product is not available
-- marketplaceWebsite: Website/marketplace name (e.g., "Amazon", "Mercado Livre")
-- sku: Product SKU code
-- ean: Product EAN/barcode
-- stockQuantity: Quantity in stock as a number
-- otherPaymentMethods: Other payment methods available (e.g., "PIX, Boleto")
-- promotionDetails: Promotion details if any
-
-IMPORTANT: Return ONLY valid JSON, no markdown, no explanation. Omit fields not found.
-Keep the response concise - only include fields with actual values."""
-
-        # Use async generate with higher token limit
+async def _warm_up_gemini():
+    start = time.time()
+    try:
+        client, error = get_gemini_client()
+        if error:
+            return
+        # Metadata lookup: opens the pooled connection without spending tokens
+        await client.aio.models.get(model=GEMINI_MODEL)
+        print(f"[Gemini] Warm-up done in {(time.time() - start) * 1000:.0f}ms")
+    except Exception as e:
+        print(f"[Gemini] Warm-up failed: {str(e)[:100]}")
+
+
+def warm_up_gemini():
+    """
+    Start the Gemini warm-up once per container (non-blocking).
+
+    Called when a container takes its first URL, so the connection is ready
+    by the time the page has been fetched.
+    """
+    global _gemini_warmup_task
+    if _gemini_warmup_task is None:
+        _gemini_warmup_task = asyncio.create_task(_warm_up_gemini())
+
+
+def get_extraction_cache_ttl() -> Optional[float]:
+    """Extraction cache TTL in seconds, or None when the cache is disabled."""
+    if os.environ.get("EXTRACTION_CACHE_ENABLED", "true").lower() not in ("true", "1", "yes"):
+        return None
+    try:
+        ttl = float(os.environ.get("EXTRACTION_CACHE_TTL", DEFAULT_EXTRACTION_CACHE_TTL))
+    except ValueError:
+        ttl = DEFAULT_EXTRACTION_CACHE_TTL
+    return ttl if ttl > 0 else None
+
+
+class ExtractionCache:
+    """
+    Gemini results keyed by hash(prompt version, model, URL, cleaned HTML).
+
+    A small in-container LRU sits in front of a shared modal.Dict. Entries
+    older than the TTL are ignored (and dropped) on read; the shared store
+    itself evicts entries that are not accessed for a week, which gives LRU
+    behaviour across containers without a separate sweeper.
+    """
+
+    def __init__(self, store=None, local_size: int = EXTRACTION_CACHE_LOCAL_SIZE):
+        self._store = store
+        self._local: OrderedDict = OrderedDict()  # key -> entry
+        self._local_size = local_size
+
+    def _get_store(self):
+        if self._store is None:
+            self._store = modal.Dict.from_name(EXTRACTION_CACHE_DICT, create_if_missing=True)
+        return self._store
+
+    @staticmethod
+    def make_key(url: str, cleaned_html: str) -> str:
+        digest = hashlib.sha256()
+        for part in (GEMINI_PROMPT_VERSION, GEMINI_MODEL, url, cleaned_html):
+            digest.update(part.encode("utf-8", errors="replace"))
+            digest.update(b"\x00")
+        return digest.hexdigest()
+
+    def _remember(self, key: str, entry: dict):
+        self._local[key] = entry
+        self._local.move_to_end(key)
+        while len(self._local) > self._local_size:
+            self._local.popitem(last=False)
+
+    async def get(self, key: str, ttl: float) -> Optional[dict]:
+        """Cached extraction for key, or None if missing/expired/unavailable."""
+        entry = self._local.get(key)
+        if entry is None:
+            try:
+                entry = await self._get_store().get.aio(key)
+            except Exception as e:
+                print(f"[ExtractionCache] Read error: {str(e)[:100]}")
+                return None
+        if not entry:
+            return None
+        if time.time() - entry.get("cachedAt", 0) > ttl:
+            self._local.pop(key, None)
+            try:
+                await self._get_store().pop.aio(key, None)
+            except Exception:
+                pass
+            return None
+        self._remember(key, entry)
+        return dict(entry["data"])
+
+    async def put(self, key: str, data: dict):
+        """Store a successful extraction (failures are never cached)."""
+        entry = {"data": data, "cachedAt": time.time()}
+        self._remember(key, entry)
+        try:
+            await self._get_store().put.aio(key, entry)
+        except Exception as e:
+            print(f"[ExtractionCache] Write error: {str(e)[:100]}")
+
+
+# Global extraction cache - created once per container
+_extraction_cache: Optional[ExtractionCache] = None
+
+
+def get_extraction_cache() -> ExtractionCache:
+    """Get or create the container's extraction cache."""
+    global _extraction_cache
+    if _extraction_cache is None:
+        _extraction_cache = ExtractionCache()
+    return _extraction_cache
+
+
+def _product_fields_only(item: dict) -> dict:
+    return {k: v for k, v in item.items() if k in PRODUCT_FIELDS and v is not None}
+
+
+async def _generate_json(prompt: str, schema: dict, max_output_tokens: int, slot_id: str):
+    """Run one schema-constrained Gemini request and return the parsed JSON."""
+    from google.genai import types
+
+    client, error = get_gemini_client()
+    if error:
+        raise RuntimeError(error)
+
+    async with get_gemini_slots(), get_cluster_limiter().slot(PROVIDER_GEMINI, slot_id):
         response = await client.aio.models.generate_content(
-            model='gemini-2.5-flash',
+            model=GEMINI_MODEL,
             contents=prompt,
-            config=types.GenerateContentConfig(temperature=0.1, max_output_tokens=8192)
+            config=types.GenerateContentConfig(
+                temperature=0.1,
+                max_output_tokens=max_output_tokens,
+                thinking_config=types.ThinkingConfig(thinking_budget=GEMINI_THINKING_BUDGET),
+                response_mime_type="application/json",
+                response_schema=schema,
+            )
         )
 
-        text = response.text.strip()
+    finish_reason = response.candidates[0].finish_reason if response.candidates else None
+    if finish_reason == types.FinishReason.MAX_TOKENS:
+        raise RuntimeError(f"Gemini output truncated at max_output_tokens={max_output_tokens}")
+    text = response.text or ""
+    if not text:
+        raise RuntimeError(f"Gemini returned no text (finish_reason={finish_reason})")
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        print(f"[{slot_id}] Gemini raw response: {text[:500]}")
+        raise
 
-        # Try to repair truncated/malformed JSON
-        repaired_text = repair_truncated_json(text)
 
+async def generate_extraction(url_id: str, url: str, cleaned_html: str) -> dict:
+    """Extract one page with Gemini (raises on API/JSON errors)."""
+    prompt = f"""Analyze this HTML content from a product page and extract the product information.
+
+URL: {url}
+
+HTML Content:
+{cleaned_html}
+
+Prices and costs are plain numbers (e.g. 1299.9). Use null for anything not on the page."""
+
+    data = await _generate_json(prompt, build_extraction_schema(), GEMINI_MAX_OUTPUT_TOKENS, url_id)
+    return _product_fields_only(data)
+
+
+async def generate_extraction_batch(pages: List[Tuple[str, str, str]]) -> dict:
+    """
+    Extract several pages in one Gemini request.
+
+    Args:
+        pages: (url_id, url, cleaned_html) tuples
+
+    Returns:
+        Dict of url_id -> product data for the pages present in the response
+    """
+    sections = "\n\n".join(
+        f"=== PAGE urlId={url_id} ===\nURL: {url}\n\n{cleaned_html}"
+        for url_id, url, cleaned_html in pages
+    )
+    prompt = f"""Below are {len(pages)} product pages, each starting with a "=== PAGE urlId=... ===" header.
+For EACH page, extract the product information from that page only and return one array item
+with its urlId. Prices and costs are plain numbers (e.g. 1299.9). Use null for anything not on the page.
+
+{sections}"""
+
+    item_schema = build_extraction_schema()
+    item_schema = {
+        **item_schema,
+        "properties": {"urlId": {"type": "STRING"}, **item_schema["properties"]},
+        "required": ["urlId"],
+        "propertyOrdering": ["urlId", *item_schema["propertyOrdering"]],
+    }
+    schema = {"type": "ARRAY", "items": item_schema}
+
+    items = await _generate_json(prompt, schema, GEMINI_MAX_OUTPUT_TOKENS * len(pages), pages[0][0])
+    expected = {url_id for url_id, _, _ in pages}
+    return {
+        item["urlId"]: _product_fields_only(item)
+        for item in items
+        if isinstance(item, dict) and item.get("urlId") in expected
+    }
+
+
+class GeminiBatcher:
+    """
+    Micro-batching queue for Gemini extraction (one per scrape_url container).
+
+    Pages wait up to max_wait for company; a batch is sent as soon as it
+    reaches max_items or the token budget. Pages missing from a batch
+    response (or a failed batch) fall back to a single-page request.
+
+    The batch task runs in the context of whichever submit flushed it, so
+    per-URL metrics are routed explicitly: a batch request's counters are
+    split evenly over its pages, and a fallback request is charged to its
+    own page.
+    """
+
+    def __init__(self, max_items: int, token_budget: int, max_wait: float):
+        self.max_items = max_items
+        self.token_budget = token_budget
+        self.max_wait = max_wait
+        self._pending: List[tuple] = []   # (url_id, url, cleaned_html, future, metrics)
+        self._pending_tokens = 0
+        self._timer: Optional[asyncio.Task] = None
+        self._tasks: set = set()
+        self.batches_sent = 0
+        self.pages_batched = 0
+
+    async def submit(self, url_id: str, url: str, cleaned_html: str) -> Tuple[dict, bool]:
+        """
+        Queue a page for extraction.
+
+        Returns (data, batched) where batched is False when the page was
+        extracted by a single-page request (alone or as a fallback).
+        """
+        tokens = estimate_tokens(cleaned_html)
+        if self._pending and self._pending_tokens + tokens > self.token_budget:
+            self._flush()
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((url_id, url, cleaned_html, future, _scrape_metrics.get()))
+        self._pending_tokens += tokens
+
+        if len(self._pending) >= self.max_items or self._pending_tokens >= self.token_budget:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_after_wait())
+
+        return await future
+
+    async def _flush_after_wait(self):
+        await asyncio.sleep(self.max_wait)
+        self._timer = None
+        self._flush()
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending, self._pending_tokens = self._pending, [], 0
+        if batch:
+            task = asyncio.create_task(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: List[tuple]):
+        results: dict = {}
+        if len(batch) > 1:
+            batch_metrics: dict = {}
+            _scrape_metrics.set(batch_metrics)  # Task-local: not the flushing URL's metrics
+            try:
+                results = await generate_extraction_batch([(u, url, html) for u, url, html, _, _ in batch])
+                self.batches_sent += 1
+                self.pages_batched += len(results)
+                print(f"[GeminiBatcher] {len(results)}/{len(batch)} pages extracted in one request")
+            except Exception as e:
+                print(f"[GeminiBatcher] Batch of {len(batch)} failed, falling back per page: {str(e)[:100]}")
+            _share_metrics(batch_metrics, [metrics for *_, metrics in batch])
+
+        async def resolve(url_id: str, url: str, cleaned_html: str, future: asyncio.Future, metrics: Optional[dict]):
+            _scrape_metrics.set(metrics)  # Each resolve runs in its own task
+            if future.done():
+                return
+            if url_id in results:
+                future.set_result((results[url_id], True))
+                return
+            try:
+                future.set_result((await generate_extraction(url_id, url, cleaned_html), False))
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+
+        await asyncio.gather(*(resolve(*item) for item in batch))
+
+
+# Global Gemini batcher - created once per container (None when disabled)
+_gemini_batcher: Optional[GeminiBatcher] = None
+
+
+def get_gemini_batcher() -> Optional[GeminiBatcher]:
+    """Get the container's Gemini batcher, or None unless GEMINI_BATCH_ENABLED=true."""
+    global _gemini_batcher
+    if os.environ.get("GEMINI_BATCH_ENABLED", "false").lower() not in ("true", "1", "yes"):
+        return None
+    if _gemini_batcher is None:
         try:
-            data = json.loads(repaired_text)
-        except json.JSONDecodeError:
-            # If repair failed, try original text with basic cleanup
-            text_clean = text.strip()
-            if text_clean.startswith('```'):
-                text_clean = '\n'.join(text_clean.split('\n')[1:])
-            if text_clean.endswith('```'):
-                text_clean = text_clean[:-3]
-            data = json.loads(text_clean)
+            max_items = int(os.environ.get("GEMINI_BATCH_MAX_ITEMS", DEFAULT_GEMINI_BATCH_MAX_ITEMS))
+            token_budget = int(os.environ.get("GEMINI_BATCH_TOKEN_BUDGET", DEFAULT_GEMINI_BATCH_TOKEN_BUDGET))
+            max_wait = float(os.environ.get("GEMINI_BATCH_MAX_WAIT", DEFAULT_GEMINI_BATCH_MAX_WAIT))
+        except ValueError:
+            max_items = DEFAULT_GEMINI_BATCH_MAX_ITEMS
+            token_budget = DEFAULT_GEMINI_BATCH_TOKEN_BUDGET
+            max_wait = DEFAULT_GEMINI_BATCH_MAX_WAIT
+        _gemini_batcher = GeminiBatcher(max(1, max_items), token_budget, max_wait)
+        print(f"[GeminiBatcher] Enabled: {max_items} pages, {token_budget} tokens, {max_wait}s max wait")
+    return _gemini_batcher
+
+
+async def extract_product_data_async(html_content: str, url: str, url_id: str) -> Tuple[Optional[dict], Optional[str]]:
+    """Extract product data using async Gemini (cached by cleaned HTML)."""
+    try:
+        cleaned_html, stats = await run_cpu_bound(clean_html, html_content)
+        print(f"[{url_id}] HTML cleaned: {stats['reduction_pct']}% reduction, ~{stats['tokens']} tokens "
+              f"({', '.join(f'{k}={v}' for k, v in stats['section_tokens'].items())}; "
+              f"{stats['dropped_tokens']} dropped)")
+
+        cache_ttl = get_extraction_cache_ttl()
+        cache_key = None
+        if cache_ttl:
+            cache_key = ExtractionCache.make_key(url, cleaned_html[:GEMINI_MAX_HTML_CHARS])
+            cached = await get_extraction_cache().get(cache_key, cache_ttl)
+            if cached is not None:
+                _count_metric("extract_cache_hits")
+                print(f"[{url_id}] Extraction cache hit: skipping Gemini")
+                return cached, None
+            _count_metric("extract_cache_misses")
+
+        batcher = get_gemini_batcher()
+        if batcher:
+            data, batched = await batcher.submit(url_id, url, cleaned_html[:GEMINI_MAX_HTML_CHARS])
+            _count_metric("extract_gemini_batched" if batched else "extract_gemini_single")
+        else:
+            data = await generate_extraction(url_id, url, cleaned_html[:GEMINI_MAX_HTML_CHARS])
 
         # Debug: show what Gemini extracted
         print(f"[{url_id}] Gemini extracted: {json.dumps(data, ensure_ascii=False)[:500]}")
@@ -1763,15 +4460,100 @@ Keep the response concise - only include fields with actual values."""
             # Return partial data with error for debugging
             return None, f"Could not extract price. Got: {json.dumps(data, ensure_ascii=False)[:200]}"
 
+        if cache_key:
+            await get_extraction_cache().put(cache_key, data)
+
         return data, None
 
     except json.JSONDecodeError as e:
-        print(f"[{url_id}] Gemini raw response: {text[:500] if 'text' in dir() else 'N/A'}")
         return None, f"JSON error: {str(e)[:100]}"
     except Exception as e:
         return None, f"Extraction error: {str(e)[:200]}"
 
 
+async def extract_product(html_content: str, url: str, url_id: str) -> Tuple[Optional[dict], Optional[str]]:
+    """
+    Extract product data, preferring structured data and domain templates over Gemini.
+
+    1. Structured data with all required fields: Gemini is skipped.
+    2. A learned domain template that yields a sane price: Gemini is skipped
+       (except for a verification sample). The template covers TEMPLATE_FIELDS;
+       the other TEMPLATE_REQUIRED_FIELDS (availability) must come from the
+       page's structured data, otherwise Gemini runs.
+    3. Otherwise Gemini runs, its empty fields are filled from the structured
+       data, and the result is used to (re)learn the domain's template.
+    """
+    template_config = get_template_config()
+    domain = get_domain(url)
+    templates = get_domain_templates()
+    entry = await templates.get(domain) if template_config["enabled"] and domain else None
+    template_fields = (entry or {}).get("fields") or None
+    structured_enabled = is_structured_fast_path_enabled()
+
+    # One parse shared by structured data and the template
+    structured: dict = {}
+    template_data = None
+    if structured_enabled or template_fields:
+        try:
+            structured, sd_stats, template_data = await run_cpu_bound(
+                extract_page_fields, html_content, template_fields, structured_enabled
+            )
+        except Exception as e:
+            print(f"[{url_id}] Structured data / template error: {str(e)[:100]}")
+            structured, sd_stats = {}, {"sources": []}
+            template_data = {} if template_fields else None
+
+    if structured_enabled:
+        required = get_structured_required_fields()
+        if structured and all(structured.get(f) not in (None, "") for f in required):
+            _count_metric("extract_structured")
+            print(f"[{url_id}] Structured data hit ({', '.join(sd_stats['sources'])}): skipping Gemini")
+            return structured, None
+
+    if template_data is not None:
+        problem = check_template_result(template_data, structured)
+        if problem:
+            _count_metric("template_rejected")
+            print(f"[{url_id}] Template for {domain} rejected: {problem}")
+            template_data = None
+        else:
+            for key, value in [*structured.items(), *(entry.get("constants") or {}).items()]:
+                if template_data.get(key) in (None, ""):
+                    template_data[key] = value
+            missing = [f for f in template_config["required_fields"] if template_data.get(f) in (None, "")]
+            if missing:
+                # Fields only Gemini reads on this domain (e.g. availability
+                # without structured data): the template result is still
+                # compared with Gemini's below.
+                _count_metric("template_incomplete")
+                print(f"[{url_id}] Template for {domain} lacks {', '.join(missing)}: using Gemini")
+            elif random.random() >= template_config["verify_rate"]:
+                _count_metric("extract_template")
+                print(f"[{url_id}] Template hit for {domain}: skipping Gemini")
+                return template_data, None
+
+    _count_metric("extract_gemini")
+    data, error = await extract_product_data_async(html_content, url, url_id)
+    if data and structured:
+        for key, value in structured.items():
+            if data.get(key) in (None, ""):
+                data[key] = value
+
+    if data and template_config["enabled"] and domain:
+        if template_data is not None:
+            # Verification sample: template and Gemini must agree on the price
+            _count_metric("template_verified")
+            if not _values_match("currentPrice", template_data.get("currentPrice"), data.get("currentPrice")):
+                _count_metric("template_verify_failed")
+                print(f"[{url_id}] Template for {domain} disagrees with Gemini: re-learning")
+                await templates.forget(domain)
+                await templates.learn(domain, html_content, data, url_id)
+        else:
+            if await templates.learn(domain, html_content, data, url_id):
+                _count_metric("template_learned")
+    return data, error
+
+
 # =============================================================================
 # Input Data Helpers
 # =============================================================================
@@ -1966,11 +4748,75 @@ def get_retries_config() -> dict:
         except ValueError:
             return default
 
-    return {
-        METHOD_FIRECRAWL: get_retry_value("FIRECRAWL_RETRIES", DEFAULT_FIRECRAWL_RETRIES),
-        METHOD_BRIGHTDATA: get_retry_value("BRIGHTDATA_RETRIES", DEFAULT_BRIGHTDATA_RETRIES),
-        METHOD_PLAYWRIGHT: get_retry_value("PLAYWRIGHT_RETRIES", DEFAULT_PLAYWRIGHT_RETRIES),
-    }
+    return {
+        METHOD_FIRECRAWL: get_retry_value("FIRECRAWL_RETRIES", DEFAULT_FIRECRAWL_RETRIES),
+        METHOD_BRIGHTDATA: get_retry_value("BRIGHTDATA_RETRIES", DEFAULT_BRIGHTDATA_RETRIES),
+        METHOD_PLAYWRIGHT: get_retry_value("PLAYWRIGHT_RETRIES", DEFAULT_PLAYWRIGHT_RETRIES),
+    }
+
+
+def get_hedge_config() -> dict:
+    """
+    Get hedged fetch configuration from environment variables.
+
+    Environment variables:
+    - HEDGE_ENABLED: Start the next method while the current one is still running (default: false)
+    - HEDGE_DELAY_SECONDS: Fixed hedge delay. If unset, uses the observed p90 latency
+      of the current method (falls back to 20s until enough samples)
+    - HEDGE_MAX_IN_FLIGHT: Max hedged fetches in flight at once (default: 5)
+
+    Returns:
+        dict: enabled, delay (None = adaptive p90), max_in_flight
+    """
+    enabled = os.environ.get("HEDGE_ENABLED", "").lower() in ("true", "1", "yes")
+
+    delay = None
+    delay_env = os.environ.get("HEDGE_DELAY_SECONDS", "").strip()
+    if delay_env:
+        try:
+            delay = max(0.0, float(delay_env))
+        except ValueError:
+            pass
+
+    max_in_flight = DEFAULT_HEDGE_MAX_IN_FLIGHT
+    max_env = os.environ.get("HEDGE_MAX_IN_FLIGHT", "").strip()
+    if max_env:
+        try:
+            max_in_flight = max(1, int(max_env))
+        except ValueError:
+            pass
+
+    return {"enabled": enabled, "delay": delay, "max_in_flight": max_in_flight}
+
+
+# Per-container fetch latencies (seconds) for successful attempts, by method
+_method_latencies: dict = {}
+_hedge_slots: Optional[asyncio.Semaphore] = None
+
+
+def record_method_latency(method_key: str, elapsed: float):
+    """Record a successful fetch latency for hedge delay estimation."""
+    samples = _method_latencies.setdefault(method_key, deque(maxlen=HEDGE_LATENCY_WINDOW))
+    samples.append(elapsed)
+
+
+def get_hedge_delay(method_key: str, hedge_config: dict) -> float:
+    """Hedge delay for a method: fixed from config, else observed p90, else default."""
+    if hedge_config.get("delay") is not None:
+        return hedge_config["delay"]
+    samples = _method_latencies.get(method_key)
+    if not samples or len(samples) < HEDGE_MIN_SAMPLES:
+        return DEFAULT_HEDGE_DELAY
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * 0.9))]
+
+
+def get_hedge_slots(hedge_config: dict) -> asyncio.Semaphore:
+    """Get the container's hedge budget semaphore."""
+    global _hedge_slots
+    if _hedge_slots is None:
+        _hedge_slots = asyncio.Semaphore(hedge_config["max_in_flight"])
+    return _hedge_slots
 
 
 def parse_method_preference(method: Optional[str]) -> Optional[str]:
@@ -2078,21 +4924,196 @@ def get_max_concurrency() -> int:
     return get_config()["max_concurrency"]
 
 
+# =============================================================================
+# Domain Router (Adaptive per-domain method ordering)
+# =============================================================================
+#
+# Keeps per-domain, per-method counters learned from the attempts/errors/method
+# fields of each ScrapeResult, stored in a modal.Dict shared by all containers:
+#
+#   "drogaraia.com.br": {
+#       "methods": {
+#           "firecrawl":  {"attempts": 40, "fetched": 2,  "extracted": 1,  "fetch_ms": 3600000},
+#           "brightdata": {"attempts": 39, "fetched": 39, "extracted": 38, "fetch_ms": 780000},
+#       },
+#       "updatedAt": 1739999999999,
+#   }
+#
+# scrape_url orders methods so that the cheapest method likely to succeed goes
+# first, and methods that keep failing on a domain go last.
+
+def is_router_enabled() -> bool:
+    """Domain router toggle (DOMAIN_ROUTER_ENABLED, default: true)."""
+    return os.environ.get("DOMAIN_ROUTER_ENABLED", "true").lower() in ("true", "1", "yes")
+
+
+def get_domain(url: str) -> str:
+    """Normalized domain for routing (lowercase, without 'www.')."""
+    from urllib.parse import urlparse
+
+    host = (urlparse(url).hostname or "").lower()
+    return host[4:] if host.startswith("www.") else host
+
+
+def summarize_method_outcomes(result: dict) -> dict:
+    """
+    Derive per-method counters from a scrape result.
+
+    attempts:  entries in result['attempts'] for the method (retries included)
+    fetched:   attempts without a 'scrape' error for the method
+    extracted: 1 if the method produced the final completed result
+    fetch_ms:  total fetch time for the method (from result['metrics'])
+    """
+    attempts = result.get("attempts") or []
+    errors = result.get("errors") or []
+    metrics = result.get("metrics") or {}
+
+    outcomes = {}
+    for method_key, display_name in METHOD_DISPLAY_NAMES.items():
+        tried = sum(1 for a in attempts if a == display_name or a.startswith(f"{display_name} (retry"))
+        if not tried:
+            continue
+        failed = sum(1 for e in errors if e.get("method") == method_key and e.get("operation") == "scrape")
+        outcomes[method_key] = {
+            "attempts": tried,
+            "fetched": max(0, tried - failed),
+            "extracted": 1 if result.get("status") == "completed" and result.get("method") == method_key else 0,
+            "fetch_ms": metrics.get(f"{method_key}_fetch_ms", 0),
+        }
+    return outcomes
+
+
+class DomainRouter:
+    """
+    Per-domain method ordering backed by a shared modal.Dict.
+
+    Reads are cached per container for ROUTER_CACHE_TTL seconds. Writes are
+    done once per batch by the orchestrator (record_results), so scrape_url
+    containers only ever read.
+
+    modal.Dict has no atomic update, so record_results is a plain
+    get/modify/put: when several batches or shards finish at the same time,
+    one can overwrite another's counts for a shared domain. Updates are
+    therefore lossy. That is acceptable for routing hints (counts are halved
+    past ROUTER_MAX_SAMPLES anyway), but the stats are not exact totals.
+    """
+
+    def __init__(self, store=None):
+        self._store = store
+        self._cache: dict = {}  # domain -> (fetched_at, stats)
+
+    def _get_store(self):
+        if self._store is None:
+            self._store = modal.Dict.from_name(DOMAIN_STATS_DICT, create_if_missing=True)
+        return self._store
+
+    async def get_stats(self, domain: str) -> dict:
+        """Get stats for a domain (cached). Empty dict if unknown or store unavailable."""
+        cached = self._cache.get(domain)
+        if cached and time.time() - cached[0] < ROUTER_CACHE_TTL:
+            return cached[1]
+        try:
+            stats = await self._get_store().get.aio(domain) or {}
+        except Exception as e:
+            print(f"[DomainRouter] Stats read error for {domain}: {str(e)[:100]}")
+            stats = {}
+        self._cache[domain] = (time.time(), stats)
+        return stats
+
+    async def order_methods(self, url: str, default_order: List[str]) -> Tuple[List[str], str]:
+        """
+        Order methods for a URL.
+
+        Methods with enough samples and a good success rate go first (cheapest
+        first), then methods without enough data (default order), then methods
+        that keep failing on this domain (best success rate first).
+        """
+        domain = get_domain(url)
+        if not domain or random.random() < ROUTER_EXPLORE_RATE:
+            return default_order, "default"
+
+        methods = (await self.get_stats(domain)).get("methods") or {}
+        good, unknown, bad = [], [], []
+        for method_key in default_order:
+            stats = methods.get(method_key) or {}
+            attempts = stats.get("attempts", 0)
+            if attempts < ROUTER_MIN_SAMPLES:
+                unknown.append(method_key)
+                continue
+            rate = stats.get("extracted", 0) / attempts
+            (good if rate >= ROUTER_MIN_SUCCESS_RATE else bad).append((method_key, rate))
+
+        good.sort(key=lambda m: ROUTER_METHOD_COST.get(m[0], 99.0))
+        bad.sort(key=lambda m: -m[1])
+        order = [m for m, _ in good] + unknown + [m for m, _ in bad]
+
+        reason = ", ".join(f"{m}={r:.0%}" for m, r in good + bad) or "no data"
+        return order, f"{domain}: {reason}"
+
+    async def record_results(self, results: List[dict]):
+        """Merge per-method outcomes from a batch of results into the shared store (lossy, see class docstring)."""
+        deltas: dict = {}
+        for r in results:
+            domain = get_domain(r.get("productUrl") or "")
+            if not domain:
+                continue
+            domain_delta = deltas.setdefault(domain, {})
+            for method_key, outcome in summarize_method_outcomes(r).items():
+                method_delta = domain_delta.setdefault(method_key, {})
+                for key, value in outcome.items():
+                    method_delta[key] = method_delta.get(key, 0) + value
+
+        store = self._get_store()
+        updated = 0
+        for domain, domain_delta in deltas.items():
+            try:
+                stats = await store.get.aio(domain) or {}
+                methods = stats.setdefault("methods", {})
+                for method_key, delta in domain_delta.items():
+                    current = methods.setdefault(method_key, {})
+                    for key, value in delta.items():
+                        current[key] = current.get(key, 0) + value
+                    # Fade old outcomes so blocks that get lifted are noticed
+                    if current.get("attempts", 0) > ROUTER_MAX_SAMPLES:
+                        for key in current:
+                            current[key] = current[key] // 2
+                stats["updatedAt"] = int(time.time() * 1000)
+                await store.put.aio(domain, stats)
+                updated += 1
+            except Exception as e:
+                print(f"[DomainRouter] Stats write error for {domain}: {str(e)[:100]}")
+
+        print(f"[DomainRouter] Updated stats for {updated}/{len(deltas)} domains")
+
+
+# Global domain router - created once per container
+_domain_router: Optional[DomainRouter] = None
+
+
+def get_domain_router() -> DomainRouter:
+    """Get or create the container's domain router."""
+    global _domain_router
+    if _domain_router is None:
+        _domain_router = DomainRouter()
+    return _domain_router
+
+
 # Note: Modal decorators require static values at import time.
-# We use maximum possible values here and control actual concurrency via semaphore.
+# We use maximum possible values here and control actual concurrency via the worker pool.
 # This allows the same code to work for both Firecrawl (2 containers) and BrightData (50 containers).
 
 
 @app.function(
     image=scraper_image,
-    max_containers=50,   # Max possible (BrightData mode) - actual usage controlled by semaphore
+    max_containers=50,   # Max possible (BrightData mode) - actual usage controlled by worker pool
     memory=512,          # MB - enough for 20 concurrent scrapes
-    timeout=300,
+    timeout=SCRAPE_URL_TIMEOUT,
     retries=1,
     secrets=[modal.Secret.from_name("bausch")],
 )
-@modal.concurrent(max_inputs=20)  # Max possible - actual controlled by semaphore
-async def scrape_url(url_id: str, url: str, method: Optional[str] = None, initial_data: Optional[dict] = None) -> dict:
+@modal.concurrent(max_inputs=20)  # Max possible - actual controlled by worker pool
+async def scrape_url(url_id: str, url: str, method: Optional[str] = None, initial_data: Optional[dict] = None,
+                     screenshot_policy: Optional[str] = None) -> dict:
     """
     Scrape a single URL with 3-tier async fallback system.
 
@@ -2101,10 +5122,13 @@ async def scrape_url(url_id: str, url: str, method: Optional[str] = None, initia
         url: The URL to scrape
         method: Optional preferred method to try first (firecrawl, brightdata, playwright)
         initial_data: Optional dict with fields from input that override scraped data
+        screenshot_policy: Optional always / alert / price_changed / error (default: SCREENSHOT_POLICY)
     """
     config = get_config()
     primary = get_primary_scraper()
     retries_config = get_retries_config()
+    policy = parse_screenshot_policy(screenshot_policy) or get_screenshot_policy()
+    capture_inline = wants_inline_screenshot(policy, initial_data)
 
     # Check if user specified a method preference
     preferred_method = parse_method_preference(method)
@@ -2121,22 +5145,27 @@ async def scrape_url(url_id: str, url: str, method: Optional[str] = None, initia
     print(f"[{url_id}] Enabled methods: {', '.join(f'{m}({retries_config[m]})' for m in enabled_methods)}")
     if disabled_methods:
         print(f"[{url_id}] Disabled methods: {', '.join(disabled_methods)}")
+    if policy != SCREENSHOT_POLICY_ALWAYS:
+        print(f"[{url_id}] Screenshot policy: {policy} ({'inline' if capture_inline else 'on demand'})")
     print(f"{'='*60}")
 
     start_time = time.time()
+    metrics = {}
+    _scrape_metrics.set(metrics)
+    warm_up_gemini()
     result = ScrapeResult(
         urlId=url_id, url=url, status="error",
-        scrapedAt=int(time.time() * 1000), attempts=[], errors=[]
+        scrapedAt=int(time.time() * 1000), attempts=[], errors=[], metrics=metrics
     )
 
-    last_screenshot_url = None
+    last_screenshots = {}
     last_error = None
 
     # Define all methods with their functions
     all_methods = {
-        METHOD_FIRECRAWL: ("Firecrawl", attempt_firecrawl_async),
-        METHOD_BRIGHTDATA: ("Bright Data", attempt_brightdata_async),
-        METHOD_PLAYWRIGHT: ("Playwright", attempt_playwright_async),
+        METHOD_FIRECRAWL: (METHOD_DISPLAY_NAMES[METHOD_FIRECRAWL], attempt_firecrawl_async),
+        METHOD_BRIGHTDATA: (METHOD_DISPLAY_NAMES[METHOD_BRIGHTDATA], attempt_brightdata_async),
+        METHOD_PLAYWRIGHT: (METHOD_DISPLAY_NAMES[METHOD_PLAYWRIGHT], attempt_playwright_async),
     }
 
     # Check URL-based rules (e.g., Mercado Livre -> Bright Data)
@@ -2155,10 +5184,19 @@ async def scrape_url(url_id: str, url: str, method: Optional[str] = None, initia
     elif url_forced_brightdata:
         # URL pattern forces Bright Data first
         attempt_order = [METHOD_BRIGHTDATA, METHOD_FIRECRAWL, METHOD_PLAYWRIGHT]
-    elif primary == PRIMARY_BRIGHTDATA:
-        attempt_order = [METHOD_BRIGHTDATA, METHOD_FIRECRAWL, METHOD_PLAYWRIGHT]
     else:
-        attempt_order = [METHOD_FIRECRAWL, METHOD_BRIGHTDATA, METHOD_PLAYWRIGHT]
+        if primary == PRIMARY_BRIGHTDATA:
+            attempt_order = [METHOD_BRIGHTDATA, METHOD_FIRECRAWL, METHOD_PLAYWRIGHT]
+        else:
+            attempt_order = [METHOD_FIRECRAWL, METHOD_BRIGHTDATA, METHOD_PLAYWRIGHT]
+
+        # Reorder by what has worked for this domain before
+        if is_router_enabled():
+            routed_order, reason = await get_domain_router().order_methods(url, attempt_order)
+            if routed_order != attempt_order:
+                print(f"[{url_id}] Domain router: {' -> '.join(routed_order)} ({reason})")
+                _count_metric("router_reordered")
+            attempt_order = routed_order
 
     # Filter out methods with 0 retries (disabled methods)
     attempt_order = [m for m in attempt_order if retries_config.get(m, 0) > 0]
@@ -2171,14 +5209,15 @@ async def scrape_url(url_id: str, url: str, method: Optional[str] = None, initia
 
     attempt_methods = [(all_methods[m][0], all_methods[m][1], m) for m in attempt_order]
     total_methods = len(attempt_methods)
+    hedge_config = get_hedge_config()
+
+    async def fetch_with_retries(attempt_num: int, method_name: str, attempt_func, method_key: str) -> Optional[AttemptResult]:
+        """Run one method with its retries. Returns the successful AttemptResult or None."""
+        nonlocal last_error
 
-    for attempt_num, (method_name, attempt_func, method_key) in enumerate(attempt_methods, 1):
         # Get retry count from environment-based config
         max_retries = retries_config.get(method_key, 1)
 
-        attempt_result = None
-        method_succeeded = False
-
         for retry in range(max_retries):
             retry_suffix = f" (attempt {retry + 1}/{max_retries})" if max_retries > 1 else ""
             print(f"\n[{url_id}] === METHOD {attempt_num}/{total_methods}: {method_name}{retry_suffix} ===")
@@ -2188,8 +5227,12 @@ async def scrape_url(url_id: str, url: str, method: Optional[str] = None, initia
             else:
                 result.attempts.append(f"{method_name} (retry {retry})")
 
+            fetch_start = time.time()
             try:
-                attempt_result = await attempt_func(url, url_id)
+                attempt_result = await attempt_func(url, url_id, screenshot=capture_inline)
+                _count_metric(f"{method_key}_fetch_ms", int((time.time() - fetch_start) * 1000))
+                for timing_key, timing_ms in attempt_result.timings.items():
+                    _count_metric(f"{method_key}_{timing_key}", timing_ms)
             except Exception as e:
                 error_msg = f"{method_name} exception: {str(e)[:200]}"
                 print(f"[{url_id}] {method_name} exception: {str(e)[:100]}")
@@ -2211,59 +5254,258 @@ async def scrape_url(url_id: str, url: str, method: Optional[str] = None, initia
                 last_error = attempt_result.error
                 continue  # Try next retry if available
 
-            # Success! Break out of retry loop
-            method_succeeded = True
-            break
+            # Success! Record latency for hedge delay estimation
+            record_method_latency(method_key, time.time() - fetch_start)
+            return attempt_result
 
-        # If all retries failed, move to next method
-        if not method_succeeded:
-            continue
+        return None
 
-        # Process screenshot
-        screenshot_url = None
-        if attempt_result.screenshot_bytes:
+    async def fetch_hedged(attempt_num: int, primary_method: tuple, secondary_method: tuple) -> Tuple[Optional[AttemptResult], Optional[tuple]]:
+        """
+        Run primary method; if it has not finished after the hedge delay, start
+        the secondary method too and take whichever returns usable HTML first.
+
+        Returns (attempt_result, unused_method): unused_method is the method
+        that was not started or was cancelled as the loser, so the caller can
+        still fall back to it; None when both ran to completion.
+        """
+        primary_task = asyncio.create_task(fetch_with_retries(attempt_num, *primary_method))
+        delay = get_hedge_delay(primary_method[2], hedge_config)
+        done, _ = await asyncio.wait({primary_task}, timeout=delay)
+        if done:
+            return primary_task.result(), secondary_method
+
+        slots = get_hedge_slots(hedge_config)
+        if slots.locked():
+            print(f"[{url_id}] Hedge budget exhausted ({hedge_config['max_in_flight']} in flight), waiting on {primary_method[0]}")
+            _count_metric("hedges_skipped")
+            return await primary_task, secondary_method
+
+        # Cluster-wide hedge budget (HEDGE_GLOBAL_MAX_IN_FLIGHT), non-blocking
+        cluster_lease = None
+        global_limit = get_provider_limits()[PROVIDER_HEDGE]
+        if global_limit > 0:
             try:
-                compressed, stats = compress_image(attempt_result.screenshot_bytes, quality=85)
-                print(f"[{url_id}] Image compressed: {stats['reduction_percent']}%")
-                screenshot_url, err = await upload_to_r2_async(compressed, url_id)
-                if screenshot_url:
-                    print(f"[{url_id}] Screenshot uploaded: {screenshot_url}")
-                    last_screenshot_url = screenshot_url
-                elif err:
-                    print(f"[{url_id}] R2 error: {err}")
-                    result.errors.append({
-                        "method": "r2",
-                        "operation": "upload",
-                        "error": err
-                    })
+                cluster_lease = await get_cluster_limiter().try_acquire(PROVIDER_HEDGE, global_limit)
             except Exception as e:
-                print(f"[{url_id}] Screenshot error: {str(e)[:100]}")
+                print(f"[{url_id}] Hedge cluster budget unavailable: {str(e)[:100]}")
+                cluster_lease = ""  # Fail open
+            if cluster_lease is None:
+                print(f"[{url_id}] Cluster hedge budget exhausted ({global_limit} in flight), waiting on {primary_method[0]}")
+                _count_metric("hedges_skipped")
+                return await primary_task, secondary_method
+
+        await slots.acquire()
+        lease_keep_alive = (asyncio.create_task(get_cluster_limiter().keep_alive(PROVIDER_HEDGE, cluster_lease, url_id))
+                            if cluster_lease else None)
+        _count_metric("hedges_started")
+        print(f"[{url_id}] HEDGE: {primary_method[0]} still running after {delay:.1f}s, starting {secondary_method[0]}")
+        secondary_task = asyncio.create_task(fetch_with_retries(attempt_num + 1, *secondary_method))
+
+        try:
+            pending = {primary_task, secondary_task}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # Prefer the primary when both finish together
+                for task in sorted(done, key=lambda t: t is not primary_task):
+                    winner = task.result()
+                    if winner is not None:
+                        if task is secondary_task:
+                            _count_metric("hedges_won")
+                        loser_task, loser_method = (
+                            (secondary_task, secondary_method) if task is primary_task
+                            else (primary_task, primary_method)
+                        )
+                        print(f"[{url_id}] HEDGE: {winner.method} won, cancelling the other")
+                        # A loser still in flight is cancelled, not failed: keep it as a fallback
+                        return winner, (loser_method if not loser_task.done() else None)
+            return None, None
+        finally:
+            for task in (primary_task, secondary_task):
+                if not task.done():
+                    task.cancel()
+            slots.release()
+            if lease_keep_alive is not None:
+                lease_keep_alive.cancel()
+                try:
+                    await get_cluster_limiter().release(PROVIDER_HEDGE, cluster_lease)
+                except Exception as e:
+                    print(f"[{url_id}] Hedge cluster release error: {str(e)[:100]}")
+
+    async def process_screenshot(screenshot_bytes: bytes, method_key: str,
+                                 extraction: asyncio.Future) -> Optional[dict]:
+        """
+        Compress + upload a screenshot and its derivatives (runs alongside extraction).
+
+        Returns {result field: url} (screenshotUrl, screenshotViewportUrl,
+        screenshotThumbUrl) or None.
+
+        With dedupe on, a capture that matches the stored dHash for this urlId
+        reuses the previous URL once extraction confirms price/availability
+        are unchanged; otherwise the new upload is recorded in the index.
+        """
+        started = time.time()
+        profile = get_screenshot_profile()
+        max_distance = get_screenshot_dedupe_max_distance()
+        with_derivatives = is_screenshot_derivatives_enabled()
+        try:
+            # The dHash is computed inside compress_image from the image it
+            # decodes; a near-identical capture comes back unencoded.
+            dedupe = None
+            if max_distance is not None:
+                previous = await get_screenshot_index().get(url_id)
+                dedupe = ((previous or {}).get("dhash"), max_distance)
+            compressed, derivatives, stats = await run_cpu_bound(
+                compress_image, screenshot_bytes, profile, with_derivatives, dedupe
+            )
+            dhash = stats.get("dhash")
+            if compressed is None:
+                if ScreenshotIndex.same_product_state(previous, await extraction):
+                    _count_metric("screenshots_deduped")
+                    print(f"[{url_id}] Screenshot unchanged (dHash distance {stats['dhash_distance']:.3f}): "
+                          f"reusing {previous['screenshotUrl']}")
+                    return ScreenshotIndex.screenshot_urls(previous)
+                print(f"[{url_id}] Screenshot looks unchanged but price/availability changed: uploading")
+                compressed, derivatives, stats = await run_cpu_bound(
+                    compress_image, screenshot_bytes, profile, with_derivatives
+                )
+            print(f"[{url_id}] Image compressed ({stats['profile']}, q{stats['quality']}, "
+                  f"{stats['original_dims']} -> {stats['output_dims']}): "
+                  f"{stats['reduction_percent']}% in {stats['encode_ms']}ms")
+            _count_metric("screenshot_encode_ms", stats['encode_ms'])
+            _count_metric("screenshot_bytes", stats['compressed_size'])
+            if stats['cropped']:
+                _count_metric("screenshots_cropped")
+            _count_metric("screenshot_derivative_bytes", sum(stats['derivative_sizes'].values()))
+            uploaded, err = await upload_screenshot_async(compressed, derivatives, url_id)
+            if "full" in uploaded:
+                screenshots = {SCREENSHOT_URL_FIELDS[variant]: u for variant, u in uploaded.items()}
+                print(f"[{url_id}] Screenshot uploaded: {screenshots['screenshotUrl']}"
+                      + (f" (+{len(screenshots) - 1} derivatives)" if len(screenshots) > 1 else ""))
+                # Only successful extractions become the reference for the next run
+                product_data = await extraction
+                if ((dhash or policy == SCREENSHOT_POLICY_PRICE_CHANGED)
+                        and product_data and product_data.get("currentPrice")):
+                    await get_screenshot_index().put(url_id, dhash, screenshots, product_data)
+                return screenshots
+            if err:
+                print(f"[{url_id}] R2 error: {err}")
                 result.errors.append({
-                    "method": method_key,
-                    "operation": "screenshot_process",
-                    "error": str(e)[:200]
+                    "method": "r2",
+                    "operation": "upload",
+                    "error": err
                 })
+        except Exception as e:
+            print(f"[{url_id}] Screenshot error: {str(e)[:100]}")
+            result.errors.append({
+                "method": method_key,
+                "operation": "screenshot_process",
+                "error": str(e)[:200]
+            })
+        finally:
+            _count_metric("screenshot_ms", int((time.time() - started) * 1000))
+        return None
+
+    async def capture_on_demand(method_key: str, product_data: Optional[dict]) -> Optional[dict]:
+        """
+        Apply a lazy screenshot policy after an HTML-only fetch. Returns the URLs or None.
+
+        Called once per URL: for the winning method, or with product_data=None
+        after every method failed (error policy). With price_changed, an
+        unchanged price reuses the last stored screenshot instead of capturing.
+        """
+        needed = False
+        if policy == SCREENSHOT_POLICY_PRICE_CHANGED and product_data:
+            previous = await get_screenshot_index().get(url_id)
+            if (previous and previous.get("screenshotUrl")
+                    and ScreenshotIndex.same_product_state(previous, product_data)):
+                _count_metric("screenshots_skipped")
+                print(f"[{url_id}] Price unchanged since last screenshot: reusing {previous['screenshotUrl']}")
+                return ScreenshotIndex.screenshot_urls(previous)
+            needed = True
+        elif policy == SCREENSHOT_POLICY_ERROR and not product_data:
+            needed = True
+
+        if not needed:
+            _count_metric("screenshots_skipped")
+            return None
+
+        screenshot_bytes = await capture_screenshot_async(method_key, url, url_id)
+        if not screenshot_bytes:
+            return None
+        _count_metric("screenshots_on_demand")
+        extraction = asyncio.get_running_loop().create_future()
+        extraction.set_result(product_data)
+        return await process_screenshot(screenshot_bytes, method_key, extraction)
+
+    pending_methods = list(attempt_methods)
+    attempt_num = 0
+    last_fetch_method = None  # Last method that returned HTML (on-demand capture after all failed)
+
+    while pending_methods:
+        attempt_num += 1
+        current = pending_methods.pop(0)
+
+        if hedge_config["enabled"] and pending_methods:
+            secondary = pending_methods.pop(0)
+            attempt_result, unused_method = await fetch_hedged(attempt_num, current, secondary)
+            if unused_method:
+                # Only the winner is consumed; the other method stays next in line
+                pending_methods.insert(0, unused_method)
+            if unused_method is not secondary:
+                attempt_num += 1
+        else:
+            attempt_result = await fetch_with_retries(attempt_num, *current)
+
+        # If all retries failed, move to next method
+        if attempt_result is None:
+            continue
+
+        method_key = attempt_result.method
+        last_fetch_method = method_key
+        method_name = all_methods[method_key][0]
+
+        # Process screenshot as a side task, concurrently with extraction
+        screenshot_task = None
+        extraction_future = asyncio.get_running_loop().create_future()
+        if attempt_result.screenshot_bytes:
+            screenshot_task = asyncio.create_task(
+                process_screenshot(attempt_result.screenshot_bytes, method_key, extraction_future)
+            )
 
         # Extract data
-        product_data, extraction_error = await extract_product_data_async(
-            attempt_result.html, url, url_id
-        )
+        extraction_started = time.time()
+        try:
+            product_data, extraction_error = await extract_product(
+                attempt_result.html, url, url_id
+            )
+        except BaseException:
+            if screenshot_task:
+                screenshot_task.cancel()
+            raise
+        extraction_future.set_result(product_data)
+        _count_metric("extraction_ms", int((time.time() - extraction_started) * 1000))
+
+        # Join the screenshot pipeline at result assembly
+        screenshots = await screenshot_task if screenshot_task else None
+        extracted = bool(product_data and (product_data.get("currentPrice") or product_data.get("originalPrice")))
+        if screenshots:
+            last_screenshots = screenshots
 
-        if product_data and (product_data.get("currentPrice") or product_data.get("originalPrice")):
+        if extracted:
             print(f"[{url_id}] SUCCESS with {method_name}!")
+            if not capture_inline:
+                # Lazy policies capture once, for the winning method only
+                screenshots = await capture_on_demand(method_key, product_data)
 
             result.status = "completed"
             result.method = attempt_result.method
-            result.screenshotUrl = screenshot_url
+            for field, screenshot_url in (screenshots or {}).items():
+                setattr(result, field, screenshot_url)
             # Only include errors if there were any
             if not result.errors:
                 result.errors = None
-            for field in ["productTitle", "brand", "currentPrice", "originalPrice",
-                          "discountPercentage", "currency", "availability", "product_image_url",
-                          "seller", "shippingInfo", "shippingCost", "deliveryTime",
-                          "review_score", "installmentOptions", "kit", "unitMeasurement",
-                          "outOfStockReason", "marketplaceWebsite", "sku", "ean",
-                          "stockQuantity", "otherPaymentMethods", "promotionDetails"]:
+            for field in PRODUCT_FIELDS:
                 setattr(result, field, product_data.get(field))
 
             print(f"[{url_id}] Completed in {time.time() - start_time:.2f}s")
@@ -2279,19 +5521,24 @@ async def scrape_url(url_id: str, url: str, method: Optional[str] = None, initia
                 "error": extraction_error or "Could not extract price"
             }
             # Keep screenshot URL in error for debugging (don't delete)
-            if screenshot_url:
-                error_entry["screenshotUrl"] = screenshot_url
-                last_screenshot_url = screenshot_url
-                print(f"[{url_id}] Keeping screenshot for debugging: {screenshot_url}")
+            if screenshots:
+                error_entry["screenshotUrl"] = screenshots["screenshotUrl"]
+                print(f"[{url_id}] Keeping screenshot for debugging: {screenshots['screenshotUrl']}")
             result.errors.append(error_entry)
             last_error = extraction_error or "Could not extract price"
 
     # All failed
     print(f"\n[{url_id}] ALL {total_methods} METHOD(S) FAILED")
+    if not capture_inline and attempt_methods:
+        # One capture for the error policy, also when no method returned HTML
+        screenshots = await capture_on_demand(last_fetch_method or attempt_methods[0][2], None)
+        if screenshots:
+            last_screenshots = screenshots
     result.status = "error"
     result.method = "erro"  # Mark method as "erro" when all methods fail
     result.errorMessage = last_error or "All methods failed"
-    result.screenshotUrl = last_screenshot_url
+    for field, screenshot_url in last_screenshots.items():
+        setattr(result, field, screenshot_url)
     # Keep errors array (don't set to None for failed results)
 
     print(f"[{url_id}] Failed after {time.time() - start_time:.2f}s")
@@ -2301,16 +5548,62 @@ async def scrape_url(url_id: str, url: str, method: Optional[str] = None, initia
 
 
 # =============================================================================
-# Batch Processing with Semaphore
+# Batch Processing (Streaming Worker Pool)
 # =============================================================================
 
+# Fields kept per result when process_batch runs with compact_results=True
+COMPACT_RESULT_FIELDS = (
+    "urlId", "productUrl", "status", "scrapedAt", "errorMessage", "screenshotUrl",
+    "currentPrice", "method", "attempts", "errors", "metrics",
+    "alertsEnabled", "minPrice", "maxPrice",
+)
+
+
+def build_error_result(url_id: str, url: str, error: str, initial_data: Optional[dict] = None) -> dict:
+    """Build an error result for a URL that could not be scraped."""
+    error_result = {
+        "urlId": url_id,
+        "productUrl": url,
+        "status": "error",
+        "errorMessage": error[:200],
+        "scrapedAt": int(time.time() * 1000)
+    }
+    # Merge with initial_data so metadata is preserved even on errors
+    return merge_with_initial_data(error_result, initial_data)
+
+
+def compact_result(result: dict) -> dict:
+    """Keep only the fields needed after ingestion (stats, webhook, alerts, router)."""
+    return {k: result[k] for k in COMPACT_RESULT_FIELDS if k in result}
+
+
+def aggregate_metrics(results: List[dict]) -> dict:
+    """Sum the per-URL 'metrics' counters returned by scrape_url."""
+    totals = {}
+    for r in results:
+        for key, value in (r.get("metrics") or {}).items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                totals[key] = totals.get(key, 0) + value
+    totals["http_handshakes_saved"] = max(
+        0, totals.get("http_requests", 0) - totals.get("http_handshakes", 0)
+    )
+    return totals
+
+
 @app.function(
     image=scraper_image,
     timeout=7200,  # 2 hours for large batches
     secrets=[modal.Secret.from_name("bausch")],
 )
-async def process_batch(urls_data: List[dict]) -> List[dict]:
-    """Process batch with concurrency control via semaphore."""
+async def process_batch(urls_data: List[dict], compact_results: bool = False) -> List[dict]:
+    """
+    Process batch with concurrency control via a bounded worker pool.
+
+    Results are streamed into the Convex/Tinybird batcher as each URL finishes.
+    With compact_results=True only the fields needed for job stats, webhooks,
+    alerts and routing are kept in the returned list (see COMPACT_RESULT_FIELDS).
+    Results are returned in completion order.
+    """
     config = get_config()
     primary = get_primary_scraper()
     retries_config = get_retries_config()
@@ -2348,6 +5641,11 @@ async def process_batch(urls_data: List[dict]) -> List[dict]:
     print(f"  Bright Data: {retries_config[METHOD_BRIGHTDATA]} {'(disabled)' if retries_config[METHOD_BRIGHTDATA] == 0 else ''}")
     print(f"  Playwright:  {retries_config[METHOD_PLAYWRIGHT]} {'(disabled)' if retries_config[METHOD_PLAYWRIGHT] == 0 else ''}")
     print(f"{'='*70}")
+    hedge_config = get_hedge_config()
+    if hedge_config["enabled"]:
+        hedge_delay = f"{hedge_config['delay']}s" if hedge_config["delay"] is not None else "p90"
+        print(f"Hedged Fetch: ON (delay={hedge_delay}, max in flight={hedge_config['max_in_flight']}/container)")
+        print(f"{'='*70}")
     print(f"Tinybird Batching: {TINYBIRD_BATCH_SIZE} records/batch, {TINYBIRD_FLUSH_TIMEOUT}s timeout")
     print(f"{'='*70}")
     print(f"Scraping Priority: {priority_str}")
@@ -2355,13 +5653,6 @@ async def process_batch(urls_data: List[dict]) -> List[dict]:
 
     start_time = time.time()
 
-    # Use semaphore to control concurrency (respects API limits)
-    semaphore = asyncio.Semaphore(config["max_concurrency"])
-
-    async def scrape_with_semaphore(url_id: str, url: str, method: Optional[str] = None, initial_data: Optional[dict] = None) -> dict:
-        async with semaphore:
-            return await scrape_url.remote.aio(url_id, url, method, initial_data)
-
     # Pre-process items: extract URL, method, and initial_data from each item
     # This allows flexible input format (url or productUrl for the URL to scrape)
     processed_items = []
@@ -2389,68 +5680,18 @@ async def process_batch(urls_data: List[dict]) -> List[dict]:
             "url": url,
             "method": method,
             "initial_data": initial_data,
+            "screenshot_policy": get_screenshot_policy(item),
             "original_item": item,  # Keep reference for error handling
         })
 
     print(f"Processed {len(processed_items)} valid items from {len(urls_data)} input items")
 
-    # Create all tasks
-    tasks = [
-        scrape_with_semaphore(
-            item["url_id"],
-            item["url"],
-            item["method"],
-            item["initial_data"]
-        )
-        for item in processed_items
-    ]
-
-    # Run all tasks concurrently (semaphore limits actual concurrency)
-    results = await asyncio.gather(*tasks, return_exceptions=True)
-
-    # Handle any exceptions
-    processed_results = []
-    for i, r in enumerate(results):
-        if isinstance(r, Exception):
-            # Build error result with initial_data merged
-            item = processed_items[i]
-            error_result = {
-                "urlId": item["url_id"],
-                "productUrl": item["url"],
-                "status": "error",
-                "errorMessage": str(r)[:200],
-                "scrapedAt": int(time.time() * 1000)
-            }
-            # Merge with initial_data so metadata is preserved even on errors
-            error_result = merge_with_initial_data(error_result, item["initial_data"])
-            processed_results.append(error_result)
-        else:
-            processed_results.append(r)
-
-    scrape_elapsed = time.time() - start_time
-
-    # Stats
-    successful = sum(1 for r in processed_results if r.get("status") == "completed")
-    failed = len(processed_results) - successful
-    with_screenshots = sum(1 for r in processed_results if r.get("screenshotUrl"))
-    via_fc = sum(1 for r in processed_results if r.get("method") == METHOD_FIRECRAWL)
-    via_bd = sum(1 for r in processed_results if r.get("method") == METHOD_BRIGHTDATA)
-    via_pw = sum(1 for r in processed_results if r.get("method") == METHOD_PLAYWRIGHT)
-
-    print(f"\n{'='*60}")
-    print(f"SCRAPING COMPLETE")
-    print(f"{'='*60}")
-    print(f"Total: {len(processed_results)} | Success: {successful} | Failed: {failed}")
-    print(f"Screenshots: {with_screenshots}")
-    print(f"Methods: Firecrawl={via_fc}, BrightData={via_bd}, Playwright={via_pw}")
-    print(f"Scrape Time: {scrape_elapsed:.2f}s | Rate: {len(processed_results)/scrape_elapsed:.2f} URLs/sec")
-    print(f"{'='*60}\n")
-
     # Determine ingest destination: Convex (preferred) or Tinybird (fallback)
     # convexIngestUrl and batchId are injected by the caller (process_batch_with_job)
     convex_ingest_url = None
     batch_id_for_ingest = None
     trigger_type_for_ingest = "manual"
+    job_id_for_checkpoint = None
 
     # Check if any URL item has the convex ingest info (passed through initial_data)
     if urls_data and len(urls_data) > 0:
@@ -2458,35 +5699,136 @@ async def process_batch(urls_data: List[dict]) -> List[dict]:
         convex_ingest_url = first_item.get("_convexIngestUrl")
         batch_id_for_ingest = first_item.get("_batchId")
         trigger_type_for_ingest = first_item.get("_triggerType", "manual")
+        job_id_for_checkpoint = first_item.get("_jobId")
 
-    ingest_start = time.time()
+    # Per-URL completion checkpoints (only for tracked jobs)
+    checkpoint = JobCheckpoint(job_id_for_checkpoint) if job_id_for_checkpoint else None
 
     if convex_ingest_url:
         print(f"\n{'='*60}")
-        print(f"SENDING TO CONVEX + TINYBIRD (dual-write) → {convex_ingest_url}")
+        print(f"STREAMING TO CONVEX + TINYBIRD (dual-write) → {convex_ingest_url}")
         print(f"{'='*60}")
-
-        async with DualBatcher(convex_ingest_url, batch_id_for_ingest or "", trigger_type_for_ingest) as batcher:
-            for result in processed_results:
-                await batcher.add(result)
+        batcher_cm = DualBatcher(convex_ingest_url, batch_id_for_ingest or "", trigger_type_for_ingest)
     else:
         # Fallback: send to Tinybird directly (legacy path)
         print(f"\n{'='*60}")
-        print(f"SENDING TO TINYBIRD (batched) — legacy path")
+        print(f"STREAMING TO TINYBIRD (batched) — legacy path")
         print(f"{'='*60}")
+        batcher_cm = TinybirdBatcher()
 
-        async with TinybirdBatcher() as batcher:
-            for result in processed_results:
-                await batcher.add(result)
+    # Worker pool: max_concurrency workers pull items (respects API limits) and
+    # push finished results onto a bounded queue. The consumer feeds each result
+    # into the batcher as soon as it arrives, so ingestion overlaps scraping and
+    # only the in-flight window is held in full.
+    results_queue: asyncio.Queue = asyncio.Queue(maxsize=config["max_concurrency"] * 2)
+    items_iter = iter(processed_items)
+
+    async def scrape_worker():
+        for item in items_iter:  # Shared iterator: each item is taken by one worker
+            try:
+                r = await scrape_url.remote.aio(
+                    item["url_id"], item["url"], item["method"], item["initial_data"], item["screenshot_policy"]
+                )
+            except Exception as e:
+                r = build_error_result(item["url_id"], item["url"], str(e), item["initial_data"])
+            await results_queue.put(r)
+
+    processed_results = []
+
+    async with batcher_cm as batcher:
+        workers = [
+            asyncio.create_task(scrape_worker())
+            for _ in range(min(config["max_concurrency"], len(processed_items)))
+        ]
+        try:
+            for _ in range(len(processed_items)):
+                r = await results_queue.get()
+                await batcher.add(r)
+                processed_results.append(compact_result(r) if compact_results else r)
+
+                if checkpoint:
+                    checkpoint.add(r)
+                    if checkpoint.pending_count >= CHECKPOINT_INTERVAL:
+                        # Only checkpoint results that have reached the ingest endpoint
+                        await batcher.flush()
+                        await checkpoint.flush(exclude=batcher.failed_url_ids)
+        finally:
+            for worker in workers:
+                if not worker.done():
+                    worker.cancel()
+        scrape_elapsed = time.time() - start_time
+        ingest_start = time.time()
+    ingest_tail = time.time() - ingest_start
+
+    if checkpoint:
+        await checkpoint.flush(exclude=batcher.failed_url_ids)
+
+    batch_metrics = aggregate_metrics(processed_results)
+
+    # Stats
+    successful = sum(1 for r in processed_results if r.get("status") == "completed")
+    failed = len(processed_results) - successful
+    with_screenshots = sum(1 for r in processed_results if r.get("screenshotUrl"))
+    via_fc = sum(1 for r in processed_results if r.get("method") == METHOD_FIRECRAWL)
+    via_bd = sum(1 for r in processed_results if r.get("method") == METHOD_BRIGHTDATA)
+    via_pw = sum(1 for r in processed_results if r.get("method") == METHOD_PLAYWRIGHT)
+
+    print(f"\n{'='*60}")
+    print(f"SCRAPING COMPLETE")
+    print(f"{'='*60}")
+    print(f"Total: {len(processed_results)} | Success: {successful} | Failed: {failed}")
+    print(f"Screenshots: {with_screenshots}"
+          + (f" | skipped by policy: {batch_metrics['screenshots_skipped']}" if batch_metrics.get("screenshots_skipped") else "")
+          + (f" | on demand: {batch_metrics['screenshots_on_demand']}" if batch_metrics.get("screenshots_on_demand") else ""))
+    print(f"Methods: Firecrawl={via_fc}, BrightData={via_bd}, Playwright={via_pw}")
+    if batch_metrics.get("hedges_started") or batch_metrics.get("hedges_skipped"):
+        print(f"Hedges: {batch_metrics.get('hedges_started', 0)} started, "
+              f"{batch_metrics.get('hedges_won', 0)} won by secondary, "
+              f"{batch_metrics.get('hedges_skipped', 0)} skipped (budget)")
+    print(f"Extraction: {batch_metrics.get('extract_structured', 0)} structured data, "
+          f"{batch_metrics.get('extract_template', 0)} domain templates "
+          f"({batch_metrics.get('template_learned', 0)} learned, {batch_metrics.get('template_rejected', 0)} rejected), "
+          f"{batch_metrics.get('extract_gemini', 0)} Gemini "
+          f"({batch_metrics.get('extract_gemini_batched', 0)} batched, "
+          f"cache: {batch_metrics.get('extract_cache_hits', 0)} hits, "
+          f"{batch_metrics.get('extract_cache_misses', 0)} misses)")
+    print(f"HTTP Pool: {batch_metrics.get('http_requests', 0)} requests, "
+          f"{batch_metrics.get('http_connections', 0)} new connections, "
+          f"{batch_metrics.get('http_handshakes', 0)} TLS handshakes "
+          f"({batch_metrics.get('http_handshakes_saved', 0)} saved)")
+    r2_uploads = sum(v for k, v in batch_metrics.items() if k.startswith("r2_put_le_") or k.startswith("r2_multipart_le_"))
+    if r2_uploads or batch_metrics.get("r2_put_skipped"):
+        histogram = ", ".join(
+            f"≤{b}ms={batch_metrics.get(f'r2_put_le_{b}', 0)}" for b in (*R2_LATENCY_BUCKETS_MS, "inf")
+            if batch_metrics.get(f"r2_put_le_{b}")
+        )
+        print(f"R2: {batch_metrics.get('r2_bytes', 0) / 1e6:.1f} MB, "
+              f"{batch_metrics.get('r2_retries', 0)} retries, {batch_metrics.get('r2_errors', 0)} errors, "
+              f"{batch_metrics.get('r2_put_skipped', 0)} duplicates skipped "
+              f"({batch_metrics.get('r2_bytes_skipped', 0) / 1e6:.1f} MB) | "
+              f"PUT latency: {histogram or 'n/a'}")
+    if batch_metrics.get("cpu_pool_tasks"):
+        print(f"CPU Pool: {batch_metrics['cpu_pool_tasks']} tasks, "
+              f"avg wait {batch_metrics.get('cpu_pool_wait_ms', 0) / batch_metrics['cpu_pool_tasks']:.0f}ms, "
+              f"avg run {batch_metrics.get('cpu_pool_run_ms', 0) / batch_metrics['cpu_pool_tasks']:.0f}ms, "
+              f"{batch_metrics.get('cpu_pool_queued', 0)} queued")
+    print(f"Scrape Time: {scrape_elapsed:.2f}s | Rate: {len(processed_results)/max(scrape_elapsed, 0.001):.2f} URLs/sec")
+    print(f"{'='*60}\n")
+
+    # Feed per-domain outcomes back to the router
+    if is_router_enabled():
+        try:
+            await get_domain_router().record_results(processed_results)
+        except Exception as e:
+            print(f"[DomainRouter] Failed to record results: {str(e)[:100]}")
 
-    ingest_elapsed = time.time() - ingest_start
     total_elapsed = time.time() - start_time
 
     print(f"\n{'='*60}")
     print(f"BATCH COMPLETE")
     print(f"{'='*60}")
-    print(f"Scrape Time: {scrape_elapsed:.2f}s")
-    print(f"Ingest Time: {ingest_elapsed:.2f}s")
+    print(f"Scrape + Ingest (overlapped): {scrape_elapsed:.2f}s")
+    print(f"Final Flush: {ingest_tail:.2f}s")
     print(f"Total Time: {total_elapsed:.2f}s")
     print(f"{'='*60}\n")
 
@@ -2851,6 +6193,198 @@ class TinybirdJobManager:
             return False
 
 
+# =============================================================================
+# Job Checkpoints (Resumable Jobs)
+# =============================================================================
+
+class JobCheckpoint:
+    """
+    Per-URL completion checkpoints for a job, stored in a modal.Dict.
+
+    Layout (one Dict per job, named scrape-job-{jobId}):
+        "__input__" -> {"urls_data": [...], "webhook_url": ..., ...}
+        "__call__"  -> FunctionCall id of the run (resume refuses while it is running)
+        "<urlId>"   -> compact result (see compact_result)
+
+    process_batch flushes the ingest batcher before each checkpoint flush and
+    excludes the urlIds of batches that were not acknowledged, so a
+    checkpointed URL has always been ingested and is never lost on resume. If the job container dies,
+    process_batch_with_job(..., resume=True) re-runs only the missing urlIds.
+    """
+
+    def __init__(self, job_id: str, store=None):
+        self.job_id = job_id
+        self._store = store
+        self._pending: dict = {}
+        self._written = 0
+
+    @property
+    def dict_name(self) -> str:
+        return f"{CHECKPOINT_DICT_PREFIX}{self.job_id}"
+
+    def _get_store(self, create: bool = True):
+        if self._store is None:
+            if not create:
+                # Lookup only: raises NotFoundError on use if the job never stored anything
+                return modal.Dict.from_name(self.dict_name)
+            self._store = modal.Dict.from_name(self.dict_name, create_if_missing=True)
+        return self._store
+
+    @property
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    def add(self, result: dict):
+        """Buffer a finished result (written on next flush)."""
+        url_id = result.get("urlId")
+        if url_id:
+            self._pending[url_id] = compact_result(result)
+
+    async def flush(self, exclude: Optional[set] = None):
+        """Write buffered checkpoints, minus urlIds in exclude (not ingested). Errors are logged, never raised."""
+        batch = {k: v for k, v in self._pending.items() if not exclude or k not in exclude}
+        if len(batch) < len(self._pending):
+            print(f"[JobCheckpoint] {self.job_id}: {len(self._pending) - len(batch)} URLs not ingested, "
+                  f"left unchecked for resume")
+        self._pending = {}
+        if not batch:
+            return
+        try:
+            await self._get_store().update.aio(batch)
+            self._written += len(batch)
+        except Exception as e:
+            print(f"[JobCheckpoint] {self.job_id}: failed to write {len(batch)} checkpoints: {str(e)[:100]}")
+
+    async def save_input(self, payload: dict):
+        """Store the job input so the job can be resumed from its jobId alone."""
+        try:
+            await self._get_store().put.aio(CHECKPOINT_INPUT_KEY, payload)
+        except Exception as e:
+            print(f"[JobCheckpoint] {self.job_id}: failed to save input: {str(e)[:100]}")
+
+    async def save_call(self, call_id: str):
+        """Record the FunctionCall running this job."""
+        try:
+            await self._get_store().put.aio(CHECKPOINT_CALL_KEY, call_id)
+        except Exception as e:
+            print(f"[JobCheckpoint] {self.job_id}: failed to save call id: {str(e)[:100]}")
+
+    async def load_input(self) -> Optional[dict]:
+        """Load the stored job input (None if unknown job). Never creates the Dict."""
+        try:
+            return await self._get_store(create=False).get.aio(CHECKPOINT_INPUT_KEY)
+        except modal.exception.NotFoundError:
+            return None
+
+    async def is_running(self) -> bool:
+        """Whether the job's recorded FunctionCall has not finished yet."""
+        try:
+            call_id = await self._get_store(create=False).get.aio(CHECKPOINT_CALL_KEY)
+        except modal.exception.NotFoundError:
+            return False
+        if not call_id:
+            return False
+        try:
+            await modal.FunctionCall.from_id(call_id).get.aio(timeout=0)
+        except TimeoutError:
+            return True  # No output yet
+        except Exception:
+            return False  # Finished with an error (crash, timeout, cancelled)
+        return False
+
+    async def load_completed(self) -> dict:
+        """Load checkpointed results: urlId -> compact result."""
+        completed = {}
+        try:
+            async for key, value in self._get_store(create=False).items.aio():
+                if key not in (CHECKPOINT_INPUT_KEY, CHECKPOINT_CALL_KEY):
+                    completed[key] = value
+        except modal.exception.NotFoundError:
+            pass
+        return completed
+
+    async def delete(self):
+        """Drop the job's checkpoints (job finished, nothing to resume)."""
+        try:
+            await modal.Dict.objects.delete.aio(self.dict_name, allow_missing=True)
+        except Exception as e:
+            print(f"[JobCheckpoint] {self.job_id}: failed to delete checkpoints: {str(e)[:100]}")
+
+
+# =============================================================================
+# Sharded Batch Processing
+# =============================================================================
+
+def get_shard_size() -> int:
+    """URLs per shard from SHARD_SIZE (default: 1000, 0 = disabled)."""
+    value = os.environ.get("SHARD_SIZE", "").strip()
+    if not value:
+        return DEFAULT_SHARD_SIZE
+    try:
+        return max(0, int(value))
+    except ValueError:
+        return DEFAULT_SHARD_SIZE
+
+
+def split_into_shards(items: List[dict], shard_size: int) -> List[List[dict]]:
+    """Split items into consecutive chunks of at most shard_size."""
+    return [items[i:i + shard_size] for i in range(0, len(items), shard_size)]
+
+
+async def process_batch_sharded(urls_data: List[dict], shard_size: int) -> List[dict]:
+    """
+    Fan a large job out to one process_batch container per shard.
+
+    Each shard streams its own results into Convex/Tinybird and returns compact
+    results, which are merged here for the job record. A shard that crashes
+    does not fail the whole job: URLs it already checkpointed (and so ingested)
+    keep their checkpointed result, the rest turn into error results.
+    Provider limits still hold across shards via the cluster limiter.
+    """
+    shards = split_into_shards(urls_data, shard_size)
+    print(f"\n{'='*70}")
+    print(f"SHARDED EXECUTION: {len(urls_data)} URLs -> {len(shards)} shards of <= {shard_size}")
+    print(f"{'='*70}\n")
+
+    shard_start = time.time()
+    results = []
+    shard_index = 0
+    async for shard_results in process_batch.map.aio(
+        shards, kwargs={"compact_results": True}, return_exceptions=True
+    ):
+        shard = shards[shard_index]
+        shard_index += 1
+
+        if isinstance(shard_results, BaseException):
+            print(f"[Shard {shard_index}/{len(shards)}] FAILED: {str(shard_results)[:200]}")
+            job_id = shard[0].get("_jobId") if shard else None
+            checkpointed = {}
+            if job_id:
+                try:
+                    checkpointed = await JobCheckpoint(job_id).load_completed()
+                except Exception as e:
+                    print(f"[Shard {shard_index}/{len(shards)}] Checkpoint read error: {str(e)[:100]}")
+            recovered = 0
+            for item in shard:
+                url = extract_url_from_item(item)
+                if item.get("urlId") in checkpointed:
+                    results.append(checkpointed[item["urlId"]])
+                    recovered += 1
+                elif url and item.get("urlId"):
+                    results.append(build_error_result(
+                        item["urlId"], url, f"Shard failed: {shard_results}", extract_initial_data(item)
+                    ))
+            print(f"[Shard {shard_index}/{len(shards)}] Kept {recovered}/{len(shard)} checkpointed results")
+            continue
+
+        completed = sum(1 for r in shard_results if r.get("status") == "completed")
+        print(f"[Shard {shard_index}/{len(shards)}] Done: {completed}/{len(shard_results)} completed "
+              f"({time.time() - shard_start:.1f}s since start)")
+        results.extend(shard_results)
+
+    return results
+
+
 # =============================================================================
 # Process Batch with Job Tracking
 # =============================================================================
@@ -2867,18 +6401,43 @@ async def process_batch_with_job(
     convex_ingest_url: Optional[str] = None,
     batch_id: Optional[str] = None,
     trigger_type: Optional[str] = None,
+    resume: bool = False,
+    screenshot_policy: Optional[str] = None,
 ) -> dict:
     """
     Process batch with job tracking in Tinybird.
 
     This is the main entry point for the API. It:
     1. Updates job status to 'processing'
-    2. Runs the scraping
+    2. Runs the scraping (checkpointing each URL as it is ingested)
     3. Updates job status to 'completed'/'partial'/'failed'
     4. Sends webhook if configured
     5. Returns summary (not full results - those go to Convex/product_scrapes)
+
+    With resume=True, URLs already checkpointed for this job_id are skipped
+    and their checkpointed results are counted in the job stats.
+
+    screenshot_policy applies to every URL without its own screenshotPolicy.
     """
     job_manager = TinybirdJobManager()
+    checkpoint = JobCheckpoint(job_id)
+
+    if resume:
+        previous_results = list((await checkpoint.load_completed()).values())
+        done_ids = {r.get("urlId") for r in previous_results}
+        print(f"[Resume] Job {job_id}: {len(done_ids)} URLs checkpointed, "
+              f"{sum(1 for item in urls_data if item.get('urlId') not in done_ids)} left to scrape")
+    else:
+        previous_results = []
+        done_ids = set()
+        await checkpoint.save_input({
+            "urls_data": urls_data,
+            "webhook_url": webhook_url,
+            "convex_ingest_url": convex_ingest_url,
+            "batch_id": batch_id,
+            "trigger_type": trigger_type,
+            "screenshot_policy": screenshot_policy,
+        })
 
     # Inject Convex ingest metadata into urls_data so process_batch can pick it up
     if convex_ingest_url and urls_data:
@@ -2887,6 +6446,12 @@ async def process_batch_with_job(
             item["_batchId"] = batch_id or ""
             item["_triggerType"] = trigger_type or "manual"
 
+    # Tag items with the job id so process_batch (and its shards) can checkpoint
+    for item in urls_data:
+        item["_jobId"] = job_id
+        if screenshot_policy:
+            item["_screenshotPolicy"] = screenshot_policy
+
     # Extract company name from first URL if available
     company_name = None
     if urls_data:
@@ -2907,18 +6472,29 @@ async def process_batch_with_job(
         # Mark as processing
         job = await job_manager.start_job(job)
 
-        # Run the actual batch processing
-        results = await process_batch.local(urls_data)
+        # Run the actual batch processing (sharded across containers for large jobs)
+        pending_urls = [item for item in urls_data if item.get("urlId") not in done_ids]
+        shard_size = get_shard_size()
+        if not pending_urls:
+            results = []
+        elif shard_size and len(pending_urls) > shard_size:
+            results = await process_batch_sharded(pending_urls, shard_size)
+        else:
+            results = await process_batch.local(pending_urls, compact_results=True)
+        results = previous_results + results
 
         # Calculate stats
         completed = sum(1 for r in results if r.get("status") == "completed")
         failed = len(results) - completed
         with_screenshots = sum(1 for r in results if r.get("screenshotUrl"))
 
+        job_metrics = aggregate_metrics(results)
         method_stats = {
             "firecrawl": sum(1 for r in results if r.get("method") == METHOD_FIRECRAWL),
             "brightdata": sum(1 for r in results if r.get("method") == METHOD_BRIGHTDATA),
             "playwright": sum(1 for r in results if r.get("method") == METHOD_PLAYWRIGHT),
+            "screenshotsSkipped": job_metrics.get("screenshots_skipped", 0),
+            "screenshotsOnDemand": job_metrics.get("screenshots_on_demand", 0),
         }
 
         # Complete the job
@@ -2964,6 +6540,9 @@ async def process_batch_with_job(
 
         await job_manager.close()
 
+        # Job finished - nothing left to resume
+        await checkpoint.delete()
+
         return {
             "jobId": job_id,
             "status": job.status,
@@ -3009,6 +6588,7 @@ def scraper_api():
 
     Endpoints:
     - POST /api/v1/scrape - Submit a new scrape job
+    - POST /api/v1/scrape/{job_id}/resume - Resume a crashed job (missing URLs only)
     - GET /api/v1/scrape/{job_id} - Get job status
     - GET /api/v1/scrape - List recent jobs
     - GET /health - Health check
@@ -3063,6 +6643,9 @@ def scraper_api():
         convexIngestUrl: Optional[str] = Field(None, description="Convex HTTP endpoint for scrape data ingestion")
         batchId: Optional[str] = Field(None, description="Batch identifier for Convex tracking")
         triggerType: Optional[str] = Field(None, description="Trigger type: 'cron' or 'manual'")
+        screenshotPolicy: Optional[str] = Field(
+            None, description="Screenshot policy for the job: always, alert, price_changed or error"
+        )
 
     class ScrapeResponse(BaseModel):
         jobId: str
@@ -3157,14 +6740,16 @@ def scraper_api():
         await job_manager.close()
 
         # Spawn the batch processing (non-blocking)
-        process_batch_with_job.spawn(
+        call = await process_batch_with_job.spawn.aio(
             job_id,
             urls_data,
             body.webhookUrl,
             body.convexIngestUrl,
             body.batchId,
             body.triggerType,
+            screenshot_policy=body.screenshotPolicy,
         )
+        await JobCheckpoint(job_id).save_call(call.object_id)
 
         return ScrapeResponse(
             jobId=job_id,
@@ -3173,6 +6758,54 @@ def scraper_api():
             message=f"Job submitted. Query GET /api/v1/scrape/{job_id} for status.",
         )
 
+    @api.post("/api/v1/scrape/{job_id}/resume", response_model=ScrapeResponse)
+    async def resume_scrape(job_id: str):
+        """
+        Resume a job whose container died or timed out.
+
+        Only URLs without a checkpoint are scraped again; the job record and
+        webhook include the checkpointed results. Jobs that are still running
+        or already completed are rejected with 409 (failed jobs can resume).
+        """
+        checkpoint = JobCheckpoint(job_id)
+        try:
+            saved = await checkpoint.load_input()
+            running = await checkpoint.is_running() if saved else False
+        except Exception as e:
+            raise HTTPException(500, f"Error loading checkpoints: {str(e)[:200]}")
+
+        if not saved:
+            raise HTTPException(404, f"No checkpoints for job {job_id} (finished or unknown)")
+        if running:
+            raise HTTPException(409, f"Job {job_id} is still running")
+
+        try:
+            job_rows = (await query_tinybird("get_job", {"job_id": job_id})).get("data", [])
+        except Exception as e:
+            print(f"[Resume] Job {job_id}: status lookup failed: {str(e)[:100]}")
+            job_rows = []
+        if job_rows and job_rows[0].get("status") in ("completed", "partial"):
+            raise HTTPException(409, f"Job {job_id} already finished ({job_rows[0]['status']})")
+
+        call = await process_batch_with_job.spawn.aio(
+            job_id,
+            saved["urls_data"],
+            saved.get("webhook_url"),
+            saved.get("convex_ingest_url"),
+            saved.get("batch_id"),
+            saved.get("trigger_type"),
+            True,
+            screenshot_policy=saved.get("screenshot_policy"),
+        )
+        await checkpoint.save_call(call.object_id)
+
+        return ScrapeResponse(
+            jobId=job_id,
+            status="processing",
+            totalUrls=len(saved["urls_data"]),
+            message=f"Job resumed. Query GET /api/v1/scrape/{job_id} for status.",
+        )
+
     @api.get("/api/v1/scrape/{job_id}", response_model=JobStatusResponse)
     async def get_job_status(job_id: str):
         """
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Benchmark clean_html on generated 1-3 MB retail pages.
+
+Pages are generated from a fixed seed (product block, JSON-LD, meta tags,
+microdata, shelves of product cards, nav/footer noise), so runs are
+comparable. With --baseline REV the clean_html of app/modal_scraper.py at
+that git revision is timed on the same pages, and its output is compared
+with the current one (element parity + category counts).
+
+Usage:
+    python scripts/bench_clean_html.py
+    python scripts/bench_clean_html.py --sizes 1 2 3 --repeat 5
+    python scripts/bench_clean_html.py --baseline <rev before the lxml cleaner>
+    python scripts/bench_clean_html.py --write-page 0.2 tests/fixtures/clean_html/generated_200k.html
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "app"))
+
+STAT_KEYS = ("areas_found", "images_found", "meta_tags_found", "schema_elements_found")
+UNLIMITED_BUDGET = 10 ** 9
+
+
+def generate_page(seed: int, target_bytes: int) -> str:
+    """Retail product page of about target_bytes, deterministic for a seed."""
+    rng = random.Random(seed)
+    parts = [
+        '<!DOCTYPE html><html><head><title>Loja</title>',
+        '<meta property="og:title" content="Produto X &amp; Y"><meta name="viewport" content="w">'
+        '<meta property="product:price:amount" content="14.90">',
+        '<link rel="stylesheet" href="a.css"><style>.a{color:red}</style>',
+        '<script type="application/ld+json">%s</script>' % json.dumps(
+            {"@type": "Product", "name": "Produto X", "offers": {"price": "14.90", "priceCurrency": "BRL"}}),
+        '<script>var analytics=1;</script><script>window.__STATE__={"product":{"price":1490}}</script>',
+        '</head><body><nav class="menu"><a class="price-link" href="/">Preço</a></nav><!-- comment -->',
+        '<div class="product-main" id="pdp"><h1 class="product-title" itemprop="name">Produto X</h1>'
+        '<div class="price-box"><span class="price-current" itemprop="price" content="14.90">R$ 14,90</span>'
+        '<span class="price-old">R$ 19,90</span></div><img src="https://cdn.loja.com/img/produto-x-large.jpg" alt="x">'
+        '<div data-product-id="123" class="buy-cta"><button>Comprar</button></div><svg><path d="M0"/></svg></div>',
+    ]
+    size = sum(map(len, parts))
+    i = 0
+    while size < target_bytes:
+        i += 1
+        kind = rng.random()
+        if kind < 0.3:
+            part = (f'<div class="shelf-item product-card-{i}"><a href="/p/{i}"><img src="https://cdn.loja.com/img/p{i}-thumb.jpg"></a>'
+                    f'<span class="price">R$ {rng.randint(1, 999)},90</span><p>{"lorem ipsum " * rng.randint(5, 40)}</p></div>')
+        elif kind < 0.5:
+            part = f'<section id="sec{i}"><div><p>{"texto " * rng.randint(20, 200)}</p><span itemprop="brand">Marca{i}</span></div></section>'
+        elif kind < 0.6:
+            part = f'<div data-sku="{i}"><span>{"x" * rng.randint(10, 300)}</span></div>'
+        elif kind < 0.7:
+            part = f'<footer><div class="price">{i}</div></footer><noscript><img src="https://t.com/pixel{i}.gif"></noscript>'
+        else:
+            items = "".join(f"<li class=n{j}>item {j}</li>" for j in range(rng.randint(5, 50)))
+            part = f'<div class="wrap"><ul>{items}</ul></div>'
+        parts.append(part)
+        size += len(part)
+    parts.append('<script>console.log("end")</script></body></html>')
+    return "".join(parts)
+
+
+def output_elements(cleaned: str) -> set:
+    """(tag, attributes, text) of every element in a clean_html output, for parity checks."""
+    from lxml import html as lxml_html
+
+    if not cleaned.strip():
+        return set()
+    elements = set()
+    for fragment in lxml_html.fragments_fromstring(cleaned):
+        if isinstance(fragment, str):
+            continue
+        for el in fragment.iter():
+            if isinstance(el.tag, str):
+                elements.add((el.tag, tuple(sorted(_normalize_attr(k, v) for k, v in el.attrib.items())),
+                              (el.text or "").strip()))
+    return elements
+
+
+def _normalize_attr(name: str, value: str):
+    """Undo serializer differences: class whitespace, boolean attributes (disabled="" / "disabled")."""
+    if name == "class":
+        value = " ".join(value.split())
+    elif value == name:
+        value = ""
+    return name, value
+
+
+def load_baseline(rev: str):
+    """Import app/modal_scraper.py as it was at a git revision."""
+    source = subprocess.run(
+        ["git", "show", f"{rev}:app/modal_scraper.py"], cwd=ROOT, check=True, capture_output=True, text=True
+    ).stdout
+    path = os.path.join(tempfile.mkdtemp(), "baseline_modal_scraper.py")
+    with open(path, "w") as f:
+        f.write(source)
+    spec = importlib.util.spec_from_file_location("baseline_modal_scraper", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def best_time(func, html: str, repeat: int):
+    """Best wall time (s) over repeat runs, and the last result."""
+    best, result = None, None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func(html, token_budget=UNLIMITED_BUDGET)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=float, nargs="+", default=[1, 2, 3], help="Page sizes in MB (default: 1 2 3)")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per page, best time is reported (default: 3)")
+    parser.add_argument("--baseline", help="git revision whose clean_html is timed and compared")
+    parser.add_argument("--write-page", nargs=2, metavar=("MB", "PATH"), help="Write one generated page and exit")
+    args = parser.parse_args()
+
+    if args.write_page:
+        with open(args.write_page[1], "w") as f:
+            f.write(generate_page(1, int(float(args.write_page[0]) * 1_000_000)))
+        return
+
+    import modal_scraper as current
+    baseline = load_baseline(args.baseline) if args.baseline else None
+
+    for seed, size_mb in enumerate(args.sizes, start=1):
+        html = generate_page(seed, int(size_mb * 1_000_000))
+        new_s, (new_out, new_stats) = best_time(current.clean_html, html, args.repeat)
+        line = f"{len(html) / 1e6:.1f} MB  current {new_s * 1000:7.0f} ms"
+        if baseline is not None:
+            old_s, (old_out, old_stats) = best_time(baseline.clean_html, html, args.repeat)
+            old_elements, new_elements = output_elements(old_out), output_elements(new_out)
+            counts = ", ".join(f"{k}={old_stats[k]}/{new_stats[k]}" for k in STAT_KEYS)
+            line += (f"  baseline {old_s * 1000:7.0f} ms  x{old_s / new_s:.1f}"
+                     f"  | missing {len(old_elements - new_elements)}, extra {len(new_elements - old_elements)}"
+                     f"  | {counts}")
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Parity test for clean_html against a golden corpus.
+
+tests/fixtures/clean_html/<name>.html are product pages (VTEX, Shopify,
+Next.js, Magento microdata and a generated 200 KB retail page). The
+<name>.golden.html / <name>.golden.json files are the output and stats of
+the BeautifulSoup implementation that preceded the lxml cleaner, run with an
+unlimited token budget.
+
+Every element of the golden output must still be present. The lxml cleaner
+may emit more areas than before (nested duplicates no longer consume area
+slots), so extra elements are allowed and areas_found may only go down.
+
+Run: python -m unittest discover -s tests
+"""
+
+import json
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "app"))
+sys.path.insert(0, os.path.join(ROOT, "scripts"))
+
+from bench_clean_html import UNLIMITED_BUDGET, output_elements  # noqa: E402
+from modal_scraper import clean_html  # noqa: E402
+
+FIXTURES = os.path.join(ROOT, "tests", "fixtures", "clean_html")
+EXACT_STATS = ("images_found", "meta_tags_found", "schema_elements_found")
+
+
+def _read(path: str) -> str:
+    with open(path, encoding="utf-8") as f:
+        return f.read()
+
+
+class CleanHtmlGoldenTest(unittest.TestCase):
+    def test_golden_corpus(self):
+        pages = sorted(
+            name[:-len(".html")] for name in os.listdir(FIXTURES)
+            if name.endswith(".html") and not name.endswith(".golden.html")
+        )
+        self.assertTrue(pages)
+        for name in pages:
+            with self.subTest(page=name):
+                cleaned, stats = clean_html(_read(os.path.join(FIXTURES, f"{name}.html")), token_budget=UNLIMITED_BUDGET)
+                golden = _read(os.path.join(FIXTURES, f"{name}.golden.html"))
+                golden_stats = json.loads(_read(os.path.join(FIXTURES, f"{name}.golden.json")))
+
+                missing = output_elements(golden) - output_elements(cleaned)
+                self.assertEqual(missing, set(), f"{name}: elements of the golden output are missing")
+                for key in EXACT_STATS:
+                    self.assertEqual(stats[key], golden_stats[key], f"{name}: {key}")
+                self.assertLessEqual(stats["areas_found"], golden_stats["areas_found"])
+                self.assertGreater(stats["areas_found"], 0)
+
+    def test_token_budget_is_respected(self):
+        html = _read(os.path.join(FIXTURES, "generated_200k.html"))
+        _, stats = clean_html(html, token_budget=500)
+        self.assertLessEqual(stats["tokens"], 500)
+
+
+if __name__ == "__main__":
+    unittest.main()
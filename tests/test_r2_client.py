@@ -0,0 +1,96 @@
+"""
+AsyncR2Client against a local S3 server (moto).
+
+Covers a single PUT, a multipart upload and the conditional PUT
+(If-None-Match: *) that answers 412 for a key that is already stored.
+Skipped when moto (moto[server]) or boto3 is not installed.
+
+Run: python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "app"))
+
+import modal_scraper  # noqa: E402
+from modal_scraper import R2_MULTIPART_PART_SIZE, AsyncR2Client  # noqa: E402
+
+try:
+    import boto3
+    from moto.server import ThreadedMotoServer
+except ImportError:
+    ThreadedMotoServer = None
+
+BUCKET = "screenshots-test"
+
+
+@unittest.skipIf(ThreadedMotoServer is None, "moto[server] and boto3 are required")
+class AsyncR2ClientTest(unittest.IsolatedAsyncioTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadedMotoServer(ip_address="127.0.0.1", port=0, verbose=False)
+        cls.server.start()
+        host, port = cls.server.get_host_and_port()
+        cls.endpoint = f"http://{host}:{port}"
+        cls.s3 = boto3.client("s3", endpoint_url=cls.endpoint, region_name="us-east-1",
+                              aws_access_key_id="testing", aws_secret_access_key="testing")
+        cls.s3.create_bucket(Bucket=BUCKET)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    async def asyncSetUp(self):
+        self.client = AsyncR2Client("test", "testing", "testing", bucket=BUCKET)
+        self.client.endpoint = self.endpoint
+
+    async def asyncTearDown(self):
+        # Pooled httpx clients belong to this test's event loop
+        await modal_scraper.close_http_clients()
+
+    def _stored(self, key: str) -> bytes:
+        return self.s3.get_object(Bucket=BUCKET, Key=key)["Body"].read()
+
+    async def test_single_put(self):
+        data = os.urandom(200_000)
+        self.assertTrue(await self.client.put_object("single/a.webp", data, "image/webp", cache_control="no-cache"))
+        self.assertEqual(self._stored("single/a.webp"), data)
+        head = self.s3.head_object(Bucket=BUCKET, Key="single/a.webp")
+        self.assertEqual(head["ContentType"], "image/webp")
+        self.assertEqual(head["CacheControl"], "no-cache")
+        self.assertTrue(await self.client.head_object("single/a.webp"))
+        self.assertFalse(await self.client.head_object("single/missing.webp"))
+
+    async def test_multipart_upload(self):
+        data = os.urandom(2 * R2_MULTIPART_PART_SIZE + 1234)
+        os.environ["R2_MULTIPART_THRESHOLD"] = str(R2_MULTIPART_PART_SIZE)
+        try:
+            self.assertTrue(await self.client.put_object("multi/b.webp", data, "image/webp"))
+        finally:
+            del os.environ["R2_MULTIPART_THRESHOLD"]
+        self.assertIn("multipart", self.client.get_stats())
+        self.assertEqual(self.client.get_stats()["part"]["count"], 3)
+        self.assertEqual(self._stored("multi/b.webp"), data)
+        self.assertEqual(self.s3.list_multipart_uploads(Bucket=BUCKET).get("Uploads", []), [])
+
+    async def test_conditional_put_412(self):
+        first, second = os.urandom(50_000), os.urandom(50_000)
+        self.assertTrue(await self.client.put_object("cond/c.webp", first, "image/webp", if_absent=True))
+        # Already stored: the PUT is answered with 412 and the object is left untouched
+        self.assertFalse(await self.client.put_object("cond/c.webp", second, "image/webp", if_absent=True))
+        self.assertEqual(self._stored("cond/c.webp"), first)
+        self.assertEqual(self.client.get_stats()["put"]["errors"], 0)
+
+    async def test_put_if_absent_remembers_keys(self):
+        data = os.urandom(10_000)
+        self.assertTrue(await self.client.put_if_absent("known/d.webp", data, "image/webp"))
+        requests_before = self.client.get_stats()["put"]["count"]
+        self.assertFalse(await self.client.put_if_absent("known/d.webp", data, "image/webp"))
+        self.assertEqual(self.client.get_stats()["put"]["count"], requests_before)
+
+
+if __name__ == "__main__":
+    unittest.main()